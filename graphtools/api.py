@@ -11,6 +11,7 @@ def Graph(data,
           sample_idx=None,
           adaptive_k='sqrt',
           precomputed=None,
+          kernel_output='auto',
           knn=5,
           decay=10,
           distance='euclidean',
@@ -19,10 +20,21 @@ def Graph(data,
           gamma=None,
           n_landmark=None,
           n_svd=100,
+          landmark_method='spectral',
+          streaming=False,
+          landmark_output='dense',
+          landmark_thresh=0,
+          n_init=1,
+          empty_clusters='drop',
           beta=1,
+          knn_method='auto',
+          knn_params=None,
+          precomputed_neighbors=None,
           n_jobs=-1,
           verbose=False,
           random_state=None,
+          dtype=None,
+          max_memory=None,
           graphtype='auto',
           use_pygsp=False,
           initialize=True,
@@ -42,6 +54,8 @@ def Graph(data,
     Incompatibilities:
     - MNNGraph and kNNGraph cannot be precomputed
     - kNNGraph and TraditionalGraph do not accept sample indices
+    - only kNNGraph accepts precomputed neighbors
+    - streaming landmark graphs cannot be MNNGraph, precomputed or PyGSP
 
     Parameters
     ----------
@@ -87,12 +101,41 @@ def Graph(data,
         matrix is provided as `data`.
         Only one of `precomputed` and `n_pca` can be set.
 
+    kernel_output : {'auto', 'dense', 'sparse'}, optional (default: 'auto')
+        Format of the exact (`TraditionalGraph`) alpha decay kernel. 'auto'
+        builds a sparse kernel if thresholding is projected to leave less
+        than 10% of entries, and a dense kernel otherwise.
+
     beta: float, optional(default: 1)
         Multiply within - batch connections by(1 - beta)
 
     sample_idx: array-like
         Batch index for MNN kernel
 
+    knn_method : `str`, optional (default: 'auto')
+        Nearest neighbor search backend for kNN and MNN graphs.
+        'auto' : chooses an exact backend based on the number of samples,
+        dimensionality and distance metric
+        'ball_tree', 'kd_tree', 'brute' : exact search
+        'gemm' : exact search by blocked matrix multiplication, for
+        euclidean and cosine distance
+        'nndescent' : approximate search by nearest neighbor descent
+        Other backends can be added with
+        `graphtools.neighbors.register_backend`.
+
+    knn_params : `dict` or `None`, optional (default: `None`)
+        Additional keyword arguments for the nearest neighbor search backend.
+        For `knn_method='nndescent'`, `n_iters` and `max_candidates` trade
+        recall for speed.
+
+    precomputed_neighbors : `tuple` or `scipy.sparse.spmatrix` or `None`, optional (default: `None`)
+        Nearest neighbors of `data` for kNN graphs, computed elsewhere.
+        Either `(indices, distances)` arrays of shape [n_samples, k] as
+        returned by `kneighbors` (including each sample itself), or a sparse
+        [n_samples, n_samples] matrix of distances to each sample's nearest
+        neighbors. Requires `k >= knn`; samples whose alpha decay extends
+        beyond their precomputed neighbors are searched again.
+
     adaptive_k : `{'min', 'mean', 'sqrt', 'none'}` (default: 'sqrt')
         Weights MNN kernel adaptively using the number of cells in
         each sample according to the selected method.
@@ -103,9 +146,51 @@ def Graph(data,
     n_svd : `int`, optional (default: 100)
         number of SVD components to use for spectral clustering
 
+    landmark_method : {'spectral', 'random', 'kmeans++', 'farthest', 'degree'}, optional (default: 'spectral')
+        How landmarks are selected. 'spectral' runs KMeans on a spectral
+        embedding of the diffusion operator. The other methods select
+        samples as landmarks and assign every sample to its nearest
+        landmark, which is much faster. See `graphs.LandmarkGraph`.
+
+    streaming : `bool`, optional (default: `False`)
+        If `True`, landmark graphs are built without the full kernel, by
+        aggregating rows of the kernel into the landmark transitions block
+        by block. Requires `n_landmark`, a `landmark_method` in
+        ['random', 'kmeans++', 'farthest'] and `use_pygsp=False`.
+
+    landmark_output : {'dense', 'sparse', 'auto'}, optional (default: 'dense')
+        Format of the landmark operator. 'auto' gives a sparse operator if
+        its density is below 10%.
+
+    landmark_thresh : `float`, optional (default: 0)
+        Entries of the landmark operator below `landmark_thresh` are set to
+        zero, and its rows are renormalized to sum to one.
+
+    n_init : `int`, optional (default: 1)
+        Number of KMeans runs for spectral landmarks, run in parallel over
+        `n_jobs` threads. The run with the lowest inertia is kept.
+
+    empty_clusters : {'drop', 'reassign'}, optional (default: 'drop')
+        Policy for empty KMeans clusters of spectral landmarks. 'drop'
+        removes them, giving fewer than `n_landmark` landmarks. 'reassign'
+        moves the samples farthest from their centers into them.
+
     random_state : `int` or `None`, optional (default: `None`)
         Random state for random PCA
 
+    dtype : floating point `numpy.dtype` or `None`, optional (default: `None`)
+        Precision of the reduced data, kernel and operators. Use
+        `np.float32` to halve memory use. If `None`, the precision of the
+        input data is kept.
+
+    max_memory : `int` or `None`, optional (default: `None`)
+        Approximate memory budget in bytes. Every stage of graph building
+        (PCA, neighbor search, kernel construction, MNN kernels and landmark
+        SVD/KMeans) picks its chunk sizes to fit within the budget, or falls
+        back to an out-of-core algorithm. A `MemoryError` is raised before
+        allocating if a stage cannot fit. If `None`, memory use is not
+        limited.
+
     verbose : `bool`, optional (default: `True`)
         Verbosity.
         TODO: should this be an integer instead to allow multiple
@@ -149,9 +234,11 @@ def Graph(data,
         if sample_idx is not None:
             # only mnn does batch correction
             graphtype = "mnn"
-        elif precomputed is None and (decay is None or thresh > 0):
+        elif precomputed_neighbors is not None or \
+                (precomputed is None and (decay is None or thresh > 0)):
             # precomputed requires exact graph
-            # no decay or threshold decay require knngraph
+            # precomputed neighbors, no decay or threshold decay
+            # require knngraph
             graphtype = "knn"
         else:
             graphtype = "exact"
@@ -174,16 +261,32 @@ def Graph(data,
             raise ValueError("MNNGraph does not support precomputed "
                              "values. Use `graphtype='exact'` and "
                              "`sample_idx=None` or `precomputed=None`")
+        if precomputed_neighbors is not None:
+            raise ValueError("MNNGraph does not support precomputed "
+                             "neighbors. Use `graphtype='knn'` and "
+                             "`sample_idx=None` or "
+                             "`precomputed_neighbors=None`")
     elif graphtype == "exact":
         basegraph = graphs.TraditionalGraph
         if sample_idx is not None:
             raise ValueError("TraditionalGraph does not support batch "
                              "correction. Use `graphtype='mnn'` or "
                              "`sample_idx=None`")
+        if precomputed_neighbors is not None:
+            raise ValueError("TraditionalGraph does not support precomputed "
+                             "neighbors. Use `graphtype='knn'` or "
+                             "`precomputed_neighbors=None`")
     else:
         raise ValueError("graphtype '{}' not recognized. Choose from "
                          "['knn', 'mnn', 'exact', 'auto']")
 
+    if streaming and n_landmark is None:
+        raise ValueError("streaming=True requires landmarks. Provide "
+                         "`n_landmark` or use `streaming=False`")
+    if streaming and use_pygsp:
+        raise ValueError("PyGSP graphs require the full kernel. Use "
+                         "`use_pygsp=False` or `streaming=False`")
+
     # set add landmarks if necessary
     parent_classes = [basegraph]
     msg = "Building {} graph".format(graphtype)
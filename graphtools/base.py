@@ -4,12 +4,14 @@ import numpy as np
 import abc
 import pygsp
 from sklearn.utils.fixes import signature
-from sklearn.decomposition import PCA, TruncatedSVD
+from sklearn.decomposition import PCA, TruncatedSVD, IncrementalPCA
 from sklearn.preprocessing import normalize
 from scipy import sparse
 import warnings
 import numbers
 import tasklogger
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 try:
     import pandas as pd
@@ -25,7 +27,8 @@ except (ImportError, SyntaxError):
 
 from .utils import (elementwise_minimum,
                     elementwise_maximum,
-                    set_diagonal)
+                    set_diagonal,
+                    find_duplicates)
 
 
 class Base(object):
@@ -87,6 +90,17 @@ class Data(Base):
     random_state : `int` or `None`, optional (default: `None`)
         Random state for random PCA
 
+    dtype : floating point `numpy.dtype` or `None`, optional (default: `None`)
+        Precision of the reduced data, kernel and operators. Use
+        `np.float32` to halve memory use. If `None`, the precision of the
+        input data is kept.
+
+    max_memory : `int` or `None`, optional (default: `None`)
+        Approximate memory budget in bytes. If given, PCA switches to
+        incremental PCA when randomized PCA would not fit, and a
+        `MemoryError` is raised before any stage that cannot fit in the
+        budget. If `None`, memory use is not limited.
+
     Attributes
     ----------
     data : array-like, shape=[n_samples,n_features]
@@ -101,9 +115,13 @@ class Data(Base):
         sklearn PCA operator
     """
 
-    def __init__(self, data, n_pca=None, random_state=None, **kwargs):
+    def __init__(self, data, n_pca=None, random_state=None, dtype=None,
+                 max_memory=None, **kwargs):
 
         self._check_data(data)
+        if dtype is not None and np.dtype(dtype).kind != 'f':
+            raise ValueError("dtype {} not recognized. Expected a floating "
+                             "point type".format(dtype))
         if n_pca is not None and data.shape[1] <= n_pca:
             warnings.warn("Cannot perform PCA to {} dimensions on "
                           "data with {} dimensions".format(n_pca,
@@ -128,7 +146,9 @@ class Data(Base):
         self.data = data
         self.n_pca = n_pca
         self.random_state = random_state
-        self.data_nu = self._reduce_data()
+        self.dtype = dtype
+        self.max_memory = max_memory
+        self.data_nu = self._as_dtype(self._reduce_data())
         super().__init__(**kwargs)
 
     def _check_data(self, data):
@@ -161,7 +181,16 @@ class Data(Base):
                     self.data = self.data.tocsr()
                 self.data_pca = TruncatedSVD(self.n_pca,
                                              random_state=self.random_state)
+                # randomized SVD keeps a few [n_samples, n_pca] arrays
+                self._check_memory(
+                    32 * self.data.shape[0] * (self.n_pca + 10), "SVD")
             else:
+                # randomized PCA centers a copy of the data
+                pca_bytes = 8 * self.data.shape[0] * (
+                    self.data.shape[1] + 4 * (self.n_pca + 10))
+                if self.max_memory is not None and \
+                        pca_bytes > self.max_memory:
+                    return self._reduce_data_incremental()
                 self.data_pca = PCA(self.n_pca,
                                     svd_solver='randomized',
                                     random_state=self.random_state)
@@ -178,11 +207,93 @@ class Data(Base):
                 data_nu = data_nu.tocsr()
             return data_nu
 
+    def _reduce_data_incremental(self):
+        """Out-of-core PCA with batches sized from `max_memory`
+
+        Returns
+        -------
+        Reduced data matrix
+        """
+        n_samples, n_features = self.data.shape
+        # output, plus batch copies and the stacked SVD of each batch
+        self._check_memory(
+            8 * n_samples * self.n_pca +
+            8 * n_features * 8 * self.n_pca, "Incremental PCA")
+        batch_size = max(self.n_pca, (self.max_memory -
+                                      8 * n_samples * self.n_pca) //
+                         (8 * n_features * 8))
+        tasklogger.log_debug(
+            "Using incremental PCA with batch_size = {}".format(batch_size))
+        self.data_pca = IncrementalPCA(self.n_pca, batch_size=batch_size)
+        batches = [slice(start, min(start + batch_size, n_samples))
+                   for start in range(0, n_samples, batch_size)]
+        if len(batches) > 1 and \
+                batches[-1].stop - batches[-1].start < self.n_pca:
+            # each batch needs at least n_pca samples
+            batches[-2] = slice(batches[-2].start, n_samples)
+            batches = batches[:-1]
+        for batch in batches:
+            self.data_pca.partial_fit(self.data[batch])
+        data_nu = np.empty((n_samples, self.n_pca))
+        for batch in batches:
+            data_nu[batch] = self.data_pca.transform(self.data[batch])
+        tasklogger.log_complete("PCA")
+        return data_nu
+
+    def _check_memory(self, n_bytes, task):
+        """Raise an error if `task` needs more than `max_memory` bytes
+
+        Parameters
+        ----------
+        n_bytes : `int`
+            Approximate memory required
+
+        task : `str`
+            Description of the task, for the error message
+
+        Raises
+        ------
+        MemoryError : if `n_bytes` exceeds `max_memory`
+        """
+        if self.max_memory is not None and n_bytes > self.max_memory:
+            raise MemoryError(
+                "{} requires approximately {} bytes, which exceeds "
+                "max_memory={}. Increase max_memory or reduce the size "
+                "of the problem.".format(task, int(n_bytes),
+                                         self.max_memory))
+
+    def _as_dtype(self, X):
+        """Cast `X` to `self.dtype`, if given
+        """
+        if self.dtype is None or X.dtype == self.dtype or \
+                isinstance(X, np.memmap):
+            # memory-mapped data are cast block by block
+            return X
+        return X.astype(self.dtype)
+
+    @property
+    def duplicates(self):
+        """Groups of identical samples in `data_nu`
+
+        Computed once on first access.
+
+        Returns
+        -------
+        groups : list of `np.ndarray`
+            Sorted indices of each group of two or more identical samples
+        """
+        try:
+            return self._duplicates
+        except AttributeError:
+            self._duplicates = find_duplicates(self.data_nu)
+            return self._duplicates
+
     def get_params(self):
         """Get parameters from this object
         """
         return {'n_pca': self.n_pca,
-                'random_state': self.random_state}
+                'random_state': self.random_state,
+                'dtype': self.dtype}
 
     def set_params(self, **params):
         """Set parameters on this object
@@ -190,8 +301,10 @@ class Data(Base):
         Safe setter method - attributes should not be modified directly as some
         changes are not valid.
         Valid parameters:
-        - n_pca
         - random_state
+        Invalid parameters: (these would require recomputing the data)
+        - n_pca
+        - dtype
 
         Parameters
         ----------
@@ -203,6 +316,8 @@ class Data(Base):
         """
         if 'n_pca' in params and params['n_pca'] != self.n_pca:
             raise ValueError("Cannot update n_pca. Please create a new graph")
+        if 'dtype' in params and params['dtype'] != self.dtype:
+            raise ValueError("Cannot update dtype. Please create a new graph")
         if 'random_state' in params:
             self.random_state = params['random_state']
         super().set_params(**params)
@@ -230,7 +345,7 @@ class Data(Base):
         try:
             # try PCA first
 
-            return self.data_pca.transform(Y)
+            return self._as_dtype(self.data_pca.transform(Y))
         except AttributeError:  # no pca, try to return data
             try:
                 if Y.shape[1] != self.data.shape[1]:
@@ -396,7 +511,8 @@ class BaseGraph(with_metaclass(abc.ABCMeta, Base)):
         # symmetrize
         if self.kernel_symm == "+":
             tasklogger.log_debug("Using addition symmetrization.")
-            K = (K + K.T) / 2
+            # multiplying by 0.5 preserves the dtype of sparse matrices
+            K = (K + K.T) * 0.5
         elif self.kernel_symm == "*":
             tasklogger.log_debug("Using multiplication symmetrization.")
             K = K.multiply(K.T)
@@ -619,8 +735,21 @@ class DataGraph(with_metaclass(abc.ABCMeta, Data, BaseGraph)):
         used at all, which is useful for debugging.
         For n_jobs below -1, (n_cpus + 1 + n_jobs) are used. Thus for
         n_jobs = -2, all CPUs but one are used
+
+    max_memory : `int` or `None`, optional (default: `None`)
+        Approximate memory budget in bytes for building kernels. If given,
+        query samples are processed in blocks of rows that fit within the
+        budget, and the nearest neighbor search backend gets the same
+        budget, so that peak memory scales with the block size rather than
+        with the number of samples. A `MemoryError` is raised before
+        allocating if a stage cannot fit in the budget. If `None`, all
+        samples are processed at once.
     """
 
+    # memory per block of rows used for blocked computations if
+    # `max_memory` is not set
+    _block_size = 2**26
+
     def __init__(self, data,
                  verbose=True,
                  n_jobs=1, **kwargs):
@@ -637,6 +766,107 @@ class DataGraph(with_metaclass(abc.ABCMeta, Data, BaseGraph)):
         params.update(BaseGraph.get_params(self))
         return params
 
+    def _row_blocks(self, n_rows, row_bytes, default_bytes=None):
+        """Split `n_rows` query rows into blocks that fit in `max_memory`
+
+        Parameters
+        ----------
+        n_rows : `int`
+            Number of query rows
+
+        row_bytes : `int`
+            Approximate memory required per query row
+
+        default_bytes : `int` or `None`, optional (default: `None`)
+            Memory per block if `max_memory` is not set. If `None`, all
+            rows are returned as a single block.
+
+        Returns
+        -------
+        blocks : list of `slice`
+        """
+        if self.max_memory is not None:
+            self._check_memory(row_bytes,
+                               "Building the kernel of one sample")
+            block_bytes = self.max_memory
+        elif default_bytes is not None:
+            block_bytes = default_bytes
+        else:
+            return [slice(0, n_rows)]
+        if n_rows == 0:
+            return [slice(0, n_rows)]
+        block_size = max(1, block_bytes // max(row_bytes, 1))
+        return [slice(start, min(start + block_size, n_rows))
+                for start in range(0, n_rows, block_size)]
+
+    def _kernel_row_bytes(self):
+        """Approximate memory required to build one row of the kernel
+
+        Defaults to a dense row of distances and affinities
+        """
+        return 16 * self.data_nu.shape[0]
+
+    def _n_threads(self, n_tasks):
+        """Number of threads to use for `n_tasks` independent tasks
+
+        Follows the `n_jobs` convention: negative values count back from
+        the number of CPUs.
+        """
+        n_jobs = self.n_jobs
+        if n_jobs < 0:
+            n_jobs = cpu_count() + 1 + n_jobs
+        return max(1, min(n_jobs, n_tasks))
+
+    def _map_blocks(self, func, blocks, task_bytes=None):
+        """Apply `func` to each block, in a thread pool if `n_jobs` allows
+
+        `func` should spend most of its time in NumPy / SciPy routines
+        that release the GIL.
+
+        Parameters
+        ----------
+        func : callable
+            Function of a single block
+
+        blocks : list
+            Blocks, e.g. from `_row_blocks`
+
+        task_bytes : `int` or `None`, optional (default: `None`)
+            Approximate memory required by `func` for one block. If given,
+            no more blocks are processed at once than fit in `max_memory`
+
+        Returns
+        -------
+        results : list
+            `func(block)` for each block, in order
+        """
+        n_threads = self._n_threads(len(blocks))
+        if task_bytes is not None and self.max_memory is not None:
+            n_threads = self._n_threads(
+                min(n_threads, self.max_memory // max(task_bytes, 1)))
+        if n_threads == 1:
+            return [func(block) for block in blocks]
+        tasklogger.log_debug("Using {} threads".format(n_threads))
+        pool = ThreadPool(n_threads)
+        try:
+            return pool.map(func, blocks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _check_duplicates(self):
+        """Warn if `data_nu` contains identical samples
+        """
+        if len(self.duplicates) > 0:
+            duplicate_names = ", ".join(
+                ["{} and {}".format(group[0], i)
+                 for group in self.duplicates for i in group[1:]])
+            warnings.warn(
+                "Detected zero distance between samples {}. "
+                "Consider removing duplicates to avoid errors in "
+                "downstream processing.".format(duplicate_names),
+                RuntimeWarning)
+
     @abc.abstractmethod
     def build_kernel_to_data(self, Y):
         """Build a kernel from new input data `Y` to the `self.data`
@@ -729,7 +959,7 @@ class DataGraph(with_metaclass(abc.ABCMeta, Data, BaseGraph)):
         """
         Y = self._check_extension_shape(Y)
         kernel = self.build_kernel_to_data(Y)
-        transitions = normalize(kernel, norm='l1', axis=1)
+        transitions = normalize(kernel, norm='l1', axis=1, copy=False)
         return transitions
 
     def interpolate(self, transform, transitions=None, Y=None):
@@ -764,7 +994,79 @@ class DataGraph(with_metaclass(abc.ABCMeta, Data, BaseGraph)):
             if Y is None:
                 raise ValueError(
                     "Either `transitions` or `Y` must be provided.")
+            # extend in blocks of rows, so that the full transition matrix
+            # is never held in memory
+            Y_transform = list(self.interpolate_iter(transform, Y))
+            if sparse.issparse(Y_transform[0]):
+                return sparse.vstack(Y_transform)
             else:
-                transitions = self.extend_to_data(Y)
+                return np.vstack(Y_transform)
         Y_transform = transitions.dot(transform)
         return Y_transform
+
+    def interpolate_iter(self, transform, Y, chunk_size=None):
+        """Interpolate new data onto a transformation of the graph data
+
+        Generator version of `interpolate`, which yields one block of
+        interpolated rows per chunk of `Y`. Only the transitions of the
+        current and the next chunk are held in memory. If `n_jobs` allows,
+        the transitions of the next chunk are built in a background thread
+        while the current chunk is interpolated.
+
+        Parameters
+        ----------
+
+        transform : array-like, shape=[n_samples, n_transform_features]
+
+        Y : array-like, shape=[n_samples_y, n_dimensions], or iterable
+            New data, either as a single matrix which is split into chunks
+            of rows, or as an iterable of such matrices, e.g. read lazily
+            from disk. `n_features` must match either the ambient or PCA
+            dimensions
+
+        chunk_size : `int` or `None`, optional (default: `None`)
+            Number of rows per chunk if `Y` is a single matrix. If `None`,
+            chunks are sized to fit in `max_memory`
+
+        Yields
+        ------
+
+        Y_transform : array-like, [n_chunk, n_features or n_pca]
+            Interpolation of each chunk of `Y`
+        """
+        if hasattr(Y, 'shape'):
+            if sparse.issparse(Y):
+                Y = Y.tocsr()
+            else:
+                Y = np.asarray(Y)
+            if chunk_size is None:
+                blocks = self._row_blocks(Y.shape[0],
+                                          self._kernel_row_bytes(),
+                                          default_bytes=self._block_size)
+            else:
+                blocks = [slice(start, min(start + chunk_size, Y.shape[0]))
+                          for start in range(0, Y.shape[0], chunk_size)]
+            if len(blocks) > 1:
+                tasklogger.log_debug("Interpolating in {} blocks".format(
+                    len(blocks)))
+            chunks = (Y[rows] for rows in blocks)
+        else:
+            chunks = iter(Y)
+        if self._n_threads(2) == 1:
+            for chunk in chunks:
+                yield self.extend_to_data(chunk).dot(transform)
+            return
+        # build the next transitions while the current chunk is multiplied
+        pool = ThreadPool(1)
+        try:
+            pending = None
+            for chunk in chunks:
+                next_pending = pool.apply_async(self.extend_to_data, (chunk,))
+                if pending is not None:
+                    yield pending.get().dot(transform)
+                pending = next_pending
+            if pending is not None:
+                yield pending.get().dot(transform)
+        finally:
+            pool.close()
+            pool.join()
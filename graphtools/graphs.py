@@ -1,11 +1,13 @@
 from builtins import super
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
-from scipy.spatial.distance import pdist, cdist
-from scipy.spatial.distance import squareform
+from scipy.spatial.distance import cdist
 from sklearn.utils.extmath import randomized_svd
 from sklearn.preprocessing import normalize
 from sklearn.cluster import MiniBatchKMeans
+from sklearn.metrics import pairwise_distances
+from sklearn.metrics.pairwise import euclidean_distances
+from sklearn.utils import check_random_state
+from sklearn.utils.extmath import row_norms
 from scipy import sparse
 import numbers
 import warnings
@@ -14,8 +16,23 @@ import tasklogger
 from .utils import (set_diagonal,
                     elementwise_minimum,
                     elementwise_maximum,
-                    set_submatrix)
+                    set_submatrix,
+                    assemble_blocks,
+                    gather_ragged,
+                    geometric_buckets,
+                    threshold_csr,
+                    alpha_decay_csr,
+                    has_negative)
 from .base import DataGraph, PyGSPGraph
+from .neighbors import build_knn_tree, get_backend, neighbor_lists
+
+
+def _neighbor_rows(neighbors, rows):
+    """Slice a contiguous range of rows from flat neighbor lists"""
+    distances, indices, indptr = neighbors
+    start, stop = indptr[rows.start], indptr[rows.stop]
+    return (distances[start:stop], indices[start:stop],
+            indptr[rows.start:rows.stop + 1] - start)
 
 
 class kNNGraph(DataGraph):
@@ -45,23 +62,59 @@ class kNNGraph(DataGraph):
         All affinities below `thresh` will be set to zero in order to save
         on time and memory constraints.
 
+    knn_method : `str`, optional (default: 'auto')
+        Nearest neighbor search backend, by name. See
+        `graphtools.neighbors.register_backend` to add new backends.
+        'auto' : chooses an exact backend based on the number of samples,
+        dimensionality and distance metric
+        'ball_tree', 'kd_tree', 'brute' : exact search with
+        `sklearn.neighbors.NearestNeighbors`
+        'gemm' : exact search by blocked matrix multiplication with
+        `graphtools.neighbors.GEMMNeighbors`, for euclidean and cosine
+        distance. The tile size follows `max_memory`, or
+        `knn_params={'max_memory': bytes}`
+        'nndescent' : approximate search with
+        `graphtools.neighbors.NNDescent`. The kernel on `data` reuses its
+        neighbor graph, fitted with as many neighbors as the kernel needs
+
+    knn_params : `dict` or `None`, optional (default: `None`)
+        Additional keyword arguments for the nearest neighbor search backend.
+        For `knn_method='nndescent'`, `n_iters` and `max_candidates` trade
+        recall for speed.
+
+    precomputed_neighbors : `tuple` or `scipy.sparse.spmatrix` or `None`, optional (default: `None`)
+        Nearest neighbors of `data`, computed elsewhere. Either
+        `(indices, distances)` arrays of shape [n_samples, k] as returned by
+        `kneighbors` (including each sample itself), or a sparse matrix of
+        shape [n_samples, n_samples] holding the distances from each sample
+        to its nearest neighbors. Distances must be computed in the space of
+        `data_nu`. If given, the kernel is built from these neighbors and
+        `knn_tree` is only searched for samples whose alpha decay extends
+        beyond their precomputed neighbors. Requires `k >= knn`.
+
     Attributes
     ----------
 
-    knn_tree : `sklearn.neighbors.NearestNeighbors`
+    knn_tree : `sklearn.neighbors.NearestNeighbors` or `NNDescent`
         The fitted KNN tree. (cached)
-        TODO: can we be more clever than sklearn when it comes to choosing
-        between KD tree, ball tree and brute force?
     """
 
     def __init__(self, data, knn=5, decay=None,
                  distance='euclidean',
-                 thresh=1e-4, n_pca=None, **kwargs):
+                 thresh=1e-4, n_pca=None,
+                 knn_method='auto', knn_params=None,
+                 precomputed_neighbors=None, **kwargs):
         self.knn = knn
         self.decay = decay
         self.distance = distance
         self.thresh = thresh
+        self.knn_method = knn_method
+        self.knn_params = knn_params
+        self.precomputed_neighbors = precomputed_neighbors
 
+        if knn_method != 'auto':
+            # raises ValueError if the backend does not exist
+            get_backend(knn_method)
         if decay is not None and thresh <= 0:
             raise ValueError("Cannot instantiate a kNNGraph with `decay=None` "
                              "and `thresh=0`. Use a TraditionalGraph instead.")
@@ -84,7 +137,11 @@ class kNNGraph(DataGraph):
                        'decay': self.decay,
                        'distance': self.distance,
                        'thresh': self.thresh,
+                       'knn_method': self.knn_method,
+                       'knn_params': self.knn_params,
+                       'precomputed_neighbors': self.precomputed_neighbors,
                        'n_jobs': self.n_jobs,
+                       'max_memory': self.max_memory,
                        'random_state': self.random_state,
                        'verbose': self.verbose})
         return params
@@ -96,6 +153,7 @@ class kNNGraph(DataGraph):
         changes are not valid.
         Valid parameters:
         - n_jobs
+        - max_memory
         - random_state
         - verbose
         Invalid parameters: (these would require modifying the kernel matrix)
@@ -103,6 +161,9 @@ class kNNGraph(DataGraph):
         - decay
         - distance
         - thresh
+        - knn_method
+        - knn_params
+        - precomputed_neighbors
 
         Parameters
         ----------
@@ -122,10 +183,31 @@ class kNNGraph(DataGraph):
         if 'thresh' in params and params['thresh'] != self.thresh \
                 and self.decay != 0:
             raise ValueError("Cannot update thresh. Please create a new graph")
+        if 'knn_method' in params and params['knn_method'] != self.knn_method:
+            raise ValueError("Cannot update knn_method. "
+                             "Please create a new graph")
+        if 'knn_params' in params and params['knn_params'] != self.knn_params:
+            raise ValueError("Cannot update knn_params. "
+                             "Please create a new graph")
+        if 'precomputed_neighbors' in params and \
+                params['precomputed_neighbors'] is not \
+                self.precomputed_neighbors:
+            raise ValueError("Cannot update precomputed_neighbors. "
+                             "Please create a new graph")
         if 'n_jobs' in params:
             self.n_jobs = params['n_jobs']
             if hasattr(self, "_knn_tree"):
                 self.knn_tree.set_params(n_jobs=self.n_jobs)
+            if hasattr(self, "_full_knn_tree"):
+                self._full_knn_tree.set_params(n_jobs=self.n_jobs)
+        if 'max_memory' in params:
+            self.max_memory = params['max_memory']
+            for knn_tree in ["_knn_tree", "_full_knn_tree"]:
+                knn_tree = getattr(self, knn_tree, None)
+                if knn_tree is not None and \
+                        'max_memory' in knn_tree.get_params() and \
+                        'max_memory' not in (self.knn_params or {}):
+                    knn_tree.set_params(max_memory=self.max_memory)
         if 'random_state' in params:
             self.random_state = params['random_state']
         if 'verbose' in params:
@@ -138,37 +220,80 @@ class kNNGraph(DataGraph):
     def knn_tree(self):
         """KNN tree object (cached)
 
-        Builds or returns the fitted KNN tree.
-        TODO: can we be more clever than sklearn when it comes to choosing
-        between KD tree, ball tree and brute force?
+        Builds or returns the fitted KNN tree, using the backend registered
+        under `knn_method` in `graphtools.neighbors`.
 
         Returns
         -------
-        knn_tree : `sklearn.neighbors.NearestNeighbors`
+        knn_tree : `sklearn.neighbors.NearestNeighbors` or any estimator
+            implementing the same interface
         """
         try:
             return self._knn_tree
         except AttributeError:
-            try:
-                self._knn_tree = NearestNeighbors(
-                    n_neighbors=self.knn,
-                    algorithm='ball_tree',
-                    metric=self.distance,
-                    n_jobs=self.n_jobs).fit(self.data_nu)
-            except ValueError:
-                # invalid metric
-                warnings.warn(
-                    "Metric {} not valid for `sklearn.neighbors.BallTree`. "
-                    "Graph instantiation may be slower than normal.".format(
-                        self.distance),
-                    UserWarning)
-                self._knn_tree = NearestNeighbors(
-                    n_neighbors=self.knn,
-                    algorithm='auto',
-                    metric=self.distance,
-                    n_jobs=self.n_jobs).fit(self.data_nu)
+            self._knn_tree = self._build_knn_tree(
+                self._search_knn(self.knn))
             return self._knn_tree
 
+    def _build_knn_tree(self, n_neighbors, method=None):
+        """Private method to fit a nearest neighbor backend on `data_nu`
+
+        Falls back to automatic backend selection if the chosen backend
+        does not support `distance`. `knn_params` only apply if `method`
+        is `None`, i.e. when fitting `knn_method`.
+        """
+        knn_params = {}
+        if method is None:
+            method = self.knn_method
+            if self.knn_params is not None:
+                knn_params = self.knn_params
+        try:
+            return build_knn_tree(
+                self.data_nu, n_neighbors=n_neighbors,
+                metric=self.distance, method=method,
+                n_jobs=self.n_jobs, random_state=self.random_state,
+                max_memory=self.max_memory, **knn_params)
+        except ValueError:
+            if method == 'auto':
+                raise
+            # invalid metric
+            warnings.warn(
+                "Metric {} not valid for knn_method '{}'. "
+                "Graph instantiation may be slower than normal.".format(
+                    self.distance, method),
+                UserWarning)
+            return build_knn_tree(
+                self.data_nu, n_neighbors=n_neighbors,
+                metric=self.distance, method='auto',
+                n_jobs=self.n_jobs, random_state=self.random_state,
+                max_memory=self.max_memory)
+
+    def _get_full_knn_tree(self):
+        """Automatically selected tree for searches over most of the data
+
+        Cached, so that blocked kernel construction builds it only once
+        """
+        try:
+            return self._full_knn_tree
+        except AttributeError:
+            self._full_knn_tree = self._build_knn_tree(
+                self.data_nu.shape[0], method='auto')
+            return self._full_knn_tree
+
+    def _search_knn(self, knn):
+        """Number of neighbors first searched for each row of the kernel
+        """
+        if self.decay is None or self.thresh == 1:
+            return knn
+        else:
+            return min(knn * 20, self.data_nu.shape[0])
+
+    def _kernel_row_bytes(self):
+        """Approximate memory required to build one row of the kernel
+        """
+        # neighbor distances and indices, plus search overhead
+        return 32 * self._search_knn(self.knn)
+
     def build_kernel(self):
         """Build the KNN kernel.
 
@@ -181,7 +306,18 @@ class kNNGraph(DataGraph):
             symmetric matrix with ones down the diagonal
             with no non-negative entries.
         """
-        K = self.build_kernel_to_data(self.data_nu)
+        self._check_duplicates()
+        neighbors = self.precomputed_neighbors
+        if neighbors is None and hasattr(self.knn_tree, "graph_"):
+            # the backend already holds the neighbors of the fitted data
+            neighbors = (self.knn_tree.graph_,
+                         self.knn_tree.graph_distances_)
+        if neighbors is None:
+            K = self.build_kernel_to_data(self.data_nu)
+        else:
+            neighbors = neighbor_lists(neighbors, self.data_nu.shape[0])
+            K = self._build_kernel_to_data(self.data_nu, self.knn,
+                                           neighbors=neighbors)
         return K
 
     def build_kernel_to_data(self, Y, knn=None):
@@ -218,88 +354,176 @@ class kNNGraph(DataGraph):
                               k=knn, n=self.data.shape[0]))
 
         Y = self._check_extension_shape(Y)
+        return self._build_kernel_to_data(Y, knn)
+
+    def _build_kernel_to_data(self, Y, knn, neighbors=None):
+        """Build the kernel from (checked) input data `Y` in row blocks
+
+        Parameters
+        ----------
+        Y: array-like, [n_samples_y, n_pca]
+            new data in the same space as `self.data_nu`
+
+        knn : `int`
+            Number of nearest neighbors
+
+        neighbors : `tuple` or `None`, optional (default: `None`)
+            Precomputed neighbors of `Y` as flat neighbor lists
+            `(distances, indices, indptr)`, from
+            `graphtools.neighbors.neighbor_lists`
+
+        Returns
+        -------
+        K_yx: `scipy.sparse.csr_matrix`, [n_samples_y, n_samples]
+        """
+        if sparse.issparse(Y):
+            Y = Y.tocsr()
+        if neighbors is not None:
+            min_knn = np.min(np.diff(neighbors[2]))
+            if min_knn < knn:
+                raise ValueError(
+                    "Precomputed neighbors include only {} neighbors for "
+                    "some samples, fewer than knn={}. Provide more "
+                    "neighbors or decrease knn.".format(min_knn, knn))
+        if neighbors is not None and self.decay is not None and \
+                self.thresh != 1:
+            search_knn = np.max(np.diff(neighbors[2]))
+        else:
+            search_knn = self._search_knn(knn)
+        # neighbor distances and indices, plus search overhead
+        blocks = self._row_blocks(Y.shape[0], 32 * search_knn)
+        if len(blocks) == 1:
+            return self._build_kernel_block(Y, knn, neighbors=neighbors)
+        tasklogger.log_debug("Building kernel in {} blocks".format(
+            len(blocks)))
+        return sparse.vstack([
+            self._build_kernel_block(
+                Y[rows], knn,
+                neighbors=None if neighbors is None else
+                _neighbor_rows(neighbors, rows))
+            for rows in blocks], format='csr')
+
+    def _build_kernel_block(self, Y, knn, neighbors=None):
+        """Build the kernel from a block of (checked) input data `Y`
+
+        Parameters
+        ----------
+        Y: array-like, [n_samples_y, n_pca]
+            new data in the same space as `self.data_nu`
+
+        knn : `int`
+            Number of nearest neighbors
+
+        neighbors : `tuple` or `None`, optional (default: `None`)
+            Precomputed neighbors of `Y` as flat neighbor lists
+            `(distances, indices, indptr)`. If `None`, neighbors are
+            searched in `self.knn_tree`
+
+        Returns
+        -------
+        K_yx: `scipy.sparse.csr_matrix`, [n_samples_y, n_samples]
+        """
         tasklogger.log_start("KNN search")
         if self.decay is None or self.thresh == 1:
             # binary connectivity matrix
-            K = self.knn_tree.kneighbors_graph(
-                Y, n_neighbors=knn,
-                mode='connectivity')
+            if neighbors is None:
+                indices = self.knn_tree.kneighbors(
+                    Y, n_neighbors=knn, return_distance=False)
+            else:
+                # nearest `knn` of each sorted neighbor list
+                indices = neighbors[1][
+                    neighbors[2][:-1, None] + np.arange(knn)]
+            K = sparse.csr_matrix(
+                (np.ones(indices.size, dtype=self.dtype), indices.ravel(),
+                 np.arange(0, indices.size + 1, knn)),
+                shape=(Y.shape[0], self.data_nu.shape[0]))
             tasklogger.log_complete("KNN search")
         else:
             # sparse fast alpha decay
-            knn_tree = self.knn_tree
-            search_knn = min(knn * 20, self.data_nu.shape[0])
-            distances, indices = knn_tree.kneighbors(
-                Y, n_neighbors=search_knn)
-            if np.any(distances[:, 1] == 0):
-                has_duplicates = distances[:, 1] == 0
-                idx = np.argwhere((distances == 0) & has_duplicates[:, None])
-                duplicate_ids = np.array(
-                    [[indices[i[0], i[1]], i[0]]
-                     for i in idx if indices[i[0], i[1]] < i[0]])
-                duplicate_ids = duplicate_ids[np.argsort(duplicate_ids[:, 0])]
-                duplicate_names = ", ".join(["{} and {}".format(i[0], i[1])
-                                             for i in duplicate_ids])
-                warnings.warn(
-                    "Detected zero distance between samples {}. "
-                    "Consider removing duplicates to avoid errors in "
-                    "downstream processing.".format(duplicate_names),
-                    RuntimeWarning)
+            if neighbors is None:
+                search_knn = self._search_knn(knn)
+                distances, indices = self.knn_tree.kneighbors(
+                    Y, n_neighbors=search_knn)
+                indptr = np.arange(0, distances.size + 1, search_knn)
+                distances, indices = distances.ravel(), indices.ravel()
+            else:
+                distances, indices, indptr = neighbors
+                search_knn = np.min(np.diff(indptr))
+            distances = self._as_dtype(distances)
             tasklogger.log_complete("KNN search")
             tasklogger.log_start("affinities")
-            bandwidth = distances[:, knn - 1]
+            bandwidth = distances[indptr[:-1] + knn - 1]
             radius = bandwidth * np.power(-1 * np.log(self.thresh),
                                           1 / self.decay)
+            # rows holding every sample cannot gain more neighbors
             update_idx = np.argwhere(
-                np.max(distances, axis=1) < radius).reshape(-1)
+                (np.maximum.reduceat(distances, indptr[:-1]) < radius) &
+                (np.diff(indptr) < self.data_nu.shape[0])).reshape(-1)
             tasklogger.log_debug("search_knn = {}; {} remaining".format(
                 search_knn, len(update_idx)))
-            if len(update_idx) > 0:
-                distances = [d for d in distances]
-                indices = [i for i in indices]
+            # neighbor lists are kept as blocks of flat buffers; each row
+            # uses the results of the last search that included it
+            blocks = [(distances, indices, indptr)]
+            row_block = np.zeros(Y.shape[0], dtype=np.intp)
+            row_pos = np.arange(Y.shape[0])
             while len(update_idx) > Y.shape[0] // 10 and \
                     search_knn < self.data_nu.shape[0] / 2:
                 # increase the knn search
                 search_knn = min(search_knn * 20, self.data_nu.shape[0])
-                dist_new, ind_new = knn_tree.kneighbors(
-                    Y[update_idx], n_neighbors=search_knn)
-                for i, idx in enumerate(update_idx):
-                    distances[idx] = dist_new[i]
-                    indices[idx] = ind_new[i]
-                update_idx = [i for i, d in enumerate(distances)
-                              if np.max(d) < radius[i]]
+                remaining = []
+                for rows in self._row_blocks(len(update_idx),
+                                             32 * search_knn):
+                    rows = update_idx[rows]
+                    dist_new, ind_new = self.knn_tree.kneighbors(
+                        Y[rows], n_neighbors=search_knn)
+                    # only rows searched this round can have changed
+                    remaining.append(
+                        rows[np.max(dist_new, axis=1) < radius[rows]])
+                    # neighbors beyond the radius have no affinity
+                    keep = dist_new <= radius[rows, None]
+                    indptr = np.zeros(len(rows) + 1, dtype=np.intp)
+                    np.cumsum(np.sum(keep, axis=1), out=indptr[1:])
+                    row_block[rows] = len(blocks)
+                    row_pos[rows] = np.arange(len(rows))
+                    blocks.append((dist_new[keep], ind_new[keep], indptr))
+                update_idx = np.concatenate(remaining)
                 tasklogger.log_debug("search_knn = {}; {} remaining".format(
                     search_knn,
                     len(update_idx)))
-            if search_knn > self.data_nu.shape[0] / 2:
-                knn_tree = NearestNeighbors(
-                    knn, algorithm='brute',
-                    n_jobs=self.n_jobs).fit(self.data_nu)
             if len(update_idx) > 0:
+                if search_knn > self.data_nu.shape[0] / 2:
+                    knn_tree = self._get_full_knn_tree()
+                else:
+                    knn_tree = self.knn_tree
                 tasklogger.log_debug(
                     "radius search on {}".format(len(update_idx)))
-                # give up - radius search
-                dist_new, ind_new = knn_tree.radius_neighbors(
-                    Y[update_idx, :],
-                    radius=np.max(radius[update_idx]))
-                for i, idx in enumerate(update_idx):
-                    distances[idx] = dist_new[i]
-                    indices[idx] = ind_new[i]
-            data = np.concatenate([distances[i] / bandwidth[i]
-                                   for i in range(len(distances))])
-            indices = np.concatenate(indices)
-            indptr = np.concatenate(
-                [[0], np.cumsum([len(d) for d in distances])])
-            K = sparse.csr_matrix((data, indices, indptr),
-                                  shape=(Y.shape[0], self.data_nu.shape[0]))
-            K.data = np.exp(-1 * np.power(K.data, self.decay))
-            # handle nan
-            K.data = np.where(np.isnan(K.data), 1, K.data)
-            # TODO: should we zero values that are below thresh?
-            K.data[K.data < self.thresh] = 0
-            K = K.tocoo()
-            K.eliminate_zeros()
-            K = K.tocsr()
+                # give up - radius search. Rows of similar radius are
+                # searched together and trimmed to their own radius, so no
+                # row holds many more neighbors than it needs
+                for bucket in geometric_buckets(radius[update_idx]):
+                    rows = update_idx[bucket]
+                    dist_new, ind_new = knn_tree.radius_neighbors(
+                        Y[rows, :],
+                        radius=np.max(radius[rows]))
+                    lengths = np.array([len(d) for d in dist_new],
+                                       dtype=np.intp)
+                    dist_new = np.concatenate(dist_new)
+                    keep = dist_new <= np.repeat(radius[rows], lengths)
+                    lengths = np.bincount(
+                        np.repeat(np.arange(len(rows)), lengths)[keep],
+                        minlength=len(rows))
+                    indptr = np.zeros(len(rows) + 1, dtype=np.intp)
+                    np.cumsum(lengths, out=indptr[1:])
+                    row_block[rows] = len(blocks)
+                    row_pos[rows] = np.arange(len(rows))
+                    blocks.append((dist_new[keep],
+                                   np.concatenate(ind_new)[keep].astype(
+                                       np.intp),
+                                   indptr))
+            data, indices, indptr = gather_ragged(blocks, row_block, row_pos)
+            K = alpha_decay_csr(data, indices, indptr, bandwidth,
+                                self.decay, self.thresh,
+                                shape=(Y.shape[0], self.data_nu.shape[0]))
             tasklogger.log_complete("affinities")
         return K
 
@@ -326,20 +550,76 @@ class LandmarkGraph(DataGraph):
     n_svd : `int`, optional (default: 100)
         number of SVD components to use for spectral clustering
 
+    landmark_method : {'spectral', 'random', 'kmeans++', 'farthest', 'degree'}, optional (default: 'spectral')
+        How landmarks are selected. 'spectral' runs KMeans on a spectral
+        embedding of the diffusion operator. The other methods select
+        `n_landmark` samples as landmarks and assign every sample to its
+        nearest landmark in `data_nu`, which is much faster:
+        'random' selects samples uniformly at random, 'kmeans++' uses
+        kmeans++ seeding, 'farthest' uses farthest-point sampling and
+        'degree' samples proportionally to the degree of the kernel.
+
+    streaming : `bool`, optional (default: `False`)
+        If `True`, the full [n_samples, n_samples] kernel is never built.
+        Rows of the kernel are computed from `data_nu` block by block and
+        aggregated directly into the landmark transitions, so memory scales
+        with the number of landmarks rather than with the kernel. Requires
+        a `landmark_method` that does not use the kernel ('random',
+        'kmeans++' or 'farthest'), `kernel_symm` in ['+', `None`], and a
+        graph that can be extended to new data.
+
+    n_init : `int`, optional (default: 1)
+        Number of KMeans runs with different seeds for
+        `landmark_method='spectral'`. Runs are parallelized over `n_jobs`
+        threads and the run with the lowest inertia is kept.
+
+    empty_clusters : {'drop', 'reassign'}, optional (default: 'drop')
+        Policy for KMeans clusters left without samples, including
+        clusters whose centers coincide with another cluster's, for
+        `landmark_method='spectral'`. 'drop' removes them, so the landmark
+        operator can have fewer than `n_landmark` landmarks. 'reassign'
+        moves the sample farthest from its center into each empty
+        cluster, which gives exactly `n_landmark` landmarks.
+
+    landmark_output : {'dense', 'sparse', 'auto'}, optional (default: 'dense')
+        Format of the landmark operator. 'sparse' gives a CSR matrix, so
+        that memory scales with its number of nonzeros rather than with
+        `n_landmark` squared. 'auto' gives a sparse operator if its density
+        is below 10%, and a dense operator otherwise.
+
+    landmark_thresh : `float`, optional (default: 0)
+        Entries of the landmark operator below `landmark_thresh` are set to
+        zero, and its rows are renormalized to sum to one. The largest
+        entry of each row is always kept, so no row is left empty.
+
     Attributes
     ----------
     landmark_op : array-like, shape=[n_landmark, n_landmark]
         Landmark operator.
         Can be treated as a diffusion operator between landmarks.
 
-    transitions : array-like, shape=[n_samples, n_landmark]
+    transitions : `scipy.sparse.csr_matrix`, shape=[n_samples, n_landmark]
         Transition probabilities between samples and landmarks.
 
+    cluster_indicator : `scipy.sparse.csr_matrix`, shape=[n_samples, n_landmark]
+        Sparse indicator of the landmark assigned to each sample.
+
     _clusters : array-like, shape=[n_samples]
         Private attribute. Cluster assignments for each sample.
     """
 
-    def __init__(self, data, n_landmark=2000, n_svd=100, **kwargs):
+    _landmark_methods = ['spectral', 'random', 'kmeans++', 'farthest',
+                         'degree']
+
+    # landmark methods that need the full kernel
+    _kernel_landmark_methods = ['spectral', 'degree']
+    # landmark_output='auto' gives sparse operators below this density
+    _sparse_density = 0.1
+
+    def __init__(self, data, n_landmark=2000, n_svd=100,
+                 landmark_method='spectral', streaming=False,
+                 landmark_output='dense', landmark_thresh=0,
+                 n_init=1, empty_clusters='drop', **kwargs):
         """Initialize a landmark graph.
 
         Raises
@@ -356,15 +636,61 @@ class LandmarkGraph(DataGraph):
                           "using kNNGraph or lower n_svd".format(
                               n_svd, data.shape[0]),
                           RuntimeWarning)
+        if landmark_output not in ['dense', 'sparse', 'auto']:
+            raise ValueError("landmark_output '{}' not recognized. Choose "
+                             "from ['dense', 'sparse', 'auto']".format(
+                                 landmark_output))
+        if empty_clusters not in ['drop', 'reassign']:
+            raise ValueError("empty_clusters '{}' not recognized. Choose "
+                             "from ['drop', 'reassign']".format(
+                                 empty_clusters))
+        self.streaming = streaming
+        self._check_landmark_method(landmark_method)
+        if streaming and (isinstance(self, MNNGraph) or
+                          getattr(self, 'precomputed', None) is not None):
+            raise ValueError("streaming=True requires a kNN or exact graph "
+                             "built from data. Use streaming=False")
         self.n_landmark = n_landmark
         self.n_svd = n_svd
+        self.landmark_method = landmark_method
+        self.landmark_output = landmark_output
+        self.landmark_thresh = landmark_thresh
+        self.n_init = n_init
+        self.empty_clusters = empty_clusters
+        if streaming:
+            # the full kernel is never built
+            kwargs['initialize'] = False
         super().__init__(data, **kwargs)
+        if streaming and self.kernel_symm not in ['+', None]:
+            raise ValueError(
+                "streaming=True requires kernel_symm in ['+', None]. "
+                "Got kernel_symm='{}'".format(self.kernel_symm))
+
+    def _check_landmark_method(self, landmark_method):
+        if landmark_method not in self._landmark_methods:
+            raise ValueError(
+                "landmark_method '{}' not recognized. Choose from "
+                "{}".format(landmark_method, self._landmark_methods))
+        if self.streaming and \
+                landmark_method in self._kernel_landmark_methods:
+            raise ValueError(
+                "landmark_method '{}' requires the full kernel and cannot "
+                "be used with streaming=True. Choose from {}".format(
+                    landmark_method,
+                    [method for method in self._landmark_methods
+                     if method not in self._kernel_landmark_methods]))
 
     def get_params(self):
         """Get parameters from this object
         """
         params = super().get_params()
         params.update({'n_landmark': self.n_landmark,
+                       'landmark_method': self.landmark_method,
+                       'streaming': self.streaming,
+                       'landmark_output': self.landmark_output,
+                       'landmark_thresh': self.landmark_thresh,
+                       'n_init': self.n_init,
+                       'empty_clusters': self.empty_clusters,
                        'n_pca': self.n_pca})
         return params
 
@@ -376,6 +702,13 @@ class LandmarkGraph(DataGraph):
         Valid parameters:
         - n_landmark
         - n_svd
+        - landmark_method
+        - landmark_output
+        - landmark_thresh
+        - n_init
+        - empty_clusters
+        Invalid parameters:
+        - streaming
 
         Parameters
         ----------
@@ -385,25 +718,65 @@ class LandmarkGraph(DataGraph):
         -------
         self
         """
+        if 'streaming' in params and params['streaming'] != self.streaming:
+            raise ValueError("Cannot update streaming. "
+                             "Please create a new graph")
         # update parameters
         reset_landmarks = False
+        reset_embedding = False
         if 'n_landmark' in params and params['n_landmark'] != self.n_landmark:
             self.n_landmark = params['n_landmark']
             reset_landmarks = True
         if 'n_svd' in params and params['n_svd'] != self.n_svd:
             self.n_svd = params['n_svd']
             reset_landmarks = True
+            reset_embedding = True
+        if 'landmark_method' in params and \
+                params['landmark_method'] != self.landmark_method:
+            self._check_landmark_method(params['landmark_method'])
+            self.landmark_method = params['landmark_method']
+            reset_landmarks = True
+        if 'landmark_output' in params and \
+                params['landmark_output'] != self.landmark_output:
+            if params['landmark_output'] not in ['dense', 'sparse', 'auto']:
+                raise ValueError(
+                    "landmark_output '{}' not recognized. Choose from "
+                    "['dense', 'sparse', 'auto']".format(
+                        params['landmark_output']))
+            self.landmark_output = params['landmark_output']
+            reset_landmarks = True
+        if 'landmark_thresh' in params and \
+                params['landmark_thresh'] != self.landmark_thresh:
+            self.landmark_thresh = params['landmark_thresh']
+            reset_landmarks = True
+        if 'n_init' in params and params['n_init'] != self.n_init:
+            self.n_init = params['n_init']
+            reset_landmarks = True
+        if 'empty_clusters' in params and \
+                params['empty_clusters'] != self.empty_clusters:
+            if params['empty_clusters'] not in ['drop', 'reassign']:
+                raise ValueError(
+                    "empty_clusters '{}' not recognized. Choose from "
+                    "['drop', 'reassign']".format(params['empty_clusters']))
+            self.empty_clusters = params['empty_clusters']
+            reset_landmarks = True
         # update superclass parameters
         super().set_params(**params)
         # reset things that changed
         if reset_landmarks:
-            self._reset_landmarks()
+            self._reset_landmarks(reset_embedding=reset_embedding)
         return self
 
-    def _reset_landmarks(self):
+    def _reset_landmarks(self, reset_embedding=True):
         """Reset landmark data
 
         Landmarks can be recomputed without recomputing the kernel
+
+        Parameters
+        ----------
+        reset_embedding : `bool`, optional (default: `True`)
+            If `False`, the spectral embedding is kept, so that only the
+            clustering is recomputed
         """
         try:
             del self._landmark_op
@@ -412,6 +785,15 @@ class LandmarkGraph(DataGraph):
         except AttributeError:
             # landmarks aren't currently defined
             pass
+        try:
+            del self._cluster_indicator
+        except AttributeError:
+            pass
+        if reset_embedding:
+            try:
+                del self._spectral_embedding
+            except AttributeError:
+                pass
 
     @property
     def landmark_op(self):
@@ -440,7 +822,7 @@ class LandmarkGraph(DataGraph):
 
         Returns
         -------
-        transitions : array-like, shape=[n_samples, n_landmark]
+        transitions : `scipy.sparse.csr_matrix`, shape=[n_samples, n_landmark]
             Transition probabilities between samples and landmarks.
         """
         try:
@@ -449,15 +831,82 @@ class LandmarkGraph(DataGraph):
             self.build_landmark_op()
             return self._transitions
 
-    def _landmarks_to_data(self):
-        landmarks = np.unique(self._clusters)
-        if sparse.issparse(self.kernel):
-            pmn = sparse.vstack(
-                [sparse.csr_matrix(self.kernel[self._clusters == i, :].sum(
-                    axis=0)) for i in landmarks])
+    @property
+    def cluster_indicator(self):
+        """Sparse indicator matrix of cluster assignments
+
+        Compute the landmark operator if necessary. Entry `(i, j)` is one if
+        sample `i` is assigned to landmark `j`. Empty clusters are dropped,
+        so columns match the rows of `landmark_op`.
+
+        Returns
+        -------
+        cluster_indicator : `scipy.sparse.csr_matrix`,
+            shape=[n_samples, n_landmark]
+        """
+        try:
+            return self._cluster_indicator
+        except AttributeError:
+            if not hasattr(self, "_clusters"):
+                self.build_landmark_op()
+            _, landmarks = np.unique(self._clusters, return_inverse=True)
+            n_samples = len(landmarks)
+            self._cluster_indicator = sparse.csr_matrix(
+                (np.ones(n_samples, dtype=self._indicator_dtype()), landmarks,
+                 np.arange(n_samples + 1)),
+                shape=(n_samples, landmarks.max() + 1))
+            return self._cluster_indicator
+
+    def _indicator_dtype(self):
+        if self.dtype is not None:
+            return self.dtype
+        elif self.streaming:
+            return np.float64
         else:
-            pmn = np.array([np.sum(self.kernel[self._clusters == i, :], axis=0)
-                            for i in landmarks])
+            return self.kernel.dtype
+
+    def _landmarks_to_data(self):
+        # sum the kernel rows of the samples in each cluster
+        return self.cluster_indicator.T.dot(self.kernel)
+
+    def _streamed_landmarks_to_data(self):
+        """Sum the kernel rows of the samples in each cluster, in blocks
+
+        Rows of the unsymmetrized kernel are built from `data_nu` one block
+        at a time. Samples are processed in order of their cluster, so
+        each block only adds to the rows of a few landmarks.
+
+        Returns
+        -------
+        pmn : `scipy.sparse.csr_matrix`, shape=[n_landmark, n_samples]
+        """
+        self._check_duplicates()
+        n_samples = self.data_nu.shape[0]
+        indicator = self.cluster_indicator
+        order = np.argsort(self._clusters, kind='mergesort')
+        blocks = self._row_blocks(n_samples, self._kernel_row_bytes(),
+                                  default_bytes=self._block_size)
+        tasklogger.log_debug("Streaming kernel in {} blocks".format(
+            len(blocks)))
+        pmn, pnm = [], []
+        for rows in blocks:
+            rows = order[rows]
+            K_rows = self.build_kernel_to_data(self.data_nu[rows])
+            if not sparse.issparse(K_rows):
+                K_rows = sparse.csr_matrix(K_rows)
+            pmn.append(indicator[rows].T.dot(K_rows).tocoo())
+            if self.kernel_symm == '+':
+                # contribution of K.T to the symmetrized kernel
+                pnm.append(K_rows.dot(indicator))
+        # blocks overlap only in the landmarks on their boundaries
+        pmn = sparse.coo_matrix(
+            (np.concatenate([block.data for block in pmn]),
+             (np.concatenate([block.row for block in pmn]),
+              np.concatenate([block.col for block in pmn]))),
+            shape=(indicator.shape[1], n_samples)).tocsr()
+        if self.kernel_symm == '+':
+            pnm = sparse.vstack(pnm, format='csr')[np.argsort(order)]
+            pmn = (pmn + pnm.T.tocsr()) * 0.5
         return pmn
 
     def _data_transitions(self):
@@ -466,45 +915,253 @@ class LandmarkGraph(DataGraph):
     def build_landmark_op(self):
         """Build the landmark operator
 
-        Calculates spectral clusters on the kernel, and calculates transition
-        probabilities between cluster centers by using transition probabilities
-        between samples assigned to each cluster.
+        Assigns samples to landmarks according to `landmark_method`, and
+        calculates transition probabilities between landmarks by using
+        transition probabilities between samples assigned to each landmark.
         """
         tasklogger.log_start("landmark operator")
-        is_sparse = sparse.issparse(self.kernel)
-        # spectral clustering
-        tasklogger.log_start("SVD")
-        _, _, VT = randomized_svd(self.diff_aff,
-                                  n_components=self.n_svd,
-                                  random_state=self.random_state)
-        tasklogger.log_complete("SVD")
-        tasklogger.log_start("KMeans")
-        kmeans = MiniBatchKMeans(
-            self.n_landmark,
-            init_size=3 * self.n_landmark,
-            batch_size=10000,
-            random_state=self.random_state)
-        self._clusters = kmeans.fit_predict(
-            self.diff_op.dot(VT.T))
-        # some clusters are not assigned
-        tasklogger.log_complete("KMeans")
+        if self.landmark_method == 'spectral':
+            self._clusters = self._spectral_clusters()
+        else:
+            self._clusters = self._sampled_clusters()
+        try:
+            del self._cluster_indicator
+        except AttributeError:
+            pass
 
         # transition matrices
-        pmn = self._landmarks_to_data()
+        if self.streaming:
+            pmn = self._streamed_landmarks_to_data()
+        else:
+            pmn = self._landmarks_to_data()
+        if sparse.issparse(pmn) or self.landmark_output == 'sparse':
+            pmn = sparse.csr_matrix(pmn)
 
         # row normalize
         pnm = pmn.transpose()
         pmn = normalize(pmn, norm='l1', axis=1)
         pnm = normalize(pnm, norm='l1', axis=1)
+        if sparse.issparse(pnm):
+            pnm = pnm.tocsr()
         landmark_op = pmn.dot(pnm)  # sparsity agnostic matrix multiplication
-        if is_sparse:
-            # no need to have a sparse landmark operator
-            landmark_op = landmark_op.toarray()
+        landmark_op = self._format_landmark_op(landmark_op)
         # store output
-        self._landmark_op = landmark_op
-        self._transitions = pnm
+        self._landmark_op = self._as_dtype(landmark_op)
+        self._transitions = self._as_dtype(sparse.csr_matrix(pnm))
         tasklogger.log_complete("landmark operator")
 
+    def _get_spectral_embedding(self):
+        """Spectral embedding of the diffusion operator
+
+        Cached, as it depends only on the kernel and `n_svd`
+
+        Returns
+        -------
+        embedding : array-like, shape=[n_samples, n_svd]
+        """
+        try:
+            return self._spectral_embedding
+        except AttributeError:
+            n_samples = self.data_nu.shape[0]
+            # randomized SVD keeps a few [n_samples, n_svd] arrays
+            self._check_memory(32 * n_samples * (self.n_svd + 10), "SVD")
+            tasklogger.log_start("SVD")
+            _, _, VT = randomized_svd(self.diff_aff,
+                                      n_components=self.n_svd,
+                                      random_state=self.random_state)
+            tasklogger.log_complete("SVD")
+            self._spectral_embedding = self.diff_op.dot(VT.T)
+            return self._spectral_embedding
+
+    def _spectral_clusters(self):
+        """Cluster samples by KMeans on a spectral embedding
+
+        The KMeans batch size grows with the number of samples and with the
+        embedding dimension `n_svd`, and is capped by `max_memory`.
+
+        Returns
+        -------
+        clusters : `np.ndarray`, shape=[n_samples]
+        """
+        embedding = self._get_spectral_embedding()
+        n_samples, n_dim = embedding.shape
+        # KMeans compares init_size samples to all landmarks
+        kmeans_bytes = 24 * self.n_landmark * (self.n_landmark + n_dim)
+        self._check_memory(kmeans_bytes, "KMeans")
+        # larger datasets need larger batches to converge in a comparable
+        # number of steps, and the noise of each center update grows with
+        # the number of coordinates it averages; each sample in a batch is
+        # compared to every landmark in the embedding space
+        batch_size = max(3 * self.n_landmark, n_samples // 100)
+        batch_size = min(n_samples, int(batch_size * max(1, n_dim / 100.)))
+        if self.max_memory is not None:
+            batch_size = min(batch_size, max(1, self.max_memory // (
+                24 * (self.n_landmark + n_dim))))
+        if self.n_init == 1:
+            seeds = [self.random_state]
+        else:
+            seeds = check_random_state(self.random_state).randint(
+                np.iinfo(np.int32).max, size=self.n_init)
+
+        def fit(seed):
+            return MiniBatchKMeans(
+                self.n_landmark,
+                init_size=3 * self.n_landmark,
+                batch_size=batch_size,
+                random_state=seed).fit(embedding)
+        # spectral clustering
+        tasklogger.log_start("KMeans")
+        kmeans = min(self._map_blocks(fit, list(seeds),
+                                      task_bytes=kmeans_bytes),
+                     key=lambda kmeans: kmeans.inertia_)
+        clusters = kmeans.labels_
+        tasklogger.log_complete("KMeans")
+        if self.empty_clusters == 'reassign':
+            clusters = self._reassign_empty_clusters(
+                embedding, clusters, kmeans.cluster_centers_)
+        # otherwise, empty clusters are dropped from the landmarks
+        return clusters
+
+    def _reassign_empty_clusters(self, embedding, clusters, centers):
+        """Move the samples farthest from their centers to empty clusters
+
+        Parameters
+        ----------
+        embedding : array-like, shape=[n_samples, n_dim]
+
+        clusters : `np.ndarray`, shape=[n_samples]
+
+        centers : `np.ndarray`, shape=[n_clusters, n_dim]
+
+        Returns
+        -------
+        clusters : `np.ndarray`, shape=[n_samples]
+        """
+        sizes = np.bincount(clusters, minlength=len(centers))
+        empty = np.flatnonzero(sizes == 0)
+        if len(empty) == 0:
+            return clusters
+        tasklogger.log_debug("Reassigning {} empty clusters".format(
+            len(empty)))
+        residuals = np.asarray(embedding - centers[clusters])
+        distances = np.sum(residuals ** 2, axis=1)
+        clusters = clusters.copy()
+        # samples in order of decreasing distance to their center
+        candidates = iter(np.argsort(-distances, kind='mergesort'))
+        for cluster in empty:
+            for i in candidates:
+                # never empty another cluster
+                if sizes[clusters[i]] > 1:
+                    sizes[clusters[i]] -= 1
+                    clusters[i] = cluster
+                    sizes[cluster] = 1
+                    break
+        return clusters
+
+    def _sampled_clusters(self):
+        """Select samples as landmarks and assign samples to the nearest one
+
+        Returns
+        -------
+        clusters : `np.ndarray`, shape=[n_samples]
+        """
+        tasklogger.log_start("landmark selection")
+        random_state = check_random_state(self.random_state)
+        n_samples = self.data_nu.shape[0]
+        if self.landmark_method in ['kmeans++', 'farthest']:
+            clusters = self._sequential_clusters(random_state)
+        else:
+            if self.landmark_method == 'random':
+                p = None
+            else:
+                degree = np.asarray(self.kernel.sum(axis=1)).reshape(-1)
+                p = degree / degree.sum()
+            landmarks = random_state.choice(
+                n_samples, self.n_landmark, replace=False, p=p)
+            clusters = self._nearest_landmarks(np.sort(landmarks))
+        tasklogger.log_complete("landmark selection")
+        return clusters
+
+    def _sequential_clusters(self, random_state):
+        """Select landmarks one at a time by kmeans++ or farthest points
+
+        Each new landmark is chosen from the squared distances of all
+        samples to their nearest landmark so far, which also gives the
+        cluster assignments.
+        """
+        X = self.data_nu
+        n_samples = X.shape[0]
+        X_norm = row_norms(X, squared=True)[np.newaxis, :]
+
+        def sq_distances(i):
+            return euclidean_distances(X[[i]], X, Y_norm_squared=X_norm,
+                                       squared=True).reshape(-1)
+        min_dist = sq_distances(random_state.randint(n_samples))
+        clusters = np.zeros(n_samples, dtype=int)
+        for landmark in range(1, self.n_landmark):
+            total = min_dist.sum()
+            if total == 0:
+                # fewer unique samples than landmarks
+                break
+            if self.landmark_method == 'farthest':
+                i = np.argmax(min_dist)
+            else:
+                i = random_state.choice(n_samples, p=min_dist / total)
+            dist = sq_distances(i)
+            closer = dist < min_dist
+            min_dist[closer] = dist[closer]
+            clusters[closer] = landmark
+        return clusters
+
+    def _nearest_landmarks(self, landmarks):
+        """Index of the nearest of `landmarks` to each sample
+
+        Computed in blocks of rows that fit in `max_memory`.
+        """
+        X = self.data_nu
+        Y = X[landmarks]
+        Y_norm = row_norms(Y, squared=True)[np.newaxis, :]
+        blocks = self._row_blocks(X.shape[0], 16 * len(landmarks),
+                                  default_bytes=self._block_size)
+        return np.concatenate([np.argmin(euclidean_distances(
+            X[rows], Y, Y_norm_squared=Y_norm, squared=True), axis=1)
+            for rows in blocks])
+
+    def _format_landmark_op(self, landmark_op):
+        """Threshold the landmark operator and convert to `landmark_output`
+        """
+        if self.landmark_thresh > 0:
+            # never drop the largest entry of a row, which would leave the
+            # row empty after renormalization
+            if sparse.issparse(landmark_op):
+                landmark_op = landmark_op.tocsr()
+                landmark_op.sum_duplicates()
+                thresh = np.minimum(
+                    self.landmark_thresh,
+                    landmark_op.max(axis=1).toarray().ravel())
+                landmark_op = threshold_csr(
+                    landmark_op,
+                    np.repeat(thresh, np.diff(landmark_op.indptr)))
+            else:
+                thresh = np.minimum(self.landmark_thresh,
+                                    landmark_op.max(axis=1))
+                landmark_op[landmark_op < thresh[:, np.newaxis]] = 0
+            landmark_op = normalize(landmark_op, norm='l1', axis=1)
+        if self.landmark_output == 'auto':
+            if sparse.issparse(landmark_op):
+                density = float(landmark_op.nnz) / np.prod(landmark_op.shape)
+            else:
+                density = np.mean(landmark_op != 0)
+            is_sparse = density < self._sparse_density
+        else:
+            is_sparse = self.landmark_output == 'sparse'
+        if is_sparse:
+            return sparse.csr_matrix(landmark_op)
+        elif sparse.issparse(landmark_op):
+            return landmark_op.toarray()
+        else:
+            return landmark_op
+
     def extend_to_data(self, data, **kwargs):
         """Build transition matrix from new data to the graph
 
@@ -530,15 +1187,12 @@ class LandmarkGraph(DataGraph):
             Transition matrix from `Y` to `self.data`
         """
         kernel = self.build_kernel_to_data(data, **kwargs)
-        if sparse.issparse(kernel):
-            pnm = sparse.hstack(
-                [sparse.csr_matrix(kernel[:, self._clusters == i].sum(
-                    axis=1)) for i in np.unique(self._clusters)])
-        else:
-            pnm = np.array([np.sum(
-                kernel[:, self._clusters == i],
-                axis=1).T for i in np.unique(self._clusters)]).transpose()
+        # sum the kernel columns of the samples in each cluster; the sparse
+        # indicator goes on the left so dense kernels also work
+        pnm = self.cluster_indicator.T.dot(kernel.T).T
         pnm = normalize(pnm, norm='l1', axis=1)
+        if sparse.issparse(pnm):
+            pnm = pnm.tocsr()
         return pnm
 
     def interpolate(self, transform, transitions=None, Y=None):
@@ -582,7 +1236,10 @@ class TraditionalGraph(DataGraph):
         `pandas.DataFrame`, `pandas.SparseDataFrame`.
         If `precomputed` is not `None`, data should be an
         [n_samples, n_samples] matrix denoting pairwise distances,
-        affinities, or edge weights.
+        affinities, or edge weights. Precomputed matrices can also be given
+        as a `numpy.memmap` or the path to a `.npy` file, which is memory
+        mapped. These are processed block by block into a sparse kernel
+        without loading the full matrix.
 
     knn : `int`, optional (default: 5)
         Number of nearest neighbors (including self) to use to build the graph
@@ -611,12 +1268,27 @@ class TraditionalGraph(DataGraph):
         If the graph is precomputed, this variable denotes which graph
         matrix is provided as `data`.
         Only one of `precomputed` and `n_pca` can be set.
+
+    kernel_output : {'auto', 'dense', 'sparse'}, optional (default: 'auto')
+        Format of the alpha decay kernel. 'auto' builds a sparse kernel if
+        the density after thresholding, projected from a random sample of
+        rows, is below 10%, and a dense kernel otherwise. Memory-mapped
+        precomputed matrices always give a sparse kernel with 'auto'.
     """
 
+    # kernel_output='auto' builds sparse kernels below this density,
+    # projected from this many rows
+    _sparse_density = 0.1
+    _density_samples = 200
+
     def __init__(self, data, knn=5, decay=10,
                  distance='euclidean', n_pca=None,
                  thresh=1e-4,
-                 precomputed=None, **kwargs):
+                 precomputed=None,
+                 kernel_output='auto', **kwargs):
+        if precomputed is not None and isinstance(data, str):
+            # path to a .npy file
+            data = np.load(data, mmap_mode='r')
         if precomputed is not None and n_pca is not None:
             # the data itself is a matrix of distances / affinities
             n_pca = None
@@ -635,14 +1307,19 @@ class TraditionalGraph(DataGraph):
                 raise ValueError("Precomputed {} must be a square matrix. "
                                  "{} was given".format(precomputed,
                                                        data.shape))
-            elif (data < 0).sum() > 0:
+            elif has_negative(data):
                 raise ValueError("Precomputed {} should be "
                                  "non-negative".format(precomputed))
+        if kernel_output not in ['auto', 'dense', 'sparse']:
+            raise ValueError("kernel_output '{}' not recognized. Choose from "
+                             "['auto', 'dense', 'sparse']".format(
+                                 kernel_output))
         self.knn = knn
         self.decay = decay
         self.distance = distance
         self.thresh = thresh
         self.precomputed = precomputed
+        self.kernel_output = kernel_output
 
         super().__init__(data, n_pca=n_pca,
                          **kwargs)
@@ -654,7 +1331,10 @@ class TraditionalGraph(DataGraph):
         params.update({'knn': self.knn,
                        'decay': self.decay,
                        'distance': self.distance,
-                       'precomputed': self.precomputed})
+                       'precomputed': self.precomputed,
+                       'kernel_output': self.kernel_output,
+                       'n_jobs': self.n_jobs,
+                       'max_memory': self.max_memory})
         return params
 
     def set_params(self, **params):
@@ -662,11 +1342,15 @@ class TraditionalGraph(DataGraph):
 
         Safe setter method - attributes should not be modified directly as some
         changes are not valid.
+        Valid parameters:
+        - n_jobs
+        - max_memory
         Invalid parameters: (these would require modifying the kernel matrix)
         - precomputed
         - distance
         - knn
         - decay
+        - kernel_output
 
         Parameters
         ----------
@@ -690,6 +1374,14 @@ class TraditionalGraph(DataGraph):
         if 'decay' in params and params['decay'] != self.decay and \
                 self.precomputed is None:
             raise ValueError("Cannot update decay. Please create a new graph")
+        if 'kernel_output' in params and \
+                params['kernel_output'] != self.kernel_output:
+            raise ValueError("Cannot update kernel_output. "
+                             "Please create a new graph")
+        if 'n_jobs' in params:
+            self.n_jobs = params['n_jobs']
+        if 'max_memory' in params:
+            self.max_memory = params['max_memory']
         # update superclass parameters
         super().set_params(**params)
         return self
@@ -712,65 +1404,45 @@ class TraditionalGraph(DataGraph):
         ------
         ValueError: if `precomputed` is not an acceptable value
         """
-        if self.precomputed == "affinity":
-            # already done
+        if self.precomputed in ["affinity", "adjacency"] and \
+                isinstance(self.data_nu, np.memmap):
+            K = self._build_precomputed_rows()
+        elif self.precomputed in ["affinity", "adjacency"]:
+            K = self.data_nu
+            if self.precomputed == "adjacency":
+                # need to set diagonal to one to make it an affinity matrix
+                if sparse.issparse(K) and \
+                    not (isinstance(K, sparse.dok_matrix) or
+                         isinstance(K, sparse.lil_matrix)):
+                    K = K.tolil()
+                K = set_diagonal(K, 1)
             # TODO: should we check that precomputed matrices look okay?
             # e.g. check the diagonal
-            K = self.data_nu
-        elif self.precomputed == "adjacency":
-            # need to set diagonal to one to make it an affinity matrix
-            K = self.data_nu
-            if sparse.issparse(K) and \
-                not (isinstance(K, sparse.dok_matrix) or
-                     isinstance(K, sparse.lil_matrix)):
-                K = K.tolil()
-            K = set_diagonal(K, 1)
+            # truncate
+            if sparse.issparse(K):
+                K = threshold_csr(K, self.thresh)
+            else:
+                K[K < self.thresh] = 0
         else:
             tasklogger.log_start("affinities")
             if sparse.issparse(self.data_nu):
                 self.data_nu = self.data_nu.toarray()
             if self.precomputed == "distance":
-                pdx = self.data_nu
+                def distances(rows):
+                    return self._as_dtype(np.array(self.data_nu[rows]))
             elif self.precomputed is None:
-                pdx = pdist(self.data_nu, metric=self.distance)
-                if np.any(pdx == 0):
-                    pdx = squareform(pdx)
-                    duplicate_ids = np.array(
-                        [i for i in np.argwhere(pdx == 0)
-                         if i[1] > i[0]])
-                    duplicate_names = ", ".join(["{} and {}".format(i[0], i[1])
-                                                 for i in duplicate_ids])
-                    warnings.warn(
-                        "Detected zero distance between samples {}. "
-                        "Consider removing duplicates to avoid errors in "
-                        "downstream processing.".format(duplicate_names),
-                        RuntimeWarning)
-                else:
-                    pdx = squareform(pdx)
+                self._check_duplicates()
+
+                def distances(rows):
+                    return self._distances_to_data(self.data_nu[rows])
             else:
                 raise ValueError(
                     "precomputed='{}' not recognized. "
                     "Choose from ['affinity', 'adjacency', 'distance', "
                     "None]".format(self.precomputed))
-            knn_dist = np.partition(pdx, self.knn, axis=1)[:, :self.knn]
-            epsilon = np.max(knn_dist, axis=1)
-            pdx = (pdx.T / epsilon).T
-            K = np.exp(-1 * np.power(pdx, self.decay))
-            # handle nan
-            K = np.where(np.isnan(K), 1, K)
+            K = self._build_kernel_rows(self.data_nu.shape[0], distances,
+                                        self.knn)
             tasklogger.log_complete("affinities")
-        # truncate
-        if sparse.issparse(K):
-            if not (isinstance(K, sparse.csr_matrix) or
-                    isinstance(K, sparse.csc_matrix) or
-                    isinstance(K, sparse.bsr_matrix)):
-                K = K.tocsr()
-            K.data[K.data < self.thresh] = 0
-            K = K.tocoo()
-            K.eliminate_zeros()
-            K = K.tocsr()
-        else:
-            K[K < self.thresh] = 0
         return K
 
     def build_kernel_to_data(self, Y, knn=None):
@@ -810,17 +1482,151 @@ class TraditionalGraph(DataGraph):
         else:
             tasklogger.log_start("affinities")
             Y = self._check_extension_shape(Y)
-            pdx = cdist(Y, self.data_nu, metric=self.distance)
-            knn_dist = np.partition(pdx, knn, axis=1)[:, :knn]
-            epsilon = np.max(knn_dist, axis=1)
-            pdx = (pdx.T / epsilon).T
-            K = np.exp(-1 * pdx**self.decay)
-            # handle nan
-            K = np.where(np.isnan(K), 1, K)
-            K[K < self.thresh] = 0
+
+            def distances(rows):
+                return self._distances_to_data(Y[rows])
+            K = self._build_kernel_rows(Y.shape[0], distances, knn)
             tasklogger.log_complete("affinities")
         return K
 
+    def _distances_to_data(self, Y):
+        """Distances from the rows of `Y` to `self.data_nu`, in `self.dtype`
+
+        Reduced precision blocks are computed by scikit-learn, which keeps
+        the dtype for its own metrics rather than returning a double
+        precision copy of the block. Other metrics are computed by scipy
+        in double precision and cast.
+        """
+        if self.dtype is not None and np.dtype(self.dtype).itemsize < 8:
+            return self._as_dtype(pairwise_distances(
+                Y, self.data_nu, metric=self.distance))
+        return self._as_dtype(cdist(Y, self.data_nu, metric=self.distance))
+
+    def _build_precomputed_rows(self):
+        """Threshold a memory-mapped affinity or adjacency matrix
+
+        The matrix is read block by block of rows into a sparse kernel.
+
+        Returns
+        -------
+        K : `scipy.sparse.csr_matrix`, shape=[n_samples, n_samples]
+        """
+        n_samples = self.data_nu.shape[0]
+        blocks = self._row_blocks(n_samples, 16 * n_samples,
+                                  default_bytes=self._block_size)
+        K = []
+        for rows in blocks:
+            block = self._as_dtype(np.array(self.data_nu[rows]))
+            if self.precomputed == "adjacency":
+                # need to set diagonal to one to make it an affinity matrix
+                block[np.arange(rows.stop - rows.start),
+                      np.arange(rows.start, rows.stop)] = 1
+            block[block < self.thresh] = 0
+            K.append(sparse.csr_matrix(block))
+        return sparse.vstack(K, format='csr')
+
+    def _affinities(self, pdx, knn):
+        """Convert a block of distances to alpha decay affinities in place
+        """
+        # the knn-th smallest distance
+        epsilon = np.partition(pdx, knn - 1, axis=1)[:, knn - 1]
+        pdx /= epsilon[:, None]
+        np.power(pdx, self.decay, out=pdx)
+        np.negative(pdx, out=pdx)
+        np.exp(pdx, out=pdx)
+        # handle nan
+        pdx[np.isnan(pdx)] = 1
+        pdx[pdx < self.thresh] = 0
+        return pdx
+
+    def _use_sparse_kernel(self, n_rows, distances, knn):
+        """Decide whether to build the kernel as a sparse matrix
+
+        For `kernel_output='auto'`, the density of the thresholded kernel is
+        projected from a random sample of rows. Returns `None` if there are
+        too few rows to sample, and the kernel should be built dense and
+        converted afterwards.
+        """
+        if self.kernel_output != 'auto':
+            return self.kernel_output == 'sparse'
+        if isinstance(self.data_nu, np.memmap):
+            # a dense kernel would be as large as the memory-mapped input
+            return True
+        if self.thresh == 0 or n_rows == 0:
+            return False
+        if n_rows <= self._density_samples:
+            # cheaper to build the kernel and decide afterwards
+            return None
+        rows = check_random_state(self.random_state).choice(
+            n_rows, min(n_rows, self._density_samples), replace=False)
+        density = np.mean(self._affinities(distances(np.sort(rows)),
+                                           knn) != 0)
+        tasklogger.log_debug("Projected kernel density: {:.4f}".format(
+            density))
+        return density < self._sparse_density
+
+    def _build_kernel_rows(self, n_rows, distances, knn):
+        """Build an alpha decay kernel in blocks of rows
+
+        Each block of distances is converted to affinities in place and
+        written into the output, so peak memory is the output plus about
+        two blocks per thread. Blocks are processed by up to `n_jobs`
+        threads.
+
+        Parameters
+        ----------
+        n_rows : `int`
+            Number of rows of the kernel
+
+        distances : callable
+            `distances(rows)` returns a new array of distances from the
+            samples indexed by `rows` to `self.data_nu`
+
+        knn : `int`
+            Number of nearest neighbors used for the bandwidth
+
+        Returns
+        -------
+        K : `np.ndarray` or `scipy.sparse.csr_matrix`,
+            shape=[n_rows, n_samples]
+        """
+        n_samples = self.data_nu.shape[0]
+        is_sparse = self._use_sparse_kernel(n_rows, distances, knn)
+        if is_sparse is None:
+            # distances and affinities of all rows at once
+            self._check_memory(16 * n_rows * n_samples, "Dense kernel")
+            K = self._affinities(distances(slice(0, n_rows)), knn)
+            if np.mean(K != 0) < self._sparse_density:
+                K = sparse.csr_matrix(K)
+            return K
+        if not is_sparse:
+            self._check_memory(8 * n_rows * n_samples, "Dense kernel")
+        row_bytes = 16 * n_samples
+        if self.max_memory is not None:
+            # each thread holds one block at a time
+            n_threads = self._n_threads(self.max_memory // row_bytes)
+        else:
+            n_threads = self._n_threads(n_rows)
+        blocks = self._row_blocks(n_rows, n_threads * row_bytes,
+                                  default_bytes=self._block_size)
+        tasklogger.log_debug("Building {} kernel in {} blocks".format(
+            "sparse" if is_sparse else "dense", len(blocks)))
+        if is_sparse:
+            return sparse.vstack(self._map_blocks(
+                lambda rows: sparse.csr_matrix(
+                    self._affinities(distances(rows), knn)),
+                blocks), format='csr')
+        # the first block sets the output dtype
+        pdx = self._affinities(distances(blocks[0]), knn)
+        K = np.empty((n_rows, n_samples), dtype=pdx.dtype)
+        K[blocks[0]] = pdx
+        del pdx
+
+        def build_block(rows):
+            K[rows] = self._affinities(distances(rows), knn)
+        self._map_blocks(build_block, blocks[1:])
+        return K
+
 
 class MNNGraph(DataGraph):
     """Mutual nearest neighbors graph
@@ -847,6 +1653,13 @@ class MNNGraph(DataGraph):
         Weights MNN kernel adaptively using the number of cells in
         each sample according to the selected method.
 
+    knn_method : `str`, optional (default: 'auto')
+        Nearest neighbor search backend used by each subgraph.
+        See `kNNGraph`.
+
+    knn_params : `dict` or `None`, optional (default: `None`)
+        Additional keyword arguments for the nearest neighbor search backend.
+
     Attributes
     ----------
     subgraphs : list of `graphtools.graphs.kNNGraph`
@@ -860,6 +1673,8 @@ class MNNGraph(DataGraph):
                  distance='euclidean',
                  thresh=1e-4,
                  n_jobs=1,
+                 knn_method='auto',
+                 knn_params=None,
                  **kwargs):
         self.beta = beta
         self.sample_idx = sample_idx
@@ -871,6 +1686,8 @@ class MNNGraph(DataGraph):
         self.distance = distance
         self.thresh = thresh
         self.n_jobs = n_jobs
+        self.knn_method = knn_method
+        self.knn_params = knn_params
         self.weighted_knn = self._weight_knn()
 
         if sample_idx is None:
@@ -959,7 +1776,10 @@ class MNNGraph(DataGraph):
                        'decay': self.decay,
                        'distance': self.distance,
                        'thresh': self.thresh,
-                       'n_jobs': self.n_jobs})
+                       'knn_method': self.knn_method,
+                       'knn_params': self.knn_params,
+                       'n_jobs': self.n_jobs,
+                       'max_memory': self.max_memory})
         return params
 
     def set_params(self, **params):
@@ -969,6 +1789,7 @@ class MNNGraph(DataGraph):
         changes are not valid.
         Valid parameters:
         - n_jobs
+        - max_memory
         - random_state
         - verbose
         Invalid parameters: (these would require modifying the kernel matrix)
@@ -977,6 +1798,8 @@ class MNNGraph(DataGraph):
         - decay
         - distance
         - thresh
+        - knn_method
+        - knn_params
         - beta
 
         Parameters
@@ -995,8 +1818,9 @@ class MNNGraph(DataGraph):
                 "Cannot update adaptive_k. Please create a new graph")
 
         # knn arguments
-        knn_kernel_args = ['knn', 'decay', 'distance', 'thresh']
-        knn_other_args = ['n_jobs', 'random_state', 'verbose']
+        knn_kernel_args = ['knn', 'decay', 'distance', 'thresh',
+                           'knn_method', 'knn_params']
+        knn_other_args = ['n_jobs', 'max_memory', 'random_state', 'verbose']
         for arg in knn_kernel_args:
             if arg in params and params[arg] != getattr(self, arg):
                 raise ValueError("Cannot update {}. "
@@ -1039,18 +1863,27 @@ class MNNGraph(DataGraph):
                           decay=self.decay,
                           distance=self.distance,
                           thresh=self.thresh,
+                          knn_method=self.knn_method,
+                          knn_params=self.knn_params,
                           verbose=self.verbose,
                           random_state=self.random_state,
+                          dtype=self.dtype,
                           n_jobs=self.n_jobs,
+                          max_memory=self.max_memory,
                           initialize=False)
             self.subgraphs.append(graph)  # append to list of subgraphs
         tasklogger.log_complete("subgraphs")
 
-        if self.thresh > 0 or self.decay is None:
-            K = sparse.lil_matrix(
-                (self.data_nu.shape[0], self.data_nu.shape[0]))
+        n_samples = self.data_nu.shape[0]
+        is_sparse = self.thresh > 0 or self.decay is None
+        if is_sparse:
+            # blocks are assembled from COO triplets in a single step
+            blocks = []
         else:
-            K = np.zeros([self.data_nu.shape[0], self.data_nu.shape[0]])
+            self._check_memory(8 * n_samples**2, "Dense kernel")
+            K = np.zeros([n_samples, n_samples], dtype=self.dtype)
+        sample_rows = [np.flatnonzero(self.sample_idx == sample)
+                       for sample in self.samples]
         for i, X in enumerate(self.subgraphs):
             for j, Y in enumerate(self.subgraphs):
                 tasklogger.log_start(
@@ -1062,11 +1895,16 @@ class MNNGraph(DataGraph):
                 if i == j:
                     # downweight within-batch affinities by beta
                     Kij = Kij * self.beta
-                K = set_submatrix(K, self.sample_idx == self.samples[i],
-                                  self.sample_idx == self.samples[j], Kij)
+                if is_sparse:
+                    blocks.append((sample_rows[i], sample_rows[j], Kij))
+                else:
+                    K = set_submatrix(K, sample_rows[i], sample_rows[j], Kij)
                 tasklogger.log_complete(
                     "kernel from sample {} to {}".format(self.samples[i],
                                                          self.samples[j]))
+        if is_sparse:
+            K = assemble_blocks(blocks, (n_samples, n_samples),
+                                dtype=self.dtype)
         return K
 
     def symmetrize_kernel(self, K):
@@ -1078,24 +1916,32 @@ class MNNGraph(DataGraph):
             # experimental samples to be corrected simultaneously
             tasklogger.log_debug("Using gamma symmetrization. "
                                  "Gamma:\n{}".format(self.gamma))
-            for i, sample_i in enumerate(self.samples):
-                for j, sample_j in enumerate(self.samples):
+            is_sparse = sparse.issparse(K)
+            if is_sparse:
+                K = K.tocsr()
+                blocks = []
+            sample_rows = [np.flatnonzero(self.sample_idx == sample)
+                           for sample in self.samples]
+            for i, rows_i in enumerate(sample_rows):
+                for j, rows_j in enumerate(sample_rows):
                     if j < i:
                         continue
-                    Kij = K[np.ix_(self.sample_idx == sample_i,
-                                   self.sample_idx == sample_j)]
-                    Kji = K[np.ix_(self.sample_idx == sample_j,
-                                   self.sample_idx == sample_i)]
+                    Kij = K[rows_i][:, rows_j]
+                    Kji = K[rows_j][:, rows_i]
                     Kij_symm = self.gamma[i, j] * \
                         elementwise_minimum(Kij, Kji.T) + \
                         (1 - self.gamma[i, j]) * \
                         elementwise_maximum(Kij, Kji.T)
-                    K = set_submatrix(K, self.sample_idx == sample_i,
-                                      self.sample_idx == sample_j, Kij_symm)
-                    if not i == j:
-                        K = set_submatrix(K, self.sample_idx == sample_j,
-                                          self.sample_idx == sample_i,
-                                          Kij_symm.T)
+                    if is_sparse:
+                        blocks.append((rows_i, rows_j, Kij_symm))
+                        if not i == j:
+                            blocks.append((rows_j, rows_i, Kij_symm.T))
+                    else:
+                        K = set_submatrix(K, rows_i, rows_j, Kij_symm)
+                        if not i == j:
+                            K = set_submatrix(K, rows_j, rows_i, Kij_symm.T)
+            if is_sparse:
+                K = assemble_blocks(blocks, K.shape, dtype=K.dtype)
         else:
             K = super().symmetrize_kernel(K)
         return K
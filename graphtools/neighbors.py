@@ -0,0 +1,1371 @@
+from builtins import super
+import numpy as np
+from sklearn import config_context, get_config
+from sklearn.base import BaseEstimator
+from sklearn.metrics import pairwise_distances
+from sklearn.neighbors import NearestNeighbors, VALID_METRICS
+from sklearn.utils import check_random_state
+from sklearn.utils.extmath import safe_sparse_dot
+from scipy import sparse
+
+
+def _dense_rows(X, idx):
+    """Gather rows of `X` as a dense array"""
+    rows = X[idx]
+    if sparse.issparse(rows):
+        rows = rows.toarray()
+    return np.asarray(rows)
+
+
+def _paired_sqeuclidean(Q, X):
+    D = np.matmul(X, Q[:, :, None])[:, :, 0]
+    D *= -2
+    D += np.einsum('ijk,ijk->ij', X, X)
+    D += np.einsum('ij,ij->i', Q, Q)[:, None]
+    return np.maximum(D, 0, out=D)
+
+
+def _paired_euclidean(Q, X):
+    return np.sqrt(_paired_sqeuclidean(Q, X))
+
+
+def _paired_manhattan(Q, X):
+    return np.sum(np.abs(X - Q[:, None, :]), axis=2)
+
+
+def _paired_chebyshev(Q, X):
+    return np.max(np.abs(X - Q[:, None, :]), axis=2)
+
+
+def _paired_cosine(Q, X):
+    dot = np.matmul(X, Q[:, :, None])[:, :, 0]
+    norm = np.sqrt(np.einsum('ijk,ijk->ij', X, X) *
+                   np.einsum('ij,ij->i', Q, Q)[:, None])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dist = 1 - dot / norm
+    # zero vectors have undefined cosine distance
+    dist[norm == 0] = 1
+    return np.maximum(dist, 0)
+
+
+_PAIRED_METRICS = {
+    'euclidean': _paired_euclidean,
+    'l2': _paired_euclidean,
+    'sqeuclidean': _paired_sqeuclidean,
+    'manhattan': _paired_manhattan,
+    'cityblock': _paired_manhattan,
+    'l1': _paired_manhattan,
+    'chebyshev': _paired_chebyshev,
+    'cosine': _paired_cosine,
+}
+
+
+def _sort_pairs(rows, cols):
+    """Sort pairs of non-negative integers, breaking ties by position
+
+    Returns
+    -------
+    order : array-like, shape=[n_pairs]
+        Positions of the pairs in sorted order
+
+    pairs : array-like, shape=[n_pairs]
+        Sorted pairs, as integers that compare like the pairs
+    """
+    n_pairs = len(rows)
+    col_bits = int(np.max(cols)).bit_length()
+    pos_bits = n_pairs.bit_length()
+    if int(np.max(rows)).bit_length() + col_bits + pos_bits < 64:
+        # sort integer keys holding the positions, which is much faster
+        # than a stable argsort
+        keys = (rows.astype(np.int64) << (col_bits + pos_bits)) | (
+            cols.astype(np.int64) << pos_bits) | np.arange(n_pairs)
+        keys.sort()
+        return keys & ((1 << pos_bits) - 1), keys >> pos_bits
+    pairs = (rows.astype(np.int64) << 32) | cols
+    order = np.argsort(pairs, kind='mergesort')
+    return order, pairs[order]
+
+
+class NNDescent(BaseEstimator):
+    """Approximate nearest neighbors by nearest neighbor descent
+
+    Builds an approximate k-nearest neighbor graph on the fitted data by
+    repeatedly comparing the neighbors of each point to each other
+    (Dong et al., 2011), starting from all pairs of points sharing a leaf
+    of random projection trees. Queries start from the tree leaves they
+    fall in and walk the same graph. All comparisons are vectorized in blocks of rows.
+
+    Parameters
+    ----------
+
+    n_neighbors : `int`, optional (default: 5)
+        Default number of neighbors to return
+
+    metric : `str`, optional (default: `'euclidean'`)
+        One of `'euclidean'`, `'sqeuclidean'`, `'manhattan'`, `'cityblock'`,
+        `'l1'`, `'l2'`, `'chebyshev'` or `'cosine'`.
+
+    n_iters : `int`, optional (default: 10)
+        Maximum number of refinement rounds for both index construction and
+        queries. This is the main recall-vs-speed knob: fewer rounds are
+        faster, more rounds bring recall closer to the exact search.
+
+    max_candidates : `int` or `None`, optional (default: `None`)
+        Maximum number of new and of old neighbors, including reverse
+        neighbors, joined per point in each round of index construction.
+        If `None`, uses the number of neighbors kept per point, up to 15.
+
+    delta : `float`, optional (default: 0.001)
+        Stop index construction once fewer than `delta * n_neighbors`
+        neighbors per point change in a single round.
+
+    min_degree : `int`, optional (default: 15)
+        Minimum number of neighbors kept per point in the search graph.
+
+    n_trees : `int`, optional (default: 4)
+        Number of random projection trees used to initialize the graph and
+        the queries. Not used on sparse data, where the graph starts at
+        random and queries start from the closest of a random set of
+        pivots.
+
+    leaf_size : `int`, optional (default: 30)
+        Maximum number of points in a leaf of each random projection tree.
+        Raised to twice the number of neighbors kept per point.
+
+    max_memory : `int` or `None`, optional (default: `None`)
+        Approximate memory budget for a single block of comparisons, in
+        bytes. If `None`, blocks use about 8MB, and candidate neighbors
+        are merged into the graph once per round.
+
+    n_jobs : `int`, optional (default: 1)
+        Ignored. Accepted for compatibility with
+        `sklearn.neighbors.NearestNeighbors`.
+
+    random_state : `int`, `numpy.RandomState` or `None`, optional
+        Random state for initialization and candidate sampling
+
+    Attributes
+    ----------
+
+    graph_ : array-like, shape=[n_samples, n_degree]
+        Indices of the approximate nearest neighbors of each fitted sample,
+        starting with the sample itself
+
+    graph_distances_ : array-like, shape=[n_samples, n_degree]
+        Distances corresponding to `graph_`
+    """
+
+    _block_size = 2**23
+
+    def __init__(self, n_neighbors=5, metric='euclidean', n_iters=10,
+                 max_candidates=None, delta=0.001, min_degree=15,
+                 n_trees=4, leaf_size=30, max_memory=None, n_jobs=1,
+                 random_state=None):
+        self.n_neighbors = n_neighbors
+        self.metric = metric
+        self.n_iters = n_iters
+        self.max_candidates = max_candidates
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.delta = delta
+        self.min_degree = min_degree
+        self.max_memory = max_memory
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        super().__init__()
+
+    def _block_rows(self, row_bytes):
+        """Number of rows to process at once, using `row_bytes` each"""
+        block_bytes = self._block_size
+        if self.max_memory is not None:
+            block_bytes = self.max_memory
+        return max(1, block_bytes // max(1, row_bytes))
+
+    def _paired_distances(self, Q, X, candidates):
+        """Distances between each row of `Q` and its candidate rows of `X`"""
+        distances = np.empty(candidates.shape, dtype=np.float64)
+        block = self._block_rows(8 * candidates.shape[1] * (X.shape[1] + 4))
+        for start in range(0, Q.shape[0], block):
+            end = min(start + block, Q.shape[0])
+            cand = candidates[start:end]
+            X_cand = _dense_rows(X, cand.ravel()).reshape(
+                cand.shape[0], cand.shape[1], -1)
+            distances[start:end] = self._paired(
+                _dense_rows(Q, np.arange(start, end)), X_cand)
+        return distances
+
+    def _batched_distances(self, A, B):
+        """Distances between rows of `A[i]` and rows of `B[i]` for each `i`
+
+        Euclidean and cosine distances use a batched matrix product.
+        """
+        if self.metric in ['euclidean', 'l2', 'sqeuclidean', 'cosine']:
+            A_norms = np.einsum('ijk,ijk->ij', A, A)
+            B_norms = np.einsum('ijk,ijk->ij', B, B)
+            D = np.matmul(A, B.transpose(0, 2, 1))
+            if self.metric == 'cosine':
+                norm = np.sqrt(A_norms[:, :, None] * B_norms[:, None, :])
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    D = 1 - D / norm
+                # zero vectors have undefined cosine distance
+                D[norm == 0] = 1
+                return np.maximum(D, 0)
+            D *= -2
+            D += A_norms[:, :, None]
+            D += B_norms[:, None, :]
+            np.maximum(D, 0, out=D)
+            if self.metric != 'sqeuclidean':
+                np.sqrt(D, out=D)
+            return D
+        else:
+            return np.stack([self._paired(A[:, j], B)
+                             for j in range(A.shape[1])], axis=1)
+
+    def _brute_kneighbors(self, Q, n_neighbors):
+        """Exact nearest neighbors by blocked brute force"""
+        n_samples = self._fit_X.shape[0]
+        distances = np.empty((Q.shape[0], n_neighbors), dtype=np.float64)
+        indices = np.empty((Q.shape[0], n_neighbors), dtype=np.intp)
+        block = self._block_rows(32 * n_samples)
+        for start in range(0, Q.shape[0], block):
+            end = min(start + block, Q.shape[0])
+            D = pairwise_distances(Q[start:end], self._fit_X,
+                                   metric=self.metric)
+            if n_neighbors < n_samples:
+                ind = np.argpartition(D, n_neighbors - 1,
+                                      axis=1)[:, :n_neighbors]
+            else:
+                ind = np.tile(np.arange(n_samples), (end - start, 1))
+            rows = np.arange(end - start)[:, None]
+            order = np.argsort(D[rows, ind], axis=1)
+            indices[start:end] = ind[rows, order]
+            distances[start:end] = D[rows, indices[start:end]]
+        return distances, indices
+
+    def _merge(self, indices, distances, is_new, rows, cols, dists):
+        """Insert candidate neighbors into the sorted rows of `indices`
+
+        Updates `indices`, `distances` and `is_new` in place, keeping the
+        closest distinct neighbors of each row. Inserted entries are flagged
+        as new.
+
+        Returns
+        -------
+        n_updates : `int`
+            Number of candidates that entered a neighbor list
+        """
+        n_samples, n_keep = indices.shape
+        if len(rows) == 0:
+            return 0
+        # drop candidates that are already neighbors, and repeats: current
+        # neighbors come first, so they sort before equal candidates
+        touched = np.flatnonzero(np.bincount(rows, minlength=n_samples))
+        known = indices[touched]
+        valid = known >= 0
+        pair_rows = np.concatenate([np.repeat(touched, np.sum(valid, axis=1)),
+                                    rows])
+        pair_cols = np.concatenate([known[valid], cols])
+        order, pairs = _sort_pairs(pair_rows, pair_cols)
+        first = np.ones(len(pairs), dtype=bool)
+        first[1:] = pairs[1:] != pairs[:-1]
+        n_known = len(pair_rows) - len(rows)
+        fresh = order[first & (order >= n_known)] - n_known
+        if len(fresh) == 0:
+            return 0
+        rows, cols, dists = rows[fresh], cols[fresh], dists[fresh]
+        # closest n_keep candidates of each row, ranked in single precision
+        order = np.argsort((rows.astype(np.int64) << 32) | dists.astype(
+            np.float32).view(np.int32).astype(np.int64))
+        rows, cols, dists = rows[order], cols[order], dists[order]
+        start = np.flatnonzero(np.concatenate([[True],
+                                               rows[1:] != rows[:-1]]))
+        touched = rows[start]
+        counts = np.diff(np.append(start, len(rows)))
+        rank = np.arange(len(rows)) - np.repeat(start, counts)
+        keep = rank < n_keep
+        position = np.repeat(np.arange(len(touched)), counts)[keep]
+        width = min(n_keep, np.max(counts))
+        cand_ind = np.full((len(touched), width), -1, dtype=indices.dtype)
+        cand_dist = np.full((len(touched), width), np.inf)
+        cand_ind[position, rank[keep]] = cols[keep]
+        cand_dist[position, rank[keep]] = dists[keep]
+        # merge with the existing neighbors
+        merged_ind = np.hstack([indices[touched], cand_ind])
+        merged_dist = np.hstack([distances[touched], cand_dist])
+        merged_new = np.hstack([is_new[touched], cand_ind >= 0])
+        order = np.argsort(merged_dist, axis=1,
+                           kind='mergesort')[:, :n_keep]
+        rows = np.arange(len(touched))[:, None]
+        indices[touched] = merged_ind[rows, order]
+        distances[touched] = merged_dist[rows, order]
+        is_new[touched] = merged_new[rows, order]
+        return np.sum((order >= n_keep) & (indices[touched] >= 0))
+
+    def _sample(self, lists, mask, n_sample, random_state, distinct=False):
+        """Random subset of up to `n_sample` distinct masked entries of
+        each row, padded with -1
+
+        If `distinct`, rows of `lists` hold no repeated entries.
+        """
+        rows = np.arange(lists.shape[0])[:, None]
+        key = random_state.uniform(size=lists.shape)
+        key[~mask] = np.inf
+        if not distinct:
+            order = np.argsort(lists, axis=1)
+            repeat = np.zeros(lists.shape, dtype=bool)
+            ordered = lists[rows, order]
+            repeat[:, 1:] = ordered[:, 1:] == ordered[:, :-1]
+            key[np.nonzero(repeat)[0], order[repeat]] = np.inf
+        n_sample = min(n_sample, lists.shape[1])
+        picked = np.argpartition(key, n_sample - 1, axis=1)[:, :n_sample]
+        return np.where(np.isfinite(key[rows, picked]),
+                        lists[rows, picked], -1)
+
+    def _reverse(self, lists, n_reverse, random_state):
+        """Random subset of up to `n_reverse` reverse neighbors of each row
+
+        Row `u` of the result holds rows `v` such that `u` is in
+        `lists[v]`, padded with -1.
+        """
+        n_samples, n_degree = lists.shape
+        source = np.repeat(np.arange(n_samples), n_degree)
+        target = lists.ravel()
+        valid = target >= 0
+        source, target = source[valid], target[valid]
+        # random order within each target, so we keep a random subset
+        order = random_state.permutation(len(target))
+        order = order[np.argsort(target[order], kind='mergesort')]
+        source, target = source[order], target[order]
+        rank = np.arange(len(target)) - np.searchsorted(target, target)
+        keep = rank < n_reverse
+        reverse = np.full((n_samples, n_reverse), -1, dtype=lists.dtype)
+        reverse[target[keep], rank[keep]] = source[keep]
+        return reverse
+
+    def _local_join(self, X, indices, distances):
+        """Refine the neighbor graph of `X` by nearest neighbor descent
+
+        In each round, every point compares all pairs of its new neighbors,
+        and each new neighbor with each old neighbor, where neighbors
+        include reverse neighbors. Neighbors are new until they have been
+        joined once, so no pair is compared twice (Dong et al., 2011).
+        Updates `indices` and `distances` in place.
+        """
+        random_state = check_random_state(self.random_state)
+        n_samples, n_neighbors = indices.shape
+        n_sample = self.max_candidates
+        if n_sample is None:
+            n_sample = min(n_neighbors, 15)
+        is_new = np.ones(indices.shape, dtype=bool)
+        if self.max_memory is None:
+            n_buffer = n_samples * n_neighbors
+        else:
+            n_buffer = self._block_rows(24)
+        for _ in range(self.n_iters):
+            new = self._sample(indices, is_new & (indices >= 0),
+                               n_sample, random_state, distinct=True)
+            old = self._sample(indices, ~is_new & (indices >= 0),
+                               n_sample, random_state, distinct=True)
+            # add reverse neighbors, still joining at most n_sample of each
+            new = np.hstack([new, self._reverse(new, n_sample, random_state)])
+            new = self._sample(new, new >= 0, n_sample, random_state)
+            old = np.hstack([old, self._reverse(old, n_sample, random_state)])
+            old = self._sample(old, old >= 0, n_sample, random_state)
+            if np.all(new < 0):
+                break
+            join = np.hstack([new, old])
+            n_new, n_join = new.shape[1], join.shape[1]
+            # gathered rows, plus distances and endpoints of each pair
+            block = self._block_rows(8 * n_join * (X.shape[1] + 6 * n_new))
+            n_updates = 0
+            candidates, n_candidates = [], 0
+            for start in range(0, n_samples, block):
+                end = min(start + block, n_samples)
+                # neighbors joined as new this round are old from now on
+                is_new[start:end] &= ~np.any(
+                    indices[start:end, :, None] == new[start:end, None, :],
+                    axis=2)
+                join_block = join[start:end]
+                X_join = _dense_rows(X, np.maximum(
+                    join_block, 0).ravel()).reshape(
+                        end - start, n_join, -1)
+                D = self._batched_distances(X_join[:, :n_new], X_join)
+                # each new neighbor against later new and all old neighbors
+                u = np.broadcast_to(join_block[:, :n_new, None], D.shape)
+                v = np.broadcast_to(join_block[:, None, :], D.shape)
+                valid = (u >= 0) & (v >= 0) & (u != v) & np.triu(
+                    np.ones((n_new, n_join), dtype=bool), k=1)
+                u, v, D = u[valid], v[valid], D[valid]
+                # only keep pairs that improve a neighbor list
+                closer_u = D < distances[u, -1]
+                closer_v = D < distances[v, -1]
+                candidates.append((np.concatenate([u[closer_u], v[closer_v]]),
+                                   np.concatenate([v[closer_u], u[closer_v]]),
+                                   np.concatenate([D[closer_u], D[closer_v]])))
+                n_candidates += len(candidates[-1][0])
+                # merging touches most rows, so buffer candidates up to the
+                # size of the graph, or of a block if memory is limited
+                if n_candidates >= n_buffer or end == n_samples:
+                    n_updates += self._merge(
+                        indices, distances, is_new,
+                        *[np.concatenate(c) for c in zip(*candidates)])
+                    candidates, n_candidates = [], 0
+            if n_updates <= self.delta * n_samples * n_neighbors:
+                break
+        return distances, indices
+
+    def _search(self, Q, indices, distances):
+        """Refine the neighbors of queries `Q` by walking the search graph
+
+        Each round expands every neighbor found in the previous round,
+        comparing the query to that neighbor's neighbors in the search
+        graph. No fitted sample is compared to the same query twice, and
+        the search stops once a round finds no new neighbors. Updates
+        `indices` and `distances` in place.
+        """
+        n_query, n_neighbors = indices.shape
+        n_samples = self._fit_X.shape[0]
+        n_degree = self._graph.shape[1]
+        # one byte per fitted sample marks those already compared, plus
+        # several copies of the expanded candidates
+        block = self._block_rows(n_samples + 48 * n_neighbors * n_degree)
+        for start in range(0, n_query, block):
+            end = min(start + block, n_query)
+            ind = indices[start:end]
+            dist = distances[start:end]
+            rows = np.arange(end - start)[:, None]
+            visited = np.zeros((end - start, n_samples), dtype=bool)
+            visited[rows, ind] = True
+            new = np.ones(ind.shape, dtype=bool)
+            for _ in range(self.n_iters):
+                if not np.any(new):
+                    break
+                candidates = np.where(new[:, :, None], self._graph[ind],
+                                      -1).reshape(end - start, -1)
+                # drop repeated and already compared candidates
+                candidates = np.sort(candidates, axis=1)
+                candidates[:, 1:][
+                    candidates[:, 1:] == candidates[:, :-1]] = -1
+                unseen = candidates >= 0
+                unseen[unseen] = ~visited[np.nonzero(unseen)[0],
+                                          candidates[unseen]]
+                n_unseen = np.max(np.sum(unseen, axis=1))
+                if n_unseen == 0:
+                    break
+                order = np.argsort(~unseen, axis=1,
+                                   kind='mergesort')[:, :n_unseen]
+                unseen = unseen[rows, order]
+                candidates = np.where(unseen, candidates[rows, order], 0)
+                visited[np.nonzero(unseen)[0], candidates[unseen]] = True
+                cand_dist = self._paired_distances(
+                    Q[start:end], self._fit_X, candidates)
+                cand_dist[~unseen] = np.inf
+                # keep the closest of the current and candidate neighbors
+                merged_ind = np.hstack([ind, candidates])
+                merged_dist = np.hstack([dist, cand_dist])
+                keep = np.argpartition(merged_dist, n_neighbors - 1,
+                                       axis=1)[:, :n_neighbors]
+                keep = keep[rows, np.argsort(merged_dist[rows, keep],
+                                             axis=1)]
+                ind[:] = merged_ind[rows, keep]
+                dist[:] = merged_dist[rows, keep]
+                new = keep >= n_neighbors
+        return distances, indices
+
+    def _search_graph(self, indices, n_reverse):
+        """Append up to `n_reverse` reverse neighbors to each row of `indices`
+
+        Missing reverse neighbors are filled with the row's own index.
+        """
+        random_state = check_random_state(self.random_state)
+        reverse = self._reverse(indices, n_reverse, random_state)
+        reverse = np.where(reverse < 0, np.arange(len(indices))[:, None],
+                           reverse)
+        return np.hstack([indices, reverse])
+
+    def _rp_tree(self, X, leaf_size, random_state):
+        """Random projection tree on the dense data `X`
+
+        Each node is split by the hyperplane halfway between two of its
+        points chosen at random, until no leaf holds more than `leaf_size`
+        points.
+
+        Returns
+        -------
+        tree : `tuple` of (normals, offsets, children, members)
+            Node `i` sends `x` to `children[i, 1]` if
+            `x . normals[i] > offsets[i]`, else to `children[i, 0]`.
+            Leaves have children -1 and hold the rows `members[i]` of `X`,
+            padded with -1.
+
+        labels : array-like, shape=[n_samples]
+            Leaf holding each row of `X`
+        """
+        n_samples, n_features = X.shape
+        labels = np.zeros(n_samples, dtype=np.intp)
+        normals = np.zeros((1, n_features))
+        offsets = np.zeros(1)
+        children = np.full((1, 2), -1, dtype=np.intp)
+        while True:
+            n_nodes = len(offsets)
+            counts = np.bincount(labels, minlength=n_nodes)
+            split = np.flatnonzero(counts > leaf_size)
+            if len(split) == 0:
+                break
+            # two random points of each node to be split
+            order = random_state.permutation(n_samples)
+            order = order[np.argsort(labels[order], kind='mergesort')]
+            first = np.searchsorted(labels[order], split)
+            left, right = X[order[first]], X[order[first + 1]]
+            normals[split] = left - right
+            offsets[split] = np.einsum('ij,ij->i', normals[split],
+                                       (left + right) / 2)
+            children[split] = n_nodes + np.arange(2 * len(split)).reshape(
+                -1, 2)
+            member = np.flatnonzero(counts[labels] > leaf_size)
+            node = labels[member]
+            side = self._rp_side(X, member, normals, offsets, node)
+            # nodes of identical points are split at random
+            n_right = np.bincount(node, weights=side, minlength=n_nodes)
+            degenerate = (n_right == 0) | (n_right == counts)
+            redo = degenerate[node]
+            side[redo] = random_state.randint(2, size=np.sum(redo))
+            labels[member] = children[node, side]
+            normals = np.vstack([normals, np.zeros((2 * len(split),
+                                                    n_features))])
+            offsets = np.concatenate([offsets, np.zeros(2 * len(split))])
+            children = np.vstack([children, np.full(
+                (2 * len(split), 2), -1, dtype=np.intp)])
+        order = np.argsort(labels, kind='mergesort')
+        rank = np.arange(n_samples) - np.searchsorted(labels[order],
+                                                      labels[order])
+        members = np.full((len(offsets), leaf_size), -1, dtype=np.intp)
+        members[labels[order], rank] = order
+        return (normals, offsets, children, members), labels
+
+    def _rp_side(self, X, rows, normals, offsets, node):
+        """Side of the hyperplane of `node` each of `rows` of `X` lies on"""
+        side = np.empty(len(rows), dtype=np.intp)
+        # gathered rows and normals
+        block = self._block_rows(16 * X.shape[1])
+        for start in range(0, len(rows), block):
+            end = min(start + block, len(rows))
+            side[start:end] = np.einsum(
+                'ij,ij->i', X[rows[start:end]],
+                normals[node[start:end]]) > offsets[node[start:end]]
+        return side
+
+    def _rp_leaves(self, tree, Q):
+        """Leaf of `tree` reached by each row of `Q`"""
+        normals, offsets, children, _ = tree
+        node = np.zeros(Q.shape[0], dtype=np.intp)
+        inner = np.flatnonzero(children[node, 0] >= 0)
+        while len(inner) > 0:
+            side = self._rp_side(Q, inner, normals, offsets, node[inner])
+            node[inner] = children[node[inner], side]
+            inner = inner[children[node[inner], 0] >= 0]
+        return node
+
+    def _initialize(self, Q, n_neighbors, seed=None, leaves=None):
+        """Starting neighbors for each row of `Q`
+
+        Candidates are the rows of `seed` if given, and the fitted samples
+        sharing a random projection tree leaf with each row. `leaves` gives
+        the leaf of each row in each tree; if `None`, rows are routed down
+        the trees. Without trees, queries start from the search graph
+        neighborhood of the closest pivot. Remaining slots are filled at
+        random.
+        """
+        random_state = check_random_state(self.random_state)
+        n_query = Q.shape[0]
+        indices = np.empty((n_query, n_neighbors), dtype=np.intp)
+        distances = np.empty((n_query, n_neighbors))
+        n_candidates = 2 * n_neighbors
+        if seed is not None:
+            n_candidates += seed.shape[1]
+        if self._trees:
+            n_candidates += sum(tree[3].shape[1] for tree in self._trees)
+        elif seed is None and hasattr(self, "_pivots"):
+            n_candidates += len(self._pivots) + self._graph.shape[1]
+        # candidates, their distances and sort order
+        block = self._block_rows(40 * n_candidates)
+        for start in range(0, n_query, block):
+            end = min(start + block, n_query)
+            Q_block = Q[start:end]
+            rows = np.arange(end - start)[:, None]
+            candidates = [] if seed is None else [seed[start:end]]
+            if self._trees:
+                if leaves is None:
+                    block_leaves = [self._rp_leaves(tree, Q_block)
+                                    for tree in self._trees]
+                else:
+                    block_leaves = [leaf[start:end] for leaf in leaves]
+                candidates.extend([tree[3][leaf] for tree, leaf in zip(
+                    self._trees, block_leaves)])
+            elif seed is None and hasattr(self, "_pivots"):
+                # search graph neighborhood of the closest pivot
+                D = pairwise_distances(Q_block, self._fit_X[self._pivots],
+                                       metric=self.metric)
+                candidates.append(
+                    self._graph[self._pivots[np.argmin(D, axis=1)]])
+            ind = np.full((end - start, n_neighbors), -1, dtype=np.intp)
+            while np.any(ind < 0):
+                # fill remaining slots at random
+                candidates.append(random_state.randint(
+                    self._fit_X.shape[0], size=ind.shape))
+                candidates = np.sort(np.hstack([ind] + candidates), axis=1)
+                candidates[:, 1:][
+                    candidates[:, 1:] == candidates[:, :-1]] = -1
+                cand_dist = self._paired_distances(
+                    Q_block, self._fit_X, np.maximum(candidates, 0))
+                cand_dist[candidates < 0] = np.inf
+                keep = np.argpartition(cand_dist, n_neighbors - 1,
+                                       axis=1)[:, :n_neighbors]
+                keep = keep[rows, np.argsort(cand_dist[rows, keep], axis=1)]
+                dist = cand_dist[rows, keep]
+                ind = np.where(np.isfinite(dist), candidates[rows, keep], -1)
+                candidates = []
+            indices[start:end] = ind
+            distances[start:end] = dist
+        return distances, indices
+
+    def _leaf_neighbors(self, X, n_neighbors, leaves):
+        """Starting neighbors for each row of the fitted data `X`
+
+        Compares all pairs of rows sharing a leaf of each random projection
+        tree by a batched matrix product. `leaves` gives the leaf of each
+        row in each tree. Rows with fewer than `n_neighbors` candidates are
+        padded with -1.
+        """
+        n_samples = X.shape[0]
+        indices = np.full((n_samples, n_neighbors), -1, dtype=np.intp)
+        distances = np.full((n_samples, n_neighbors), np.inf)
+        for tree, labels in zip(self._trees, leaves):
+            members = tree[3][tree[2][:, 0] < 0]
+            n_members = members.shape[1]
+            valid = members >= 0
+            # position of each row in its leaf
+            slot = np.empty(n_samples, dtype=np.intp)
+            slot[members[valid]] = np.nonzero(valid)[1]
+            # gathered rows, plus distances and candidates of each pair
+            block = self._block_rows(8 * n_members * (
+                X.shape[1] + 3 * (n_members + n_neighbors)))
+            for start in range(0, len(members), block):
+                leaf = members[start:start + block]
+                valid = leaf >= 0
+                X_leaf = X[np.maximum(leaf, 0)]
+                D = self._batched_distances(X_leaf, X_leaf)
+                D[~np.broadcast_to(valid[:, None, :], D.shape)] = np.inf
+                # each row is its own nearest neighbor
+                D[:, np.arange(n_members), np.arange(n_members)] = 0
+                rows = leaf[valid]
+                cand_dist = D[valid]
+                cand_ind = np.broadcast_to(leaf[:, None, :], D.shape)[valid]
+                # current neighbors in the same leaf are candidates again
+                current = indices[rows]
+                same = (current >= 0) & (labels[np.maximum(
+                    current, 0)] == labels[rows][:, None])
+                cand_dist[np.nonzero(same)[0], slot[current[same]]] = np.inf
+                merged_dist = np.hstack([distances[rows], cand_dist])
+                merged_ind = np.hstack([current, cand_ind])
+                keep = np.argpartition(merged_dist, n_neighbors - 1,
+                                       axis=1)[:, :n_neighbors]
+                block_rows = np.arange(len(rows))[:, None]
+                distances[rows] = merged_dist[block_rows, keep]
+                indices[rows] = merged_ind[block_rows, keep]
+        order = np.argsort(distances, axis=1)
+        rows = np.arange(n_samples)[:, None]
+        distances = distances[rows, order]
+        indices = np.where(np.isfinite(distances), indices[rows, order], -1)
+        return distances, indices
+
+    def fit(self, X, y=None):
+        """Build the approximate nearest neighbor graph on `X`
+
+        Parameters
+        ----------
+        X : array-like, shape=[n_samples, n_features]
+
+        Returns
+        -------
+        self
+        """
+        try:
+            self._paired = _PAIRED_METRICS[self.metric]
+        except (KeyError, TypeError):
+            raise ValueError(
+                "Metric {} not supported by NNDescent. Choose from "
+                "{}".format(self.metric, sorted(_PAIRED_METRICS.keys())))
+        if not sparse.issparse(X):
+            X = np.asarray(X)
+        self._fit_X = X
+        n_samples = X.shape[0]
+        n_degree = min(max(self.n_neighbors, self.min_degree), n_samples)
+        self._trees = []
+        if n_degree > n_samples // 2:
+            # descent has no advantage on tiny datasets
+            self.graph_distances_, self.graph_ = self._brute_kneighbors(
+                X, n_degree)
+        else:
+            leaves = []
+            if not sparse.issparse(X):
+                # random projection trees give each point, and later each
+                # query, a starting point close to its neighbors
+                random_state = check_random_state(self.random_state)
+                for _ in range(self.n_trees):
+                    tree, labels = self._rp_tree(
+                        X, max(self.leaf_size, 2 * n_degree), random_state)
+                    self._trees.append(tree)
+                    leaves.append(labels)
+                distances, indices = self._leaf_neighbors(X, n_degree, leaves)
+                # fill rows from small leaves
+                fill = np.flatnonzero(indices[:, -1] < 0)
+                if len(fill) > 0:
+                    distances[fill], indices[fill] = self._initialize(
+                        X[fill], n_degree, seed=indices[fill],
+                        leaves=[leaf[fill] for leaf in leaves])
+            else:
+                distances, indices = self._initialize(
+                    X, n_degree, seed=np.arange(n_samples)[:, None])
+            self.graph_distances_, self.graph_ = self._local_join(
+                X, indices, distances)
+        # duplicates can displace a sample from its own neighbor list
+        missing = np.flatnonzero(~np.any(
+            self.graph_ == np.arange(n_samples)[:, None], axis=1))
+        self.graph_[missing, 1:] = self.graph_[missing, :-1]
+        self.graph_[missing, 0] = missing
+        self.graph_distances_[missing, 1:] = \
+            self.graph_distances_[missing, :-1]
+        self.graph_distances_[missing, 0] = 0
+        self._graph = self._search_graph(self.graph_, n_degree)
+        if not self._trees:
+            # pivots give queries a starting point close to their neighbors
+            random_state = check_random_state(self.random_state)
+            self._pivots = random_state.choice(
+                n_samples, int(np.ceil(np.sqrt(n_samples))), replace=False)
+        return self
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """Find the approximate nearest neighbors of each row of `X`
+
+        Parameters
+        ----------
+        X : array-like, shape=[n_queries, n_features]
+
+        n_neighbors : `int` or `None`, optional (default: `None`)
+            If `None`, defaults to `self.n_neighbors`
+
+        return_distance : `bool`, optional (default: `True`)
+
+        Returns
+        -------
+        distances : array-like, shape=[n_queries, n_neighbors]
+            Only returned if `return_distance` is `True`
+
+        indices : array-like, shape=[n_queries, n_neighbors]
+            Sorted by increasing distance
+        """
+        if n_neighbors is None:
+            n_neighbors = self.n_neighbors
+        n_samples, n_degree = self.graph_.shape
+        if n_neighbors > n_samples:
+            raise ValueError(
+                "Expected n_neighbors <= n_samples, but n_samples = {}, "
+                "n_neighbors = {}".format(n_samples, n_neighbors))
+        if X is self._fit_X and n_neighbors <= n_degree:
+            distances = self.graph_distances_[:, :n_neighbors].copy()
+            indices = self.graph_[:, :n_neighbors].copy()
+        elif n_neighbors > n_samples // 2:
+            distances, indices = self._brute_kneighbors(X, n_neighbors)
+        else:
+            seed = self.graph_ if X is self._fit_X else None
+            # search with at least as many neighbors as the graph holds
+            distances, indices = self._initialize(
+                X, max(n_neighbors, n_degree), seed=seed)
+            distances, indices = self._search(X, indices, distances)
+            distances = distances[:, :n_neighbors]
+            indices = indices[:, :n_neighbors]
+        if return_distance:
+            return distances, indices
+        else:
+            return indices
+
+    def kneighbors_graph(self, X, n_neighbors=None, mode='connectivity'):
+        """Sparse graph of the approximate nearest neighbors of `X`
+
+        Parameters
+        ----------
+        X : array-like, shape=[n_queries, n_features]
+
+        n_neighbors : `int` or `None`, optional (default: `None`)
+            If `None`, defaults to `self.n_neighbors`
+
+        mode : {'connectivity', 'distance'}, optional (default: 'connectivity')
+            Type of returned matrix
+
+        Returns
+        -------
+        A : `scipy.sparse.csr_matrix`, shape=[n_queries, n_samples]
+        """
+        if n_neighbors is None:
+            n_neighbors = self.n_neighbors
+        distances, indices = self.kneighbors(X, n_neighbors=n_neighbors)
+        if mode == 'connectivity':
+            data = np.ones(indices.size)
+        elif mode == 'distance':
+            data = distances.ravel()
+        else:
+            raise ValueError("mode '{}' not recognized. Choose from "
+                             "['connectivity', 'distance']".format(mode))
+        indptr = np.arange(0, indices.size + 1, n_neighbors)
+        return sparse.csr_matrix((data, indices.ravel(), indptr),
+                                 shape=(X.shape[0], self._fit_X.shape[0]))
+
+    def radius_neighbors(self, X, radius, return_distance=True):
+        """Find all fitted samples within `radius` of each row of `X`
+
+        Radius queries are answered exactly by a blocked brute force search.
+
+        Parameters
+        ----------
+        X : array-like, shape=[n_queries, n_features]
+
+        radius : `float`
+
+        return_distance : `bool`, optional (default: `True`)
+
+        Returns
+        -------
+        distances : array of arrays, shape=[n_queries]
+            Only returned if `return_distance` is `True`
+
+        indices : array of arrays, shape=[n_queries]
+        """
+        distances = np.empty(X.shape[0], dtype=object)
+        indices = np.empty(X.shape[0], dtype=object)
+        block = self._block_rows(32 * self._fit_X.shape[0])
+        for start in range(0, X.shape[0], block):
+            end = min(start + block, X.shape[0])
+            D = pairwise_distances(X[start:end], self._fit_X,
+                                   metric=self.metric)
+            for i, d in enumerate(D):
+                ind = np.argwhere(d <= radius).reshape(-1)
+                indices[start + i] = ind
+                distances[start + i] = d[ind]
+        if return_distance:
+            return distances, indices
+        else:
+            return indices
+
+
+class GEMMNeighbors(BaseEstimator):
+    """Exact nearest neighbors by blocked matrix multiplication
+
+    Computes euclidean or cosine distances between tiles of queries and
+    fitted samples with a single matrix product per tile, keeping a running
+    top-k per query. The tile size is chosen so that the working set fits in
+    `max_memory`, so memory use does not grow with the number of fitted
+    samples.
+
+    Parameters
+    ----------
+
+    n_neighbors : `int`, optional (default: 5)
+        Default number of neighbors to return
+
+    metric : {'euclidean', 'sqeuclidean', 'cosine'}, optional
+        (default: 'euclidean')
+
+    max_memory : `int` or `None`, optional (default: 2**28)
+        Approximate memory budget for a single tile, in bytes. If `None`,
+        uses 2**28.
+
+    n_jobs : `int`, optional (default: 1)
+        Ignored. Parallelism comes from the BLAS library. Accepted for
+        compatibility with `sklearn.neighbors.NearestNeighbors`.
+
+    random_state : ignored
+    """
+
+    _metrics = ['euclidean', 'l2', 'sqeuclidean', 'cosine']
+
+    def __init__(self, n_neighbors=5, metric='euclidean', max_memory=2**28,
+                 n_jobs=1, random_state=None):
+        self.n_neighbors = n_neighbors
+        self.metric = metric
+        self.max_memory = max_memory
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        super().__init__()
+
+    def _prepare(self, X):
+        """Normalize rows for cosine distance and compute squared norms
+
+        `X` keeps its floating point dtype; the squared norms are
+        accumulated in double precision.
+        """
+        if not sparse.issparse(X):
+            X = np.asarray(X)
+            if X.dtype.kind != 'f':
+                X = X.astype(np.float64)
+        if self.metric == 'cosine':
+            norms = np.sqrt(self._sq_norms(X))
+            norms[norms == 0] = 1
+            if sparse.issparse(X):
+                X = sparse.diags((1 / norms).astype(X.dtype)).dot(X).tocsr()
+            else:
+                X = X * (1 / norms).astype(X.dtype)[:, None]
+        return X, self._sq_norms(X)
+
+    @staticmethod
+    def _sq_norms(X):
+        if sparse.issparse(X):
+            return np.asarray(X.multiply(X).sum(
+                axis=1, dtype=np.float64)).ravel()
+        return np.einsum('ij,ij->i', X, X, dtype=np.float64)
+
+    def fit(self, X, y=None):
+        """Store the data to be searched
+
+        Parameters
+        ----------
+        X : array-like, shape=[n_samples, n_features]
+
+        Returns
+        -------
+        self
+        """
+        if self.metric not in self._metrics:
+            raise ValueError(
+                "Metric {} not supported by GEMMNeighbors. Choose from "
+                "{}".format(self.metric, self._metrics))
+        if not sparse.issparse(X):
+            X = np.asarray(X)
+        # single precision data are searched in single precision
+        self._fit_data, self._fit_norms = self._prepare(X)
+        self._fit_X = X
+        return self
+
+    def _tiles(self, n_neighbors):
+        """Number of query rows and fitted rows per tile"""
+        n_samples = self._fit_X.shape[0]
+        max_memory = self.max_memory
+        if max_memory is None:
+            max_memory = 2**28
+        # distance tile, candidate buffer and partition indices: ~3 copies
+        # of [n_query, n_reference + n_neighbors] 8-byte values
+        n_reference = min(n_samples, max(
+            n_neighbors, max_memory // (24 * 64)))
+        n_query = max(1, max_memory // (24 * (n_reference + n_neighbors)))
+        return n_query, n_reference
+
+    def _sq_distances(self, Q, start, end, Q_norms=None):
+        """Squared distances from `Q` to fitted samples `start:end`
+
+        If `Q_norms` is `None`, the squared query norms are left out. The
+        result is then only valid for ranking neighbors. The product runs in
+        the dtype of the fitted data.
+        """
+        D = safe_sparse_dot(Q, self._fit_data[start:end].T,
+                            dense_output=True)
+        D *= -2
+        D += self._fit_norms[start:end]
+        if Q_norms is not None:
+            D += Q_norms[:, None]
+            np.maximum(D, 0, out=D)
+        return D
+
+    def _to_metric(self, sq_distances):
+        if self.metric == 'sqeuclidean':
+            return sq_distances
+        elif self.metric == 'cosine':
+            # for unit vectors, |x - y|^2 = 2 - 2 x.y
+            return sq_distances / 2
+        else:
+            return np.sqrt(sq_distances)
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """Find the nearest neighbors of each row of `X`
+
+        Parameters
+        ----------
+        X : array-like, shape=[n_queries, n_features]
+
+        n_neighbors : `int` or `None`, optional (default: `None`)
+            If `None`, defaults to `self.n_neighbors`
+
+        return_distance : `bool`, optional (default: `True`)
+
+        Returns
+        -------
+        distances : array-like, shape=[n_queries, n_neighbors]
+            Only returned if `return_distance` is `True`
+
+        indices : array-like, shape=[n_queries, n_neighbors]
+            Sorted by increasing distance
+        """
+        if n_neighbors is None:
+            n_neighbors = self.n_neighbors
+        n_samples = self._fit_X.shape[0]
+        if n_neighbors > n_samples:
+            raise ValueError(
+                "Expected n_neighbors <= n_samples, but n_samples = {}, "
+                "n_neighbors = {}".format(n_samples, n_neighbors))
+        Q, Q_norms = self._prepare(X)
+        dtype = self._fit_data.dtype
+        Q = Q.astype(dtype, copy=False)
+        # in single precision, small distances are lost to cancellation
+        refine = dtype != np.float64 and not sparse.issparse(Q)
+        n_query, n_reference = self._tiles(n_neighbors)
+        distances = np.empty((X.shape[0], n_neighbors), dtype=np.float64)
+        indices = np.empty((X.shape[0], n_neighbors), dtype=np.intp)
+        for q_start in range(0, X.shape[0], n_query):
+            q_end = min(q_start + n_query, X.shape[0])
+            rows = np.arange(q_end - q_start)[:, None]
+            best_dist = np.empty((q_end - q_start, 0), dtype=dtype)
+            best_ind = np.empty((q_end - q_start, 0), dtype=np.intp)
+            for r_start in range(0, n_samples, n_reference):
+                r_end = min(r_start + n_reference, n_samples)
+                # the query norm does not change the ranking
+                D = self._sq_distances(Q[q_start:q_end], r_start, r_end)
+                cand_dist = np.hstack([best_dist, D])
+                cand_ind = np.hstack([
+                    best_ind, np.broadcast_to(np.arange(r_start, r_end),
+                                              D.shape)])
+                if cand_dist.shape[1] > n_neighbors:
+                    keep = np.argpartition(cand_dist, n_neighbors - 1,
+                                           axis=1)[:, :n_neighbors]
+                    cand_dist = cand_dist[rows, keep]
+                    cand_ind = cand_ind[rows, keep]
+                best_dist, best_ind = cand_dist, cand_ind
+            if refine:
+                # recompute the distances of the selected neighbors from
+                # their differences in double precision
+                diff = self._fit_data[best_ind].astype(np.float64)
+                diff -= Q[q_start:q_end, None, :]
+                best_dist = np.einsum('ijk,ijk->ij', diff, diff)
+                del diff
+            else:
+                best_dist = best_dist + Q_norms[q_start:q_end, None]
+            order = np.argsort(best_dist, axis=1)
+            indices[q_start:q_end] = best_ind[rows, order]
+            distances[q_start:q_end] = np.maximum(
+                best_dist[rows, order], 0)
+        distances = self._to_metric(distances)
+        if return_distance:
+            return distances, indices
+        else:
+            return indices
+
+    def radius_neighbors(self, X, radius, return_distance=True):
+        """Find all fitted samples within `radius` of each row of `X`
+
+        Parameters
+        ----------
+        X : array-like, shape=[n_queries, n_features]
+
+        radius : `float`
+
+        return_distance : `bool`, optional (default: `True`)
+
+        Returns
+        -------
+        distances : array of arrays, shape=[n_queries]
+            Only returned if `return_distance` is `True`
+
+        indices : array of arrays, shape=[n_queries]
+        """
+        Q, Q_norms = self._prepare(X)
+        Q = Q.astype(self._fit_data.dtype, copy=False)
+        n_samples = self._fit_X.shape[0]
+        n_query, n_reference = self._tiles(0)
+        distances = np.empty(X.shape[0], dtype=object)
+        indices = np.empty(X.shape[0], dtype=object)
+        for q_start in range(0, X.shape[0], n_query):
+            q_end = min(q_start + n_query, X.shape[0])
+            row_dist = [[] for _ in range(q_end - q_start)]
+            row_ind = [[] for _ in range(q_end - q_start)]
+            for r_start in range(0, n_samples, n_reference):
+                r_end = min(r_start + n_reference, n_samples)
+                D = self._to_metric(self._sq_distances(
+                    Q[q_start:q_end], r_start, r_end,
+                    Q_norms=Q_norms[q_start:q_end]))
+                row, col = np.nonzero(D <= radius)
+                split = np.searchsorted(row, np.arange(1, q_end - q_start))
+                for i, (d, c) in enumerate(zip(
+                        np.split(D[row, col], split),
+                        np.split(col + r_start, split))):
+                    row_dist[i].append(d)
+                    row_ind[i].append(c)
+            for i in range(q_end - q_start):
+                distances[q_start + i] = np.concatenate(row_dist[i])
+                indices[q_start + i] = np.concatenate(row_ind[i])
+        if return_distance:
+            return distances, indices
+        else:
+            return indices
+
+
+# smallest dataset on which building a tree pays off
+_TREE_MIN_SAMPLES = 1000
+# dimensionality above which space partitioning trees stop pruning
+_KD_TREE_MAX_FEATURES = 15
+_BALL_TREE_MAX_FEATURES = 30
+
+_BACKENDS = {}
+
+
+def register_backend(name, backend):
+    """Register a nearest neighbor search backend
+
+    Parameters
+    ----------
+    name : `str`
+        Name used to select the backend, e.g. `knn_method=name`
+
+    backend : callable
+        Called as `backend(n_neighbors=n_neighbors, metric=metric,
+        n_jobs=n_jobs, random_state=random_state, **params)`. Must return an
+        unfitted estimator implementing `fit(X)`,
+        `kneighbors(X, n_neighbors)` and `radius_neighbors(X, radius)` with
+        the semantics of `sklearn.neighbors.NearestNeighbors`. If the graph
+        sets `max_memory`, `params` include `max_memory`, the memory budget
+        of a single query call in bytes. If the fitted estimator has
+        attributes `graph_` and `graph_distances_` holding the sorted
+        neighbors of each fitted sample, including itself, graphs use them
+        for the kernel on the fitted data rather than searching again.
+    """
+    if name == 'auto':
+        raise ValueError("'auto' is reserved for automatic backend selection")
+    _BACKENDS[name] = backend
+
+
+def available_backends():
+    """List the names of all registered nearest neighbor backends
+    """
+    return sorted(_BACKENDS.keys())
+
+
+def get_backend(name):
+    """Get a registered nearest neighbor backend by name
+
+    Raises
+    ------
+    ValueError : if no backend is registered under `name`
+    """
+    try:
+        return _BACKENDS[name]
+    except KeyError:
+        raise ValueError("knn_method '{}' not recognized. Choose from "
+                         "{}".format(name, ['auto'] + available_backends()))
+
+
+def select_backend(n_samples, n_features, metric='euclidean',
+                   n_neighbors=5, is_sparse=False):
+    """Pick the exact nearest neighbor backend that is cheapest to query
+
+    Brute force computes every distance, but at matrix multiplication speed
+    (`GEMMNeighbors` for euclidean and cosine distance on dense data).
+    Trees prune most distance computations, but only in low dimensions and
+    only once the dataset is large enough to amortize their construction.
+
+    Parameters
+    ----------
+    n_samples : `int`
+        Number of samples to be indexed
+
+    n_features : `int`
+        Dimensionality of the data
+
+    metric : `str` or callable, optional (default: `'euclidean'`)
+
+    n_neighbors : `int`, optional (default: 5)
+        Number of neighbors to be queried
+
+    is_sparse : `bool`, optional (default: `False`)
+        Whether the data is a sparse matrix
+
+    Returns
+    -------
+    name : `str`
+        Name of a registered backend
+    """
+    if not is_sparse and metric in VALID_METRICS['ball_tree'] and \
+            n_samples >= _TREE_MIN_SAMPLES and n_neighbors < n_samples // 2:
+        if n_features <= _KD_TREE_MAX_FEATURES and \
+                metric in VALID_METRICS['kd_tree']:
+            return 'kd_tree'
+        elif n_features <= _BALL_TREE_MAX_FEATURES:
+            return 'ball_tree'
+    # no tree can prune the search: compute all distances
+    if not is_sparse and metric in GEMMNeighbors._metrics:
+        return 'gemm'
+    else:
+        return 'brute'
+
+
+def build_knn_tree(data, n_neighbors=5, metric='euclidean', method='auto',
+                   n_jobs=1, random_state=None, max_memory=None, **params):
+    """Fit a nearest neighbor search backend on `data`
+
+    Parameters
+    ----------
+    data : array-like, shape=[n_samples, n_features]
+
+    n_neighbors : `int`, optional (default: 5)
+        Default number of neighbors to query
+
+    metric : `str` or callable, optional (default: `'euclidean'`)
+
+    method : `str`, optional (default: `'auto'`)
+        Name of a registered backend. If `'auto'`, chosen by
+        `select_backend`.
+
+    n_jobs : `int`, optional (default: 1)
+
+    random_state : `int` or `None`, optional (default: `None`)
+
+    max_memory : `int` or `None`, optional (default: `None`)
+        Memory budget of a single query, in bytes. Passed to the backend
+        unless `params` set their own `max_memory`.
+
+    **params : extra arguments for the backend
+
+    Returns
+    -------
+    knn_tree : fitted nearest neighbor search estimator
+    """
+    if method == 'auto':
+        method = select_backend(data.shape[0], data.shape[1],
+                                metric=metric, n_neighbors=n_neighbors,
+                                is_sparse=sparse.issparse(data))
+    backend = get_backend(method)
+    if max_memory is not None and 'max_memory' not in params:
+        params = dict(params, max_memory=max_memory)
+    return backend(n_neighbors=n_neighbors, metric=metric, n_jobs=n_jobs,
+                   random_state=random_state, **params).fit(data)
+
+
+def neighbor_lists(neighbors, n_samples):
+    """Convert precomputed nearest neighbors to flat neighbor lists
+
+    Parameters
+    ----------
+    neighbors : `tuple` of array-like or `scipy.sparse.spmatrix`
+        Either `(indices, distances)`, each of shape [n_samples, k], as
+        returned by `kneighbors` (including each sample itself), or a
+        sparse matrix of shape [n_samples, n_samples] holding the distances
+        from each sample to its nearest neighbors. Self-distances are
+        implicitly zero in the sparse matrix.
+
+    n_samples : `int`
+        Number of samples the neighbors were computed on
+
+    Returns
+    -------
+    distances : `np.ndarray`, shape=[n_neighbors_total]
+
+    indices : `np.ndarray`, shape=[n_neighbors_total]
+
+    indptr : `np.ndarray`, shape=[n_samples + 1]
+        Neighbors of sample `i` are `indices[indptr[i]:indptr[i + 1]]`,
+        sorted by increasing distance
+
+    Raises
+    ------
+    ValueError : if the neighbors do not match `n_samples`
+    """
+    if sparse.issparse(neighbors):
+        if neighbors.shape != (n_samples, n_samples):
+            raise ValueError(
+                "Precomputed neighbors matrix of shape {} does not match "
+                "data with {} samples. Expected shape {}".format(
+                    neighbors.shape, n_samples, (n_samples, n_samples)))
+        neighbors = neighbors.tocoo()
+        keep = neighbors.row != neighbors.col
+        self_idx = np.arange(n_samples)
+        rows = np.concatenate([neighbors.row[keep], self_idx])
+        indices = np.concatenate([neighbors.col[keep], self_idx])
+        distances = np.concatenate([neighbors.data[keep],
+                                    np.zeros(n_samples)])
+    else:
+        try:
+            indices, distances = neighbors
+        except (TypeError, ValueError):
+            raise ValueError(
+                "Expected precomputed neighbors as a tuple "
+                "`(indices, distances)` or a sparse matrix. "
+                "Got {}".format(type(neighbors).__name__))
+        indices = np.asarray(indices)
+        distances = np.asarray(distances)
+        if indices.ndim != 2 or indices.shape[0] != n_samples or \
+                distances.shape != indices.shape:
+            raise ValueError(
+                "Precomputed neighbor indices of shape {} and distances of "
+                "shape {} do not match data with {} samples. Expected "
+                "arrays of shape [{}, k]".format(
+                    indices.shape, distances.shape, n_samples, n_samples))
+        if not np.all(np.any(
+                indices == np.arange(n_samples)[:, None], axis=1)):
+            raise ValueError(
+                "Precomputed neighbors must include each sample as its own "
+                "nearest neighbor, as returned by `kneighbors`")
+        rows = np.repeat(np.arange(n_samples), indices.shape[1])
+        indices = indices.ravel()
+        distances = distances.ravel()
+    order = np.lexsort((distances, rows))
+    indptr = np.zeros(n_samples + 1, dtype=np.intp)
+    np.cumsum(np.bincount(rows, minlength=n_samples), out=indptr[1:])
+    return (distances[order].astype(np.float64, copy=False),
+            indices[order].astype(np.intp, copy=False), indptr)
+
+
+class _BoundedNearestNeighbors(NearestNeighbors):
+    """`sklearn.neighbors.NearestNeighbors` with a memory budget
+
+    Brute force searches compute distances in chunks of about `max_memory`
+    bytes, through scikit-learn's `working_memory` setting.
+    """
+
+    def __init__(self, n_neighbors=5, radius=1.0, algorithm='auto',
+                 leaf_size=30, metric='minkowski', p=2, metric_params=None,
+                 n_jobs=None, max_memory=None):
+        super().__init__(n_neighbors=n_neighbors, radius=radius,
+                         algorithm=algorithm, leaf_size=leaf_size,
+                         metric=metric, p=p, metric_params=metric_params,
+                         n_jobs=n_jobs)
+        self.max_memory = max_memory
+
+    def _working_memory(self):
+        if self.max_memory is None or 'working_memory' not in get_config():
+            # scikit-learn < 0.20 does not chunk distance computations
+            return config_context()
+        # a chunk holds distances and their partition for at least one row
+        chunk_bytes = max(self.max_memory // 4, 8 * self._fit_X.shape[0])
+        return config_context(working_memory=float(chunk_bytes) / 2**20)
+
+    def kneighbors(self, X=None, n_neighbors=None, return_distance=True):
+        with self._working_memory():
+            return super().kneighbors(X, n_neighbors=n_neighbors,
+                                      return_distance=return_distance)
+
+    def radius_neighbors(self, X=None, radius=None, return_distance=True,
+                         **kwargs):
+        with self._working_memory():
+            return super().radius_neighbors(
+                X, radius=radius, return_distance=return_distance, **kwargs)
+
+
+def _sklearn_backend(algorithm):
+    def backend(n_neighbors=5, metric='euclidean', n_jobs=1,
+                random_state=None, **params):
+        return _BoundedNearestNeighbors(n_neighbors=n_neighbors,
+                                        algorithm=algorithm, metric=metric,
+                                        n_jobs=n_jobs, **params)
+    return backend
+
+
+for _algorithm in ['ball_tree', 'kd_tree', 'brute']:
+    register_backend(_algorithm, _sklearn_backend(_algorithm))
+register_backend('gemm', GEMMNeighbors)
+register_backend('nndescent', NNDescent)
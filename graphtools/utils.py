@@ -44,3 +44,307 @@ def set_diagonal(X, diag):
 def set_submatrix(X, i, j, values):
     X[np.ix_(i, j)] = values
     return X
+
+
+def assemble_blocks(blocks, shape, dtype=None):
+    """Assemble a CSR matrix from blocks placed at given rows and columns
+
+    Equivalent to writing each block into a `lil_matrix` with
+    `set_submatrix`, but concatenates the COO triplets of all blocks with
+    global indices and converts them to CSR in a single step.
+
+    Parameters
+    ----------
+    blocks : list of `(rows, cols, values)` tuples
+        `values` is a dense or sparse matrix of shape
+        `[len(rows), len(cols)]` holding the entries of the output at
+        integer indices `rows` and `cols`. Blocks must not overlap.
+
+    shape : `tuple` of `int`
+        Shape of the output
+
+    dtype : `numpy.dtype` or `None`, optional (default: `None`)
+        Data type of the output. If `None`, inferred from the blocks
+
+    Returns
+    -------
+    K : `scipy.sparse.csr_matrix`
+    """
+    data, row, col = [], [], []
+    for rows, cols, values in blocks:
+        values = sparse.coo_matrix(values)
+        data.append(values.data)
+        row.append(np.asarray(rows)[values.row])
+        col.append(np.asarray(cols)[values.col])
+    K = sparse.csr_matrix(
+        (np.concatenate(data), (np.concatenate(row), np.concatenate(col))),
+        shape=shape, dtype=dtype)
+    K.eliminate_zeros()
+    return K
+
+
+def ragged_ranges(starts, lengths):
+    """Flat indices of the ranges `[starts[i], starts[i] + lengths[i])`
+
+    Vectorized equivalent of
+    `np.concatenate([np.arange(s, s + l) for s, l in zip(starts, lengths)])`
+    """
+    lengths = np.asarray(lengths, dtype=np.intp)
+    offsets = np.arange(np.sum(lengths), dtype=np.intp) - \
+        np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(np.asarray(starts, dtype=np.intp), lengths) + offsets
+
+
+def gather_ragged(blocks, row_block, row_pos):
+    """Assemble ragged rows from several blocks into flat CSR buffers
+
+    Parameters
+    ----------
+    blocks : list of `(data, indices, indptr)` tuples
+        Flat ragged buffers, one row per entry of `indptr[1:]`
+
+    row_block : array-like, shape=[n_rows]
+        Block holding each output row
+
+    row_pos : array-like, shape=[n_rows]
+        Position of each output row within its block
+
+    Returns
+    -------
+    data, indices, indptr : CSR buffers of the output rows
+    """
+    if len(blocks) == 1 and np.all(row_pos == np.arange(len(row_pos))):
+        # nothing to gather
+        return blocks[0]
+    lengths = np.zeros(len(row_block), dtype=np.intp)
+    block_rows = []
+    for b, (_, _, block_indptr) in enumerate(blocks):
+        rows = np.flatnonzero(row_block == b)
+        lengths[rows] = np.diff(block_indptr)[row_pos[rows]]
+        block_rows.append(rows)
+    indptr = np.zeros(len(row_block) + 1, dtype=np.intp)
+    np.cumsum(lengths, out=indptr[1:])
+    data = np.empty(indptr[-1], dtype=blocks[0][0].dtype)
+    indices = np.empty(indptr[-1], dtype=blocks[0][1].dtype)
+    for (block_data, block_indices, block_indptr), rows in zip(
+            blocks, block_rows):
+        src = ragged_ranges(block_indptr[row_pos[rows]], lengths[rows])
+        dst = ragged_ranges(indptr[rows], lengths[rows])
+        data[dst] = block_data[src]
+        indices[dst] = block_indices[src]
+    return data, indices, indptr
+
+
+def geometric_buckets(values, ratio=1.25):
+    """Group positive values so that within each group max <= ratio * min
+
+    Parameters
+    ----------
+    values : array-like, shape=[n]
+        Positive values
+
+    ratio : `float`, optional (default: 1.25)
+        Maximum ratio between the largest and smallest value of a group
+
+    Returns
+    -------
+    buckets : list of array-like
+        Indices into `values` for each group, from smallest to largest
+    """
+    values = np.asarray(values)
+    bucket = np.floor(np.log(values / np.min(values)) /
+                      np.log(ratio)).astype(np.intp)
+    order = np.argsort(bucket, kind='mergesort')
+    return np.split(order, np.flatnonzero(np.diff(bucket[order])) + 1)
+
+
+def threshold_csr(K, thresh):
+    """Drop all entries of a sparse matrix below `thresh`
+
+    Returns a canonical CSR matrix (sorted indices, no duplicates or
+    explicit zeros below `thresh`) built in a single pass over the data.
+    `thresh` may also be an array with one threshold per stored entry of
+    `K`, if `K` is already a CSR matrix without duplicates.
+    """
+    K = K.tocsr()
+    K.sum_duplicates()
+    keep = ~(K.data < thresh)
+    kept = np.zeros(len(keep) + 1, dtype=np.intp)
+    np.cumsum(keep, out=kept[1:])
+    K = sparse.csr_matrix((K.data[keep], K.indices[keep], kept[K.indptr]),
+                          shape=K.shape)
+    K.has_sorted_indices = True
+    return K
+
+
+def alpha_decay_csr(distances, indices, indptr, bandwidth, decay, thresh,
+                    shape, block_size=2**22):
+    """Build a thresholded alpha decay kernel as a canonical CSR matrix
+
+    Computes `exp(-(distances / bandwidth) ** decay)` row by row from flat
+    neighbor buffers, maps NaN to 1 and drops affinities below `thresh` in
+    a single blocked pass. `distances` and `indices` are overwritten and
+    compacted in place, so no full-size temporaries are created.
+
+    Parameters
+    ----------
+    distances, indices, indptr : array-like
+        Flat CSR-style neighbor buffers. Rows need not be sorted.
+
+    bandwidth : array-like, shape=[n_rows]
+        Kernel bandwidth of each row
+
+    decay : `float`
+        Rate of alpha decay
+
+    thresh : `float`
+        Affinities below `thresh` are dropped
+
+    shape : `tuple`
+        Shape of the output matrix
+
+    block_size : `int`, optional (default: 2**22)
+        Approximate number of entries processed at once
+
+    Returns
+    -------
+    K : `scipy.sparse.csr_matrix` with sorted indices
+    """
+    n_rows = len(indptr) - 1
+    kernel_indptr = np.zeros(n_rows + 1, dtype=np.intp)
+    n_kept = 0
+    row_start = 0
+    while row_start < n_rows:
+        row_end = np.searchsorted(indptr, indptr[row_start] + block_size,
+                                  side='right') - 1
+        row_end = min(max(row_end, row_start + 1), n_rows)
+        start, end = indptr[row_start], indptr[row_end]
+        rows = np.repeat(np.arange(row_end - row_start),
+                         np.diff(indptr[row_start:row_end + 1]))
+        K = distances[start:end]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            K /= bandwidth[row_start:row_end][rows]
+        np.power(K, decay, out=K)
+        np.negative(K, out=K)
+        np.exp(K, out=K)
+        # handle nan
+        K[np.isnan(K)] = 1
+        # kept entries, ordered by row then column
+        order = np.lexsort((indices[start:end], rows))
+        order = order[K[order] >= thresh]
+        n_block = len(order)
+        distances[n_kept:n_kept + n_block] = K[order]
+        indices[n_kept:n_kept + n_block] = indices[start:end][order]
+        np.cumsum(np.bincount(rows[order], minlength=row_end - row_start),
+                  out=kernel_indptr[row_start + 1:row_end + 1])
+        kernel_indptr[row_start + 1:row_end + 1] += n_kept
+        n_kept += n_block
+        row_start = row_end
+    K = sparse.csr_matrix((distances[:n_kept].copy(),
+                           indices[:n_kept].copy(),
+                           kernel_indptr),
+                          shape=shape)
+    K.has_sorted_indices = True
+    return K
+
+
+def _row_values(data, idx):
+    """Dense float64 copy of rows `idx` with signed zeros merged"""
+    rows = data[idx]
+    if sparse.issparse(rows):
+        rows = rows.toarray()
+    return np.array(rows, dtype=np.float64) + 0.0
+
+
+def find_duplicates(data, block_size=2**20):
+    """Find groups of identical rows
+
+    Rows are hashed block by block, sorted by hash and only rows sharing a
+    hash are compared exactly, so memory use is bounded by `block_size`
+    in addition to a few arrays of length `n_samples`.
+
+    Parameters
+    ----------
+    data : array-like, shape=[n_samples, n_features]
+        Dense or sparse input data
+
+    block_size : `int`, optional (default: 2**20)
+        Approximate number of matrix entries processed at once
+
+    Returns
+    -------
+    groups : list of `np.ndarray`
+        Sorted indices of each group of two or more identical rows,
+        ordered by their first index
+    """
+    n_samples, n_features = data.shape
+    block_rows = max(1, block_size // max(n_features, 1))
+    multipliers = np.random.RandomState(42).randint(
+        1, 2**62, n_features).astype(np.uint64) | np.uint64(1)
+    hashes = np.empty(n_samples, dtype=np.uint64)
+    for start in range(0, n_samples, block_rows):
+        end = min(start + block_rows, n_samples)
+        bits = _row_values(data, slice(start, end)).view(np.uint64)
+        bits ^= bits >> np.uint64(31)
+        bits *= multipliers
+        hashes[start:end] = bits.sum(axis=1)
+    order = np.argsort(hashes, kind='mergesort')
+    hashes = hashes[order]
+    same = hashes[1:] == hashes[:-1]
+    if not np.any(same):
+        return []
+    runs = np.concatenate([[0], np.cumsum(~same)])
+    in_run = np.zeros(n_samples, dtype=bool)
+    in_run[1:] |= same
+    in_run[:-1] |= same
+    candidates, runs = order[in_run], runs[in_run]
+    labels = np.full(n_samples, -1, dtype=np.intp)
+    while len(candidates) > 0:
+        # compare each candidate to the first remaining member of its run
+        first = np.concatenate([[True], runs[1:] != runs[:-1]])
+        leaders = candidates[first][np.cumsum(first) - 1]
+        equal = np.zeros(len(candidates), dtype=bool)
+        for start in range(0, len(candidates), block_rows):
+            end = min(start + block_rows, len(candidates))
+            equal[start:end] = np.all(
+                _row_values(data, candidates[start:end]) ==
+                _row_values(data, leaders[start:end]), axis=1)
+        labels[candidates[equal]] = leaders[equal]
+        # hash collisions are compared again among themselves
+        remaining = ~(equal | first)
+        candidates, runs = candidates[remaining], runs[remaining]
+        _, inverse, counts = np.unique(runs, return_inverse=True,
+                                       return_counts=True)
+        remaining = counts[inverse] > 1
+        candidates, runs = candidates[remaining], runs[remaining]
+    idx = np.flatnonzero(labels >= 0)
+    idx = idx[np.lexsort((idx, labels[idx]))]
+    groups = np.split(idx, np.flatnonzero(np.diff(labels[idx])) + 1)
+    return [group for group in groups if len(group) > 1]
+
+
+def has_negative(X, block_size=2**24):
+    """Check a matrix for negative entries
+
+    Dense matrices are checked block by block of rows, so that
+    memory-mapped matrices are never loaded into memory at once.
+
+    Parameters
+    ----------
+    X : array-like, shape=[n_samples, n_features]
+        Dense, sparse or memory-mapped matrix
+
+    block_size : `int`, optional (default: 2**24)
+        Approximate number of entries checked at once
+
+    Returns
+    -------
+    has_negative : `bool`
+    """
+    if sparse.issparse(X):
+        return bool(np.any(X.tocoo().data < 0))
+    block_rows = max(1, block_size // max(X.shape[1], 1))
+    for start in range(0, X.shape[0], block_rows):
+        if np.any(np.asarray(X[start:start + block_rows]) < 0):
+            return True
+    return False
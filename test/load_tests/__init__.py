@@ -1,5 +1,6 @@
-from sklearn.decomposition import PCA, TruncatedSVD
+from sklearn.decomposition import PCA, TruncatedSVD, IncrementalPCA
 from sklearn import datasets
+from sklearn.neighbors import NearestNeighbors
 from scipy.spatial.distance import pdist, cdist, squareform
 import pygsp
 import graphtools
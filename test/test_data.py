@@ -11,6 +11,7 @@ from load_tests import (
     warns,
     squareform,
     pdist,
+    IncrementalPCA,
 )
 import warnings
 
@@ -33,6 +34,11 @@ def test_1d_data():
     build_graph(data[:, 0])
 
 
+@raises(ValueError)
+def test_invalid_dtype():
+    build_graph(data, dtype=int)
+
+
 @raises(ValueError)
 def test_3d_data():
     build_graph(data[:, :, None])
@@ -185,6 +191,23 @@ def test_inverse_transform_sparse_no_pca():
                   sp.csr_matrix(G.data)[:, :15])
 
 
+def test_incremental_pca_max_memory():
+    G = build_graph(data, n_pca=20, thresh=1e-4, max_memory=2**20)
+    assert isinstance(G.data_pca, IncrementalPCA)
+    assert G.data_nu.shape == (data.shape[0], 20)
+    # same subspace as randomized PCA, up to sign
+    G_full = build_graph(data, n_pca=20, thresh=1e-4)
+    for i in range(5):
+        corr = np.corrcoef(G.data_nu[:, i], G_full.data_nu[:, i])[0, 1]
+        assert np.abs(corr) > 0.99
+    assert G.transform(data[:10]).shape == (10, 20)
+
+
+@raises(MemoryError)
+def test_sparse_pca_max_memory_too_small():
+    build_graph(sp.csr_matrix(data), n_pca=20, max_memory=2**16)
+
+
 #############
 # Test API
 #############
@@ -192,8 +215,10 @@ def test_inverse_transform_sparse_no_pca():
 
 def test_set_params():
     G = graphtools.base.Data(data, n_pca=20)
-    assert G.get_params() == {'n_pca': 20, 'random_state': None}
+    assert G.get_params() == {'n_pca': 20, 'random_state': None,
+                              'dtype': None}
     G.set_params(random_state=13)
     assert G.random_state == 13
     assert_raises(ValueError, G.set_params, n_pca=10)
-    G.set_params(n_pca=G.n_pca)
+    assert_raises(ValueError, G.set_params, dtype=np.float32)
+    G.set_params(n_pca=G.n_pca, dtype=G.dtype)
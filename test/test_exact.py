@@ -14,6 +14,7 @@ from load_tests import (
     PCA,
     TruncatedSVD
 )
+import tempfile
 
 #####################################################
 # Check parameters
@@ -139,6 +140,133 @@ def test_exact_graph():
     assert(isinstance(G2, graphtools.graphs.TraditionalGraph))
 
 
+def test_exact_graph_float32():
+    G = build_graph(data, n_pca=20, decay=10, thresh=0)
+    G32 = build_graph(data, n_pca=20, decay=10, thresh=0,
+                      dtype=np.float32)
+    for M, M32 in [(G.K, G32.K), (G.P, G32.P), (G.diff_aff, G32.diff_aff)]:
+        assert M32.dtype == np.float32
+        np.testing.assert_allclose(M32, M, atol=1e-5)
+    K32 = G32.build_kernel_to_data(data[:20])
+    assert K32.dtype == np.float32
+    np.testing.assert_allclose(K32, G.build_kernel_to_data(data[:20]),
+                               atol=1e-5)
+
+
+def test_build_exact_kernel_to_data_max_memory():
+    G = build_graph(data, n_pca=None, decay=10, thresh=0)
+    G_blocked = build_graph(data, n_pca=None, decay=10, thresh=0,
+                            max_memory=2**25)
+    n = G.data_nu.shape[0] // 2
+    assert len(G_blocked._row_blocks(n, 24 * G.data_nu.shape[0])) > 1
+    np.testing.assert_array_equal(G.build_kernel_to_data(G.data_nu[:n]),
+                                  G_blocked.build_kernel_to_data(
+                                      G_blocked.data_nu[:n]))
+
+
+def test_exact_graph_max_memory():
+    G = build_graph(data, n_pca=None, decay=10, thresh=0)
+    G_blocked = build_graph(data, n_pca=None, decay=10, thresh=0,
+                            max_memory=2**26)
+    np.testing.assert_allclose(G_blocked.K, G.K, atol=1e-12)
+
+
+def test_precomputed_exact_graph_max_memory():
+    pdx = squareform(pdist(data[:500]))
+    G = build_graph(pdx, n_pca=None, precomputed='distance', decay=10,
+                    thresh=0)
+    G_blocked = build_graph(pdx, n_pca=None, precomputed='distance',
+                            decay=10, thresh=0, max_memory=3 * 2**20)
+    assert len(G_blocked._row_blocks(500, 16 * 500)) > 1
+    np.testing.assert_array_equal(G_blocked.K, G.K)
+
+
+def test_precomputed_memmap():
+    pdx = squareform(pdist(data[:500]))
+    K = np.exp(-1 * (pdx / np.median(pdx))**2)
+    with tempfile.NamedTemporaryFile(suffix='.npy') as f:
+        for precomputed, X in [('distance', pdx), ('affinity', K),
+                               ('adjacency', K)]:
+            np.save(f.name, X)
+            G = build_graph(X, n_pca=None, precomputed=precomputed,
+                            decay=10, thresh=1e-4, kernel_output='sparse')
+            for X_mmap in [f.name, np.load(f.name, mmap_mode='r')]:
+                G_mmap = build_graph(X_mmap, n_pca=None,
+                                     precomputed=precomputed,
+                                     decay=10, thresh=1e-4,
+                                     max_memory=2**20)
+                assert isinstance(G_mmap.data_nu, np.memmap)
+                assert sp.isspmatrix_csr(G_mmap.K)
+                assert abs(G_mmap.K - G.K).max() < 1e-12
+
+
+@raises(ValueError)
+def test_precomputed_memmap_negative():
+    with tempfile.NamedTemporaryFile(suffix='.npy') as f:
+        np.save(f.name, -1 * squareform(pdist(data[:100])))
+        build_graph(f.name, n_pca=None, precomputed='distance')
+
+
+def test_exact_graph_n_jobs():
+    G = build_graph(data, n_pca=20, decay=10, thresh=0, n_jobs=1)
+    for kwargs in [{}, {'max_memory': 2**26}]:
+        G_threaded = build_graph(data, n_pca=20, decay=10, thresh=0,
+                                 n_jobs=4, **kwargs)
+        assert G_threaded._n_threads(G.data_nu.shape[0]) == 4
+        np.testing.assert_array_equal(G_threaded.K, G.K)
+    G = build_graph(data, n_pca=20, decay=10, thresh=1e-4, n_jobs=1,
+                    graphtype='exact', kernel_output='sparse')
+    G_threaded = build_graph(data, n_pca=20, decay=10, thresh=1e-4,
+                             n_jobs=-1, graphtype='exact',
+                             kernel_output='sparse')
+    assert (G_threaded.K != G.K).nnz == 0
+    np.testing.assert_array_equal(
+        G_threaded.build_kernel_to_data(G.data_nu[:500]).toarray(),
+        G.build_kernel_to_data(G.data_nu[:500]).toarray())
+
+
+@raises(MemoryError)
+def test_exact_graph_max_memory_too_small():
+    build_graph(data, n_pca=None, decay=10, thresh=0, max_memory=2**20)
+
+
+@raises(ValueError)
+def test_invalid_kernel_output():
+    build_graph(data, graphtype='exact', kernel_output='csr')
+
+
+def test_sparse_kernel_output():
+    G = build_graph(data, n_pca=20, decay=10, thresh=1e-4,
+                    graphtype='exact', kernel_output='dense')
+    assert isinstance(G.K, np.ndarray)
+    # digits are clustered: the thresholded kernel is mostly zeros
+    G_auto = build_graph(data, n_pca=20, decay=10, thresh=1e-4,
+                         graphtype='exact')
+    assert sp.isspmatrix_csr(G_auto.K)
+    np.testing.assert_array_equal(G_auto.K.toarray(), G.K)
+    assert sp.issparse(G_auto.P)
+    np.testing.assert_allclose(G_auto.P.toarray(), G.P)
+    G_sparse = build_graph(data, n_pca=20, decay=10, thresh=0,
+                           graphtype='exact', kernel_output='sparse')
+    assert sp.issparse(G_sparse.K)
+    # no truncation: too dense for a sparse kernel
+    G_dense = build_graph(data, n_pca=20, decay=10, thresh=0,
+                          graphtype='exact')
+    assert isinstance(G_dense.K, np.ndarray)
+    np.testing.assert_allclose(G_sparse.K.toarray(), G_dense.K)
+    G_random_state = graphtools.Graph(data, n_pca=20, decay=10, thresh=1e-4,
+                                      graphtype='exact', verbose=0,
+                                      random_state=np.random.RandomState(42))
+    assert sp.isspmatrix_csr(G_random_state.K)
+
+
+@raises(MemoryError)
+def test_small_exact_graph_max_memory_too_small():
+    # too few rows to project the density: built dense at once
+    build_graph(data[:100], n_pca=None, decay=10, thresh=1e-4,
+                graphtype='exact', max_memory=2**16)
+
+
 def test_truncated_exact_graph():
     k = 3
     a = 13
@@ -325,6 +453,20 @@ def test_exact_interpolate():
                   G.interpolate(pca_data, transitions=transitions)))
 
 
+def test_exact_interpolate_blocks():
+    G = build_graph(data, n_pca=20, decay=10, thresh=1e-4,
+                    graphtype='exact', max_memory=2**22)
+    pca_data = PCA(2).fit_transform(data)
+    assert len(G._row_blocks(data.shape[0],
+                             16 * G.data_nu.shape[0])) > 1
+    transitions = G.extend_to_data(data)
+    assert sp.isspmatrix_csr(transitions)
+    np.testing.assert_allclose(transitions.sum(axis=1), 1)
+    np.testing.assert_allclose(G.interpolate(pca_data, Y=data),
+                               G.interpolate(pca_data,
+                                             transitions=transitions))
+
+
 @raises(ValueError)
 def test_precomputed_interpolate():
     G = build_graph(squareform(pdist(data)), n_pca=None,
@@ -347,16 +489,28 @@ def test_set_params():
     G = build_graph(data, decay=10, thresh=0)
     assert G.get_params() == {'n_pca': 20,
                               'random_state': 42,
+                              'dtype': None,
                               'kernel_symm': '+',
                               'gamma': None,
                               'knn': 3,
                               'decay': 10,
                               'distance': 'euclidean',
-                              'precomputed': None}
+                              'precomputed': None,
+                              'kernel_output': 'auto',
+                              'n_jobs': -1,
+                              'max_memory': None}
     assert_raises(ValueError, G.set_params, knn=15)
     assert_raises(ValueError, G.set_params, decay=15)
     assert_raises(ValueError, G.set_params, distance='manhattan')
     assert_raises(ValueError, G.set_params, precomputed='distance')
+    assert_raises(ValueError, G.set_params, kernel_output='sparse')
+    G.set_params(n_jobs=4)
+    assert G.n_jobs == 4
+    G.set_params(max_memory=1)
+    assert G.max_memory == 1
+    assert_raises(MemoryError, G.build_kernel_to_data, data[:10])
+    G.set_params(max_memory=None)
+    assert G.get_params()['max_memory'] is None
     G.set_params(knn=G.knn,
                  decay=G.decay,
                  distance=G.distance,
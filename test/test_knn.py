@@ -12,10 +12,18 @@ from load_tests import (
     raises,
     squareform,
     pdist,
+    cdist,
     PCA,
     TruncatedSVD,
+    NearestNeighbors,
 )
 
+try:
+    import tracemalloc
+except ImportError:
+    # python2 support is missing
+    pass
+
 
 #####################################################
 # Check parameters
@@ -37,6 +45,11 @@ def test_build_knn_with_sample_idx():
     build_graph(data, graphtype='knn', sample_idx=np.arange(len(data)))
 
 
+@raises(ValueError)
+def test_build_knn_with_invalid_knn_method():
+    build_graph(data, graphtype='knn', knn_method='hello world')
+
+
 @warns(RuntimeWarning)
 def test_duplicate_data():
     build_graph(np.vstack([data, data[:10]]),
@@ -45,6 +58,19 @@ def test_duplicate_data():
                 thresh=1e-4)
 
 
+def test_duplicate_groups():
+    X = np.vstack([data, data[:10], data[:1]])
+    groups = graphtools.utils.find_duplicates(X, block_size=100)
+    assert len(groups) == 10
+    np.testing.assert_array_equal(groups[0],
+                                  [0, data.shape[0], data.shape[0] + 10])
+    for i, group in enumerate(groups[1:], 1):
+        np.testing.assert_array_equal(group, [i, data.shape[0] + i])
+    sparse_groups = graphtools.utils.find_duplicates(sp.csr_matrix(X))
+    assert len(sparse_groups) == len(groups)
+    assert graphtools.utils.find_duplicates(data) == []
+
+
 #####################################################
 # Check kernel
 #####################################################
@@ -124,6 +150,239 @@ def test_sparse_alpha_knn_graph():
     assert(isinstance(G2, graphtools.graphs.kNNGraph))
 
 
+def test_sparse_alpha_knn_graph_outliers():
+    # outliers have a much larger decay radius than the bulk of the data
+    generator = np.random.RandomState(42)
+    data = np.vstack([generator.normal(0, 1, (1000, 3)),
+                      generator.normal(0, 50, (20, 3))])
+    k = 5
+    a = 3
+    thresh = 1e-4
+    pdx = squareform(pdist(data, metric='euclidean'))
+    knn_dist = np.partition(pdx, k, axis=1)[:, :k]
+    epsilon = np.max(knn_dist, axis=1)
+    pdx = (pdx.T / epsilon).T
+    K = np.exp(-1 * pdx**a)
+    K[K < thresh] = 0
+    K = (K + K.T) / 2
+    G = build_graph(data, n_pca=None, decay=a, knn=k, thresh=thresh,
+                    random_state=42)
+    np.testing.assert_allclose(G.K.toarray(), K, atol=1e-12)
+
+
+def test_knn_graph_float32():
+    G = build_graph(data, n_pca=20, decay=10, knn=5, thresh=1e-4)
+    G32 = build_graph(data, n_pca=20, decay=10, knn=5, thresh=1e-4,
+                      dtype=np.float32)
+    for M, M32 in [(G.K, G32.K), (G.P, G32.P), (G.diff_aff, G32.diff_aff)]:
+        assert M32.dtype == np.float32
+        assert abs(M - M32).max() < 1e-5
+    assert G32.data_nu.dtype == np.float32
+    K32 = G32.build_kernel_to_data(data[:20])
+    assert K32.dtype == np.float32
+    assert abs(G.build_kernel_to_data(data[:20]) - K32).max() < 1e-5
+
+
+def test_knn_graph_max_memory():
+    generator = np.random.RandomState(42)
+    X = np.vstack([generator.normal(0, 1, (1000, 3)),
+                   generator.normal(0, 50, (20, 3))])
+    for decay in [None, 3]:
+        G = build_graph(X, n_pca=None, decay=decay, knn=5, thresh=1e-4)
+        G_blocked = build_graph(X, n_pca=None, decay=decay, knn=5,
+                                thresh=1e-4, max_memory=2**16)
+        assert len(G_blocked._row_blocks(X.shape[0], 32 * 100)) > 1
+        assert G.K.nnz == G_blocked.K.nnz
+        assert abs(G.K - G_blocked.K).max() < 1e-10
+
+
+def test_knn_graph_max_memory_backends():
+    try:
+        tracemalloc
+    except NameError:
+        return
+    X = np.random.RandomState(42).normal(0, 1, (5000, 50))
+    max_memory = 2**20
+    K_exact = build_graph(X, n_pca=None, knn=5, decay=40, thresh=1e-4,
+                          knn_method='brute').build_kernel_to_data(X[:1000])
+    for knn_method in ['gemm', 'nndescent', 'brute', 'ball_tree']:
+        G = graphtools.graphs.kNNGraph(
+            X, n_pca=None, knn=5, decay=40, knn_method=knn_method,
+            max_memory=max_memory, random_state=42, initialize=False)
+        G.knn_tree
+        tracemalloc.start()
+        try:
+            K = G.build_kernel_to_data(X[:1000])
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # search results for a block of rows, plus the kernel itself
+        assert peak < 4 * max_memory, (knn_method, peak)
+        if knn_method == 'nndescent':
+            assert abs(K - K_exact).sum() / K_exact.sum() < 0.05
+        else:
+            assert abs(K - K_exact).max() < 1e-10
+
+
+@raises(MemoryError)
+def test_knn_graph_max_memory_too_small():
+    build_graph(data, n_pca=None, decay=10, knn=5, thresh=1e-4,
+                max_memory=2**10)
+
+
+def test_precomputed_neighbors():
+    G = build_graph(data, n_pca=20, decay=10, knn=5, thresh=1e-4,
+                    random_state=42)
+    nn = NearestNeighbors(n_neighbors=150).fit(G.data_nu)
+    # enough neighbors for every row, and too few for the decay radius
+    for k in [150, 10]:
+        distances, indices = nn.kneighbors(G.data_nu, n_neighbors=k)
+        G_nn = build_graph(data, n_pca=20, decay=10, knn=5, thresh=1e-4,
+                           random_state=42,
+                           precomputed_neighbors=(indices, distances))
+        assert G_nn.K.nnz == G.K.nnz
+        assert abs(G.K - G_nn.K).max() < 1e-10
+    # sparse distance matrix without self entries, shuffled columns
+    K_dist = nn.kneighbors_graph(n_neighbors=149, mode='distance')
+    G_nn = build_graph(data, n_pca=20, decay=10, knn=5, thresh=1e-4,
+                       random_state=42, precomputed_neighbors=K_dist.tocoo())
+    assert abs(G.K - G_nn.K).max() < 1e-10
+    G = build_graph(data, n_pca=20, decay=None, knn=5, random_state=42)
+    G_nn = build_graph(data, n_pca=20, decay=None, knn=5, random_state=42,
+                       precomputed_neighbors=K_dist)
+    assert (G.K != G_nn.K).nnz == 0
+
+
+@raises(ValueError)
+def test_precomputed_neighbors_too_few():
+    distances, indices = NearestNeighbors(n_neighbors=3).fit(
+        data).kneighbors(data)
+    build_graph(data, n_pca=None, decay=10, knn=5, thresh=1e-4,
+                precomputed_neighbors=(indices, distances))
+
+
+@raises(ValueError)
+def test_precomputed_neighbors_without_self():
+    distances, indices = NearestNeighbors(n_neighbors=10).fit(
+        data).kneighbors()
+    build_graph(data, n_pca=None, decay=10, knn=5, thresh=1e-4,
+                precomputed_neighbors=(indices, distances))
+
+
+@raises(ValueError)
+def test_precomputed_neighbors_wrong_shape():
+    distances, indices = NearestNeighbors(n_neighbors=10).fit(
+        data).kneighbors(data[:10])
+    build_graph(data, n_pca=None, decay=10, knn=5, thresh=1e-4,
+                precomputed_neighbors=(indices, distances))
+
+
+@raises(ValueError)
+def test_build_exact_with_precomputed_neighbors():
+    K_dist = NearestNeighbors(n_neighbors=10).fit(data).kneighbors_graph(
+        mode='distance')
+    build_graph(data, n_pca=None, graphtype='exact',
+                precomputed_neighbors=K_dist)
+
+
+def test_alpha_decay_csr_blocks():
+    G = build_graph(data, n_pca=20, decay=10, knn=5, thresh=1e-4,
+                    random_state=42)
+    distances, indices = G.knn_tree.kneighbors(G.data_nu, n_neighbors=5)
+    bandwidth = distances[:, -1].copy()
+    indptr = np.arange(0, distances.size + 1, 5)
+    K = graphtools.utils.alpha_decay_csr(
+        distances.ravel().copy(), indices.ravel().copy(), indptr,
+        bandwidth, 10, 1e-4, shape=(data.shape[0], data.shape[0]))
+    K_blocked = graphtools.utils.alpha_decay_csr(
+        distances.ravel().copy(), indices.ravel().copy(), indptr,
+        bandwidth, 10, 1e-4, shape=(data.shape[0], data.shape[0]),
+        block_size=37)
+    assert K.has_canonical_format
+    assert K_blocked.has_canonical_format
+    assert np.all(K.data >= 1e-4)
+    assert (K - K_blocked).nnz == 0
+    np.testing.assert_array_equal(K.indptr, K_blocked.indptr)
+    np.testing.assert_array_equal(K.indices, K_blocked.indices)
+
+
+def test_knn_kernel_escalation():
+    # a slow decay needs many more neighbors than knn * 20, so the search
+    # is escalated twice and then finished by radius searches
+    knn, decay, thresh = 2, 0.75, 1e-4
+    X = np.random.RandomState(42).uniform(size=(10000, 2))
+    G = graphtools.graphs.kNNGraph(X, n_pca=None, knn=knn, decay=decay,
+                                   thresh=thresh, random_state=42,
+                                   verbose=0, initialize=False)
+    searches = []
+    kneighbors = G.knn_tree.kneighbors
+    radius_neighbors = G.knn_tree.radius_neighbors
+
+    def record_kneighbors(Y, n_neighbors=None, **kwargs):
+        searches.append(n_neighbors)
+        return kneighbors(Y, n_neighbors=n_neighbors, **kwargs)
+
+    def record_radius_neighbors(Y, **kwargs):
+        searches.append('radius')
+        return radius_neighbors(Y, **kwargs)
+    G.knn_tree.kneighbors = record_kneighbors
+    G.knn_tree.radius_neighbors = record_radius_neighbors
+    Y = X[:1000]
+    K = G.build_kernel_to_data(Y)
+    assert searches[:2] == [knn * 20, knn * 400]
+    assert searches[2:] and all(s == 'radius' for s in searches[2:])
+    pdx = cdist(Y, X)
+    bandwidth = np.partition(pdx, knn - 1, axis=1)[:, knn - 1]
+    K_dense = np.exp(-1 * (pdx / bandwidth[:, None])**decay)
+    K_dense[K_dense < thresh] = 0
+    assert K.nnz == np.sum(K_dense > 0)
+    np.testing.assert_allclose(K.toarray(), K_dense, atol=1e-10)
+
+
+def test_ragged_ranges():
+    starts = np.array([5, 0, 9, 2])
+    lengths = np.array([3, 0, 1, 4])
+    np.testing.assert_array_equal(
+        graphtools.utils.ragged_ranges(starts, lengths),
+        np.concatenate([np.arange(s, s + l)
+                        for s, l in zip(starts, lengths)]))
+    assert len(graphtools.utils.ragged_ranges([], [])) == 0
+
+
+def test_gather_ragged():
+    generator = np.random.RandomState(42)
+    n_rows = 50
+    # every row is in the first block; later blocks replace some rows
+    row_block = np.zeros(n_rows, dtype=np.intp)
+    row_pos = np.arange(n_rows)
+    blocks = []
+    expected = [None] * n_rows
+    for b, rows in enumerate([np.arange(n_rows),
+                              generator.choice(n_rows, 20, replace=False),
+                              generator.choice(n_rows, 10, replace=False)]):
+        lengths = generator.randint(0, 8, len(rows))
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        block_data = generator.rand(indptr[-1])
+        block_indices = generator.randint(0, 1000, indptr[-1])
+        blocks.append((block_data, block_indices, indptr))
+        row_block[rows] = b
+        row_pos[rows] = np.arange(len(rows))
+        for i, row in enumerate(rows):
+            expected[row] = (block_data[indptr[i]:indptr[i + 1]],
+                             block_indices[indptr[i]:indptr[i + 1]])
+    assert len(np.unique(row_block)) == 3
+    K_data, K_indices, K_indptr = graphtools.utils.gather_ragged(
+        blocks, row_block, row_pos)
+    np.testing.assert_array_equal(
+        K_indptr, np.concatenate([[0], np.cumsum(
+            [len(row_data) for row_data, _ in expected])]))
+    np.testing.assert_array_equal(
+        K_data, np.concatenate([row_data for row_data, _ in expected]))
+    np.testing.assert_array_equal(
+        K_indices,
+        np.concatenate([row_indices for _, row_indices in expected]))
+
+
 @warns(UserWarning)
 def test_knn_graph_sparse_no_pca():
     build_graph(sp.coo_matrix(data), n_pca=None,  # n_pca,
@@ -131,6 +390,169 @@ def test_knn_graph_sparse_no_pca():
                 random_state=42, use_pygsp=True)
 
 
+def test_select_backend():
+    select = graphtools.neighbors.select_backend
+    assert select(10000, 3) == 'kd_tree'
+    assert select(10000, 20) == 'ball_tree'
+    assert select(10000, 100) == 'gemm'
+    assert select(100, 3) == 'gemm'
+    assert select(10000, 3, n_neighbors=6000) == 'gemm'
+    assert select(10000, 3, metric='cosine') == 'gemm'
+    assert select(10000, 100, metric='manhattan') == 'brute'
+    assert select(10000, 3, is_sparse=True) == 'brute'
+
+
+def test_custom_backend():
+    calls = []
+
+    def backend(**kwargs):
+        calls.append(kwargs)
+        return NearestNeighbors(n_neighbors=kwargs['n_neighbors'],
+                                algorithm='brute', metric=kwargs['metric'])
+    graphtools.neighbors.register_backend('test_backend', backend)
+    assert 'test_backend' in graphtools.neighbors.available_backends()
+    G = build_graph(data, decay=None, knn_method='test_backend')
+    G2 = build_graph(data, decay=None, knn_method='brute')
+    assert(len(calls) == 1)
+    assert(calls[0]['n_neighbors'] == G.knn)
+    assert((G.K != G2.K).nnz == 0)
+    assert_raises(ValueError, graphtools.neighbors.register_backend,
+                  'auto', backend)
+
+
+@warns(UserWarning)
+def test_knn_method_invalid_metric():
+    G = build_graph(data, decay=None, knn_method='kd_tree',
+                    distance='cosine')
+    assert(isinstance(G.knn_tree, graphtools.neighbors.GEMMNeighbors))
+
+
+def test_gemm_neighbors():
+    k = 10
+    data_nu = PCA(20, svd_solver='randomized',
+                  random_state=42).fit_transform(data)
+    Y = data_nu[:300] + 0.1
+    for metric in ['euclidean', 'cosine']:
+        exact = NearestNeighbors(n_neighbors=k, algorithm='brute',
+                                 metric=metric).fit(data_nu)
+        # a small budget forces tiling over both queries and references
+        gemm = graphtools.neighbors.GEMMNeighbors(
+            n_neighbors=k, metric=metric, max_memory=2**16).fit(data_nu)
+        assert(gemm._tiles(k)[1] < data_nu.shape[0])
+        dist_exact, ind_exact = exact.kneighbors(Y)
+        dist, ind = gemm.kneighbors(Y)
+        np.testing.assert_allclose(dist, dist_exact, atol=1e-6)
+        assert(np.mean(ind == ind_exact) > 0.99)
+        radius = np.median(dist[:, -1])
+        dist_exact, ind_exact = exact.radius_neighbors(Y, radius=radius)
+        dist, ind = gemm.radius_neighbors(Y, radius=radius)
+        for i, j in zip(ind, ind_exact):
+            assert(len(np.setxor1d(i, j)) <= 1)
+
+
+def test_gemm_knn_graph():
+    G = build_graph(data, n_pca=20, decay=10, knn=5, thresh=1e-4,
+                    knn_method='ball_tree')
+    G2 = build_graph(data, n_pca=20, decay=10, knn=5, thresh=1e-4,
+                     knn_method='gemm')
+    assert(isinstance(G2.knn_tree, graphtools.neighbors.GEMMNeighbors))
+    np.testing.assert_allclose(G.K.toarray(), G2.K.toarray(), atol=1e-5)
+
+
+def test_gemm_float32():
+    data_nu = PCA(20, svd_solver='randomized',
+                  random_state=42).fit_transform(data)
+    Y = data_nu[:200] + 0.1
+    for metric in ['euclidean', 'cosine']:
+        gemm = graphtools.neighbors.GEMMNeighbors(
+            n_neighbors=5, metric=metric).fit(data_nu)
+        gemm32 = graphtools.neighbors.GEMMNeighbors(
+            n_neighbors=5, metric=metric).fit(data_nu.astype(np.float32))
+        # the fitted data are not copied to double precision
+        assert(gemm32._fit_data.dtype == np.float32)
+        if metric == 'euclidean':
+            assert(np.shares_memory(gemm32._fit_data, gemm32._fit_X))
+        dist, ind = gemm.kneighbors(Y)
+        dist32, ind32 = gemm32.kneighbors(Y.astype(np.float32))
+        np.testing.assert_allclose(dist32, dist, rtol=1e-5, atol=1e-6)
+        assert(np.mean(ind32 == ind) > 0.99)
+
+
+def test_nndescent_recall():
+    k = 10
+    data_nu = PCA(20, svd_solver='randomized',
+                  random_state=42).fit_transform(data)
+    exact = NearestNeighbors(n_neighbors=k).fit(data_nu)
+    approx = graphtools.neighbors.NNDescent(
+        n_neighbors=k, random_state=42).fit(data_nu)
+    for Y in [data_nu, data_nu[:200] + 0.1]:
+        _, ind_exact = exact.kneighbors(Y)
+        dist, ind = approx.kneighbors(Y)
+        assert(ind.shape == (Y.shape[0], k))
+        assert(np.all(np.diff(dist, axis=1) >= 0))
+        recall = np.mean([float(len(np.intersect1d(i, j))) / k
+                          for i, j in zip(ind, ind_exact)])
+        assert(recall > 0.95)
+
+
+def test_nndescent_recall_clustered():
+    k = 10
+    X, _ = datasets.make_blobs(n_samples=10000, n_features=30, centers=50,
+                               random_state=42)
+    exact = NearestNeighbors(n_neighbors=k, algorithm='ball_tree').fit(X)
+    approx = graphtools.neighbors.NNDescent(
+        n_neighbors=k, random_state=42).fit(X)
+    for Y in [X, X[:1000] + 0.1]:
+        _, ind_exact = exact.kneighbors(Y)
+        ind = approx.kneighbors(Y, return_distance=False)
+        recall = np.mean([float(len(np.intersect1d(i, j))) / k
+                          for i, j in zip(ind, ind_exact)])
+        assert(recall > 0.97)
+    # more neighbors than the graph holds
+    _, ind_exact = exact.kneighbors(X[:1000], n_neighbors=10 * k)
+    ind = approx.kneighbors(X[:1000], n_neighbors=10 * k,
+                            return_distance=False)
+    recall = np.mean([float(len(np.intersect1d(i, j))) / (10 * k)
+                      for i, j in zip(ind, ind_exact)])
+    assert(recall > 0.97)
+
+
+def test_nndescent_knn_graph():
+    G = build_graph(data, n_pca=20, decay=10, knn=5, thresh=1e-4)
+    G2 = build_graph(data, n_pca=20, decay=10, knn=5, thresh=1e-4,
+                     knn_method='nndescent')
+    assert(isinstance(G2.knn_tree, graphtools.neighbors.NNDescent))
+    assert(G.K.shape == G2.K.shape)
+    assert(np.abs(G.K - G2.K).sum() / G.K.sum() < 0.05)
+    G = build_graph(data, n_pca=20, decay=None, knn=5)
+    G2 = build_graph(data, n_pca=20, decay=None, knn=5,
+                     knn_method='nndescent')
+    assert(float((G.K != G2.K).nnz) / G.K.nnz < 0.05)
+
+
+def test_nndescent_knn_graph_reuses_fit():
+    G = graphtools.graphs.kNNGraph(data, n_pca=20, decay=10, knn=5,
+                                   thresh=1e-4, knn_method='nndescent',
+                                   random_state=42, initialize=False)
+    # fitted with as many neighbors as the kernel searches
+    assert(G.knn_tree.graph_.shape[1] == 100)
+    assert(np.all(G.knn_tree.graph_[:, 0] ==
+                  np.arange(G.data_nu.shape[0])))
+    searches = []
+    kneighbors = G.knn_tree.kneighbors
+
+    def record_kneighbors(X, n_neighbors=None, **kwargs):
+        searches.append(n_neighbors)
+        return kneighbors(X, n_neighbors=n_neighbors, **kwargs)
+    G.knn_tree.kneighbors = record_kneighbors
+    K = G.build_kernel()
+    # the data are only searched again for rows the graph does not cover
+    assert(all(n_neighbors > 100 for n_neighbors in searches))
+    K_exact = build_graph(data, n_pca=20, decay=10, knn=5, thresh=1e-4,
+                          knn_method='brute').build_kernel()
+    assert(np.abs(K - K_exact).sum() / K_exact.sum() < 0.05)
+
+
 #####################################################
 # Check interpolation
 #####################################################
@@ -167,6 +589,35 @@ def test_knn_interpolate():
                   G.interpolate(pca_data, transitions=transitions)))
 
 
+def test_knn_interpolate_iter():
+    G = build_graph(data, decay=10, thresh=1e-4)
+    pca_data = PCA(2).fit_transform(data)
+    Y_transform = G.interpolate(pca_data, Y=data)
+    for n_jobs in [1, 2]:
+        G.set_params(n_jobs=n_jobs)
+        blocks = list(G.interpolate_iter(pca_data, data, chunk_size=500))
+        assert len(blocks) == 4
+        np.testing.assert_allclose(np.vstack(blocks), Y_transform,
+                                   atol=1e-12)
+        blocks = G.interpolate_iter(pca_data, (data[i:i + 300] for i in
+                                               range(0, len(data), 300)))
+        np.testing.assert_allclose(np.vstack(list(blocks)), Y_transform,
+                                   atol=1e-12)
+
+
+def test_knn_interpolate_max_memory():
+    # a kNN row needs far less memory than a dense row of the kernel
+    X = np.random.RandomState(42).normal(0, 1, (5000, 10))
+    G = build_graph(X, n_pca=None, decay=40, knn=5, thresh=1e-4)
+    G_blocked = build_graph(X, n_pca=None, decay=40, knn=5, thresh=1e-4,
+                            max_memory=2**16)
+    assert 16 * X.shape[0] > G_blocked.max_memory
+    Y_transform = G.interpolate(X[:, :2], Y=X[:500])
+    np.testing.assert_allclose(
+        G_blocked.interpolate(X[:, :2], Y=X[:500]), Y_transform,
+        atol=1e-12)
+
+
 ####################
 # Test API
 ####################
@@ -183,13 +634,18 @@ def test_set_params():
     assert G.get_params() == {
         'n_pca': 20,
         'random_state': 42,
+        'dtype': None,
         'kernel_symm': '+',
         'gamma': None,
         'knn': 3,
         'decay': None,
         'distance': 'euclidean',
         'thresh': 0,
+        'knn_method': 'auto',
+        'knn_params': None,
+        'precomputed_neighbors': None,
         'n_jobs': -1,
+        'max_memory': None,
         'verbose': 0
     }
     G.set_params(n_jobs=4)
@@ -200,10 +656,17 @@ def test_set_params():
     G.set_params(verbose=2)
     assert G.verbose == 2
     G.set_params(verbose=0)
+    G.set_params(max_memory=2**20)
+    assert G.max_memory == 2**20
     assert_raises(ValueError, G.set_params, knn=15)
     assert_raises(ValueError, G.set_params, decay=10)
     assert_raises(ValueError, G.set_params, distance='manhattan')
     assert_raises(ValueError, G.set_params, thresh=1e-3)
+    assert_raises(ValueError, G.set_params, knn_method='nndescent')
+    assert_raises(ValueError, G.set_params, knn_params={'leaf_size': 10})
+    assert_raises(ValueError, G.set_params,
+                  precomputed_neighbors=G.knn_tree.kneighbors_graph(
+                      mode='distance'))
     assert_raises(ValueError, G.set_params, gamma=0.99)
     assert_raises(ValueError, G.set_params, kernel_symm='*')
     G.set_params(knn=G.knn,
@@ -1,6 +1,7 @@
 from load_tests import (
     graphtools,
     np,
+    sp,
     nose2,
     data,
     digits,
@@ -23,6 +24,11 @@ def test_build_landmark_with_too_many_landmarks():
     build_graph(data, n_landmark=len(data))
 
 
+@raises(ValueError)
+def test_build_landmark_with_invalid_method():
+    build_graph(data, n_landmark=100, landmark_method='invalid')
+
+
 @warns(RuntimeWarning)
 def test_build_landmark_with_too_few_points():
     build_graph(data[:50], n_landmark=25, n_svd=100)
@@ -54,6 +60,178 @@ def test_landmark_knn_graph():
     assert(isinstance(G, graphtools.graphs.LandmarkGraph))
 
 
+def test_landmark_cluster_indicator():
+    for graphtype, thresh in [('knn', 1e-4), ('exact', 0)]:
+        G = build_graph(data, n_landmark=100, n_pca=20, decay=10, knn=5,
+                        thresh=thresh, graphtype=graphtype)
+        indicator = G.cluster_indicator
+        assert indicator.shape == (data.shape[0], G.landmark_op.shape[0])
+        np.testing.assert_array_equal(indicator.sum(axis=1), 1)
+        K = G.kernel.toarray() if sp.issparse(G.kernel) else G.kernel
+        pmn = np.array([K[G._clusters == i].sum(axis=0)
+                        for i in np.unique(G._clusters)])
+        pmn_indicator = G._landmarks_to_data()
+        if sp.issparse(pmn_indicator):
+            pmn_indicator = pmn_indicator.toarray()
+        np.testing.assert_allclose(pmn_indicator, pmn, atol=1e-12)
+        Y = G.data_nu[:300] + 0.01
+        transitions = G.extend_to_data(Y)
+        K_Y = G.build_kernel_to_data(Y)
+        if sp.issparse(K_Y):
+            K_Y = K_Y.toarray()
+        pnm = np.array([K_Y[:, G._clusters == i].sum(axis=1)
+                        for i in np.unique(G._clusters)]).T
+        pnm = pnm / pnm.sum(axis=1, keepdims=True)
+        if sp.issparse(transitions):
+            transitions = transitions.toarray()
+        np.testing.assert_allclose(transitions, pnm, atol=1e-12)
+    G.set_params(n_landmark=50)
+    assert not hasattr(G, '_cluster_indicator')
+    assert G.cluster_indicator.shape[1] == G.landmark_op.shape[0]
+
+
+def _landmark_diffusion_error(G):
+    # error of diffusing through landmarks rather than through samples
+    P = G.diff_op.toarray() if sp.issparse(G.diff_op) else G.diff_op
+    transitions = G.transitions
+    if sp.issparse(transitions):
+        transitions = transitions.toarray()
+    P_landmark = G.cluster_indicator.T.dot(P.T).T
+    return np.linalg.norm(P_landmark - transitions.dot(G.landmark_op)) / \
+        np.linalg.norm(P_landmark)
+
+
+def test_landmark_methods():
+    G = build_graph(data, n_landmark=100, n_pca=20, decay=10, knn=5,
+                    thresh=1e-4)
+    spectral_error = _landmark_diffusion_error(G)
+    for landmark_method in ['random', 'kmeans++', 'farthest', 'degree']:
+        G.set_params(landmark_method=landmark_method)
+        assert not hasattr(G, '_landmark_op')
+        assert G.landmark_op.shape == (100, 100)
+        np.testing.assert_allclose(np.sum(G.transitions, axis=1), 1)
+        assert _landmark_diffusion_error(G) < 1.5 * spectral_error
+    assert_raises(ValueError, G.set_params, landmark_method='invalid')
+
+
+def test_landmark_streaming():
+    for graphtype, thresh in [('knn', 1e-4), ('exact', 1e-4)]:
+        G = build_graph(data, n_landmark=100, n_pca=20, decay=10, knn=5,
+                        thresh=thresh, graphtype=graphtype,
+                        landmark_method='farthest')
+        G_stream = build_graph(data, n_landmark=100, n_pca=20, decay=10,
+                               knn=5, thresh=thresh, graphtype=graphtype,
+                               landmark_method='farthest', streaming=True,
+                               max_memory=2**22)
+        np.testing.assert_allclose(G_stream.landmark_op, G.landmark_op,
+                                   atol=1e-12)
+        np.testing.assert_array_equal(G_stream._clusters, G._clusters)
+        assert abs(G_stream.transitions - G.transitions).max() < 1e-12
+        assert not hasattr(G_stream, '_kernel')
+    transitions = G_stream.extend_to_data(G.data_nu[:100] + 0.01)
+    assert transitions.shape == (100, G.landmark_op.shape[0])
+    assert not hasattr(G_stream, '_kernel')
+    assert_raises(ValueError, G_stream.set_params, landmark_method='degree')
+    assert_raises(ValueError, G_stream.set_params, streaming=False)
+
+
+def test_landmark_streaming_invalid():
+    assert_raises(ValueError, build_graph, data, n_landmark=100,
+                  streaming=True)
+    assert_raises(ValueError, build_graph, data, n_landmark=100,
+                  landmark_method='random', streaming=True,
+                  kernel_symm='*')
+    assert_raises(ValueError, build_graph, data, landmark_method='random',
+                  streaming=True)
+    assert_raises(ValueError, build_graph, data, n_landmark=100,
+                  landmark_method='random', streaming=True, use_pygsp=True)
+
+
+def test_sparse_landmark_op():
+    for graphtype, thresh in [('knn', 1e-4), ('exact', 0)]:
+        G = build_graph(data, n_landmark=100, n_pca=20, decay=10, knn=5,
+                        thresh=thresh, graphtype=graphtype)
+        assert isinstance(G.landmark_op, np.ndarray)
+        landmark_op = G.landmark_op
+        assert sp.isspmatrix_csr(G.transitions)
+        G.set_params(landmark_output='sparse')
+        assert sp.isspmatrix_csr(G.landmark_op)
+        assert sp.isspmatrix_csr(G.transitions)
+        np.testing.assert_allclose(G.landmark_op.toarray(), landmark_op,
+                                   atol=1e-12)
+        G.set_params(landmark_thresh=1e-3)
+        assert sp.isspmatrix_csr(G.landmark_op)
+        assert G.landmark_op.nnz < np.sum(landmark_op > 0)
+        assert G.landmark_op.data.min() >= 1e-3
+        np.testing.assert_allclose(G.landmark_op.sum(axis=1), 1)
+        G.set_params(landmark_output='auto', landmark_thresh=0.05)
+        assert sp.isspmatrix_csr(G.landmark_op)
+        G.set_params(landmark_output='dense')
+        assert isinstance(G.landmark_op, np.ndarray)
+        np.testing.assert_allclose(G.landmark_op.sum(axis=1), 1)
+        # a threshold above every entry keeps only the largest of each row
+        for landmark_output in ['dense', 'sparse']:
+            G.set_params(landmark_output=landmark_output, landmark_thresh=1)
+            op = G.landmark_op
+            if sp.issparse(op):
+                op = op.toarray()
+            np.testing.assert_allclose(op.sum(axis=1), 1)
+            np.testing.assert_array_equal(
+                np.argmax(op, axis=1), np.argmax(landmark_op, axis=1))
+    assert_raises(ValueError, G.set_params, landmark_output='csr')
+    assert_raises(ValueError, build_graph, data, n_landmark=100,
+                  landmark_output='csr')
+
+
+def test_landmark_interpolate_iter():
+    G = build_graph(data, n_landmark=100, n_pca=20, decay=10, knn=5,
+                    thresh=1e-4)
+    transform = np.random.RandomState(42).normal(
+        size=(G.landmark_op.shape[0], 2))
+    Y_transform = G.interpolate(transform, Y=data[:1000])
+    blocks = list(G.interpolate_iter(transform, data[:1000], chunk_size=300))
+    assert [len(block) for block in blocks] == [300, 300, 300, 100]
+    np.testing.assert_allclose(np.vstack(blocks), Y_transform, atol=1e-12)
+
+
+def test_landmark_kmeans_restarts():
+    G = build_graph(data, n_landmark=500, n_pca=20, decay=None, knn=5,
+                    n_jobs=2)
+    G.landmark_op
+    clusters = G._clusters
+    G.set_params(n_init=3)
+    assert hasattr(G, '_spectral_embedding')
+    G.landmark_op
+    assert not np.array_equal(G._clusters, clusters)
+    G.set_params(empty_clusters='reassign')
+    assert G.landmark_op.shape == (500, 500)
+    assert len(np.unique(G._clusters)) == 500
+    assert_raises(ValueError, G.set_params, empty_clusters='merge')
+    assert_raises(ValueError, build_graph, data, n_landmark=100,
+                  empty_clusters='merge')
+
+
+def test_landmark_knn_graph_float32():
+    G = build_graph(data, n_landmark=100, n_pca=20, decay=10, knn=5,
+                    thresh=1e-4)
+    G32 = build_graph(data, n_landmark=100, n_pca=20, decay=10, knn=5,
+                      thresh=1e-4, dtype=np.float32)
+    assert isinstance(G32, graphtools.graphs.kNNLandmarkGraph)
+    assert G32.landmark_op.dtype == np.float32
+    assert G32.transitions.dtype == np.float32
+    np.testing.assert_allclose(G32.landmark_op, G.landmark_op, atol=1e-5)
+    assert abs(G32.transitions - G.transitions).max() < 1e-5
+
+
+def test_landmark_knn_graph_max_memory():
+    G = build_graph(data, n_landmark=100, n_pca=20, decay=10, knn=5,
+                    thresh=1e-4, max_memory=2**23)
+    assert G.landmark_op.shape == (100, 100)
+    G = build_graph(data, n_landmark=100, n_pca=20, decay=10, knn=5,
+                    thresh=1e-4, max_memory=2**22)
+    assert_raises(MemoryError, getattr, G, 'landmark_op')
+
+
 def test_landmark_mnn_graph():
     n_landmark = 150
     X, sample_idx = generate_swiss_roll()
@@ -134,19 +312,36 @@ def test_set_params():
     G.landmark_op
     assert G.get_params() == {'n_pca': 20,
                               'random_state': 42,
+                              'dtype': None,
                               'kernel_symm': '+',
                               'gamma': None,
                               'n_landmark': 500,
+                              'landmark_method': 'spectral',
+                              'streaming': False,
+                              'landmark_output': 'dense',
+                              'landmark_thresh': 0,
+                              'n_init': 1,
+                              'empty_clusters': 'drop',
                               'knn': 3,
                               'decay': None,
                               'distance':
                               'euclidean',
                               'thresh': 0,
+                              'knn_method': 'auto',
+                              'knn_params': None,
+                              'precomputed_neighbors': None,
                               'n_jobs': -1,
+                              'max_memory': None,
                               'verbose': 0}
+    embedding = G._spectral_embedding
     G.set_params(n_landmark=300)
+    assert G._spectral_embedding is embedding
     assert G.landmark_op.shape == (300, 300)
+    assert G._spectral_embedding is embedding
     G.set_params(n_landmark=G.n_landmark, n_svd=G.n_svd)
     assert hasattr(G, "_landmark_op")
     G.set_params(n_svd=50)
     assert not hasattr(G, "_landmark_op")
+    assert not hasattr(G, "_spectral_embedding")
+    G.landmark_op
+    assert G._spectral_embedding.shape == (data.shape[0], 50)
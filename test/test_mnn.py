@@ -1,6 +1,7 @@
 from load_tests import (
     graphtools,
     np,
+    sp,
     pd,
     pygsp,
     nose2,
@@ -215,6 +216,30 @@ def test_mnn_graph_matrix_gamma():
 
 # TODO: add interpolation tests
 
+def test_mnn_sparse_kernel_blocks():
+    X, sample_idx = generate_swiss_roll()
+    G = build_graph(X, sample_idx=sample_idx, knn=10, decay=20, thresh=1e-4,
+                    beta=0.5, kernel_symm='gamma',
+                    gamma=np.array([[1, 0.8], [0.8, 1]]), n_pca=None)
+    K = G.build_kernel()
+    assert sp.isspmatrix_csr(K)
+    # reference assembly by assignment into a lil_matrix
+    K_lil = sp.lil_matrix(K.shape)
+    for i, X_i in enumerate(G.subgraphs):
+        for j, X_j in enumerate(G.subgraphs):
+            Kij = X_j.build_kernel_to_data(X_i.data_nu, knn=G.weighted_knn[i])
+            if i == j:
+                Kij = Kij * G.beta
+            K_lil = graphtools.utils.set_submatrix(
+                K_lil, sample_idx == G.samples[i],
+                sample_idx == G.samples[j], Kij)
+    assert (K != K_lil.tocsr()).nnz == 0
+    K_symm = G.symmetrize_kernel(K)
+    assert sp.isspmatrix_csr(K_symm)
+    assert abs(K_symm - K_symm.T).max() < 1e-12
+    assert (K_symm != G.K).nnz == 0
+
+
 def test_verbose():
     X, sample_idx = generate_swiss_roll()
     print()
@@ -233,6 +258,7 @@ def test_set_params():
     assert G.get_params() == {
         'n_pca': None,
         'random_state': 42,
+        'dtype': None,
         'kernel_symm': 'gamma',
         'gamma': 0.5,
         'beta': 1,
@@ -241,7 +267,10 @@ def test_set_params():
         'decay': 10,
         'distance': 'euclidean',
         'thresh': 1e-4,
-        'n_jobs': 1
+        'knn_method': 'auto',
+        'knn_params': None,
+        'n_jobs': 1,
+        'max_memory': None
     }
     G.set_params(n_jobs=4)
     assert G.n_jobs == 4
@@ -261,6 +290,7 @@ def test_set_params():
     assert_raises(ValueError, G.set_params, decay=15)
     assert_raises(ValueError, G.set_params, distance='manhattan')
     assert_raises(ValueError, G.set_params, thresh=1e-3)
+    assert_raises(ValueError, G.set_params, knn_method='nndescent')
     assert_raises(ValueError, G.set_params, beta=0.2)
     assert_raises(ValueError, G.set_params, adaptive_k='min')
     G.set_params(knn=G.knn,